@@ -0,0 +1,16 @@
+"""
+Benchmarks for import time, which every worker process pays.
+"""
+
+
+class Import:
+    timeout = 120
+
+    def timeraw_import_dendrocat(self):
+        return "import dendrocat"
+
+    def timeraw_import_classes(self):
+        return "from dendrocat import RadioSource, MasterCatalog"
+
+    def timeraw_import_utils(self):
+        return "from dendrocat import utils"
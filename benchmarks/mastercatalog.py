@@ -0,0 +1,53 @@
+"""
+Benchmarks for matching and photometry across images of one field.
+"""
+import astropy.units as u
+
+from dendrocat.radiosource import RadioSource
+from dendrocat.aperture import Ellipse, Annulus
+from dendrocat import utils
+
+from .synthetic import make_image
+from .radiosource import SIZES, DENSITIES
+
+FREQS = [226.1*u.GHz, 93.0*u.GHz]
+
+
+def field(size, density, freqs=FREQS):
+    """
+    Detect the sources of one synthetic field in each band.
+    """
+    sources = []
+    for i, freq in enumerate(freqs):
+        rs = RadioSource(make_image(size, density, freq=freq, seed=i))
+        rs.to_catalog()
+        rs.autoreject()
+        sources.append(rs)
+    return sources
+
+
+class Match:
+    params = (SIZES, DENSITIES)
+    param_names = ['size', 'density']
+    timeout = 600
+
+    def setup(self, size, density):
+        self.sources = field(size, density)
+
+    def time_match(self, size, density):
+        utils.match(*self.sources, verbose=False)
+
+
+class Photometer:
+    params = (SIZES, DENSITIES)
+    param_names = ['size', 'density']
+    timeout = 600
+
+    def setup(self, size, density):
+        self.mc = utils.match(*field(size, density), verbose=False)
+
+    def time_photometer(self, size, density):
+        self.mc.photometer(Ellipse, Annulus)
+
+    def peakmem_photometer(self, size, density):
+        self.mc.photometer(Ellipse, Annulus)
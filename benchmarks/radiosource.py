@@ -0,0 +1,72 @@
+"""
+Benchmarks for source detection and aperture measurements on one image.
+"""
+from dendrocat.radiosource import RadioSource
+from dendrocat.aperture import Ellipse, Annulus
+
+from .synthetic import make_image
+
+# Image width in pixels, and number of sources per million pixels
+SIZES = [512, 1024, 2048]
+DENSITIES = [50, 200]
+
+
+class Dendrogram:
+    params = (SIZES, DENSITIES)
+    param_names = ['size', 'density']
+    timeout = 600
+
+    def setup(self, size, density):
+        self.rs = RadioSource(make_image(size, density))
+
+    def time_to_dendrogram(self, size, density):
+        self.rs.to_dendrogram(save=False)
+
+    def peakmem_to_dendrogram(self, size, density):
+        self.rs.to_dendrogram(save=False)
+
+
+class Catalog:
+    params = (SIZES, DENSITIES)
+    param_names = ['size', 'density']
+    timeout = 600
+
+    def setup(self, size, density):
+        self.rs = RadioSource(make_image(size, density))
+        self.rs.to_dendrogram()
+
+    def time_to_catalog(self, size, density):
+        self.rs.to_catalog()
+
+    def track_sources(self, size, density):
+        return len(self.rs.to_catalog())
+
+
+class Apertures:
+    params = (SIZES, DENSITIES)
+    param_names = ['size', 'density']
+    timeout = 600
+
+    def setup(self, size, density):
+        self.rs = RadioSource(make_image(size, density))
+        self.rs.to_catalog()
+        self.cutouts, self.cutout_data = self.rs._make_cutouts(save=False)
+
+    def time_make_cutouts(self, size, density):
+        self.rs._make_cutouts(save=False)
+
+    def time_get_pixels_ellipse(self, size, density):
+        self.rs.get_pixels(Ellipse, cutouts=self.cutouts, save=False)
+
+    def time_get_pixels_annulus(self, size, density):
+        self.rs.get_pixels(Annulus, cutouts=self.cutouts, save=False)
+
+    def time_get_snr(self, size, density):
+        self.rs.get_snr(cutouts=self.cutouts, cutout_data=self.cutout_data,
+                        save=False)
+
+    def time_autoreject(self, size, density):
+        self.rs.autoreject()
+
+    def peakmem_autoreject(self, size, density):
+        self.rs.autoreject()
@@ -0,0 +1,137 @@
+"""
+Synthetic ALMA-like radio images for the benchmarks.
+
+Images have a four-axis header (RA, DEC, FREQ, STOKES) with a beam, Jy/beam
+data, Gaussian noise, and Gaussian sources injected at positions that are the
+same at every frequency, so that images of one field in several bands can be
+matched. They can also be written to disk to size hardware for a survey::
+
+    python -m benchmarks.synthetic field_226GHz.fits --size 4096 --density 200
+"""
+import argparse
+import numpy as np
+import astropy.units as u
+from astropy.io import fits
+
+PIXEL_SCALE = 1e-5*u.deg
+
+# Beam FWHM in pixels at 226.1 GHz. Beams at other frequencies scale as 1/nu.
+BEAM_PIX = 4.
+
+NOISE = 1e-4
+
+
+def source_field(size, density, seed=0):
+    """
+    Draw the sources of a field.
+
+    Parameters
+    ----------
+    size : int
+        Width and height of the image in pixels.
+    density : float
+        Number of sources per million pixels.
+    seed : int, optional
+        Random seed for the field, shared by all bands.
+
+    Returns
+    -------
+    x, y, width, flux, alpha : `~numpy.ndarray`
+        Pixel positions, intrinsic Gaussian FWHM in pixels, flux at
+        226.1 GHz in Jy, and spectral index of each source.
+    """
+    rng = np.random.default_rng(seed)
+    nsrc = max(int(round(density*size**2/1e6)), 1)
+    margin = min(30, size//4)
+    x, y = rng.uniform(margin, size-margin, (2, nsrc))
+    width = rng.uniform(0., 2*BEAM_PIX, nsrc)
+    flux = NOISE*10**rng.uniform(np.log10(5), 3, nsrc)
+    alpha = rng.uniform(-1., 3., nsrc)
+    return x, y, width, flux, alpha
+
+
+def make_image(size=1024, density=50, freq=226.1*u.GHz, noise=NOISE,
+               seed=0, field_seed=0):
+    """
+    Make a synthetic image of a field.
+
+    Parameters
+    ----------
+    size : int, optional
+        Width and height of the image in pixels. Default is 1024.
+    density : float, optional
+        Number of sources per million pixels. Default is 50.
+    freq : `~astropy.units.Quantity`, optional
+        Observing frequency. Default is 226.1 GHz.
+    noise : float, optional
+        Standard deviation of the noise, in Jy/beam. Default is 1e-4.
+    seed : int, optional
+        Random seed for the noise.
+    field_seed : int, optional
+        Random seed for the sources. Images with the same `field_seed` show
+        the same field.
+
+    Returns
+    -------
+    `~astropy.io.fits.HDUList`
+    """
+    freq = freq.to(u.GHz)
+    beam = BEAM_PIX*(226.1*u.GHz/freq).value
+    data = np.random.default_rng(seed).normal(0., noise, (size, size))
+
+    for x, y, width, flux, alpha in zip(*source_field(size, density,
+                                                      field_seed)):
+        fwhm = np.hypot(beam, width)
+        sigma = fwhm/np.sqrt(8*np.log(2))
+        # Extended sources spread the same flux over more beams
+        amplitude = flux*(freq.value/226.1)**alpha*(beam/fwhm)**2
+        r = int(np.ceil(5*sigma))
+        x0, y0 = int(x), int(y)
+        yy, xx = np.mgrid[max(y0-r, 0):min(y0+r+1, size),
+                          max(x0-r, 0):min(x0+r+1, size)]
+        data[yy, xx] += amplitude*np.exp(-((xx-x)**2+(yy-y)**2)
+                                         / (2*sigma**2))
+
+    header = fits.Header()
+    header['NAXIS'] = 4
+    for i, (ctype, crval, cdelt, crpix, cunit) in enumerate([
+            ('RA---SIN', 290.9, -PIXEL_SCALE.value, size/2, 'deg'),
+            ('DEC--SIN', 14.5, PIXEL_SCALE.value, size/2, 'deg'),
+            ('FREQ', freq.to(u.Hz).value, 1.875e9, 1., 'Hz'),
+            ('STOKES', 1., 1., 1., '')]):
+        header['CTYPE{}'.format(i+1)] = ctype
+        header['CRVAL{}'.format(i+1)] = crval
+        header['CDELT{}'.format(i+1)] = cdelt
+        header['CRPIX{}'.format(i+1)] = crpix
+        header['CUNIT{}'.format(i+1)] = cunit
+    header['BMAJ'] = beam*PIXEL_SCALE.value
+    header['BMIN'] = beam*PIXEL_SCALE.value
+    header['BPA'] = 0.
+    header['BUNIT'] = 'Jy/beam'
+    header['TELESCOP'] = 'ALMA'
+    header['RADESYS'] = 'ICRS'
+    header['EQUINOX'] = 2000.
+    header['RESTFRQ'] = freq.to(u.Hz).value
+
+    return fits.HDUList([fits.PrimaryHDU(data=data[None, None].astype('>f4'),
+                                         header=header)])
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Write a synthetic ALMA-like'
+                                                 ' image to a FITS file.')
+    parser.add_argument('outfile')
+    parser.add_argument('--size', type=int, default=1024)
+    parser.add_argument('--density', type=float, default=50)
+    parser.add_argument('--freq', type=float, default=226.1,
+                        help='Frequency in GHz.')
+    parser.add_argument('--noise', type=float, default=NOISE)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(args)
+
+    make_image(args.size, args.density, args.freq*u.GHz, noise=args.noise,
+               seed=args.seed).writeto(args.outfile, overwrite=True)
+
+
+if __name__ == '__main__':
+    main()
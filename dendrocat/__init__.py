@@ -18,9 +18,45 @@ class UnsupportedPythonError(Exception):
 if sys.version_info < tuple((int(val) for val in __minimum_python_version__.split('.'))):
     raise UnsupportedPythonError("dendrocat does not support Python < {}".format(__minimum_python_version__))
 
-if not _ASTROPY_SETUP_:
-    # For egg_info test builds to pass, put package imports here.
+# Public names, and the submodules that define them. These are imported on
+# first use, so that `import dendrocat` stays cheap for short-lived worker
+# processes.
+_LAZY_NAMES = {
+    'MasterCatalog': 'mastercatalog',
+    'RadioSource': 'radiosource',
+    'ucheck': 'utils',
+    'MeasurementStore': 'store',
+}
+_SUBMODULES = ['aperture', 'export', 'mastercatalog', 'profiling',
+               'radiosource', 'store', 'utils']
+
+__all__ = list(_LAZY_NAMES)
+
+
+def __getattr__(name):
+    import importlib
+
+    if name in _LAZY_NAMES:
+        module = importlib.import_module('.' + _LAZY_NAMES[name], __name__)
+        value = getattr(module, name)
+    elif name in _SUBMODULES:
+        value = importlib.import_module('.' + name, __name__)
+    else:
+        raise AttributeError("module {!r} has no attribute {!r}"
+                             .format(__name__, name))
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_LAZY_NAMES) | set(_SUBMODULES))
+
+
+if not _ASTROPY_SETUP_ and sys.version_info < (3, 7):
+    # For egg_info test builds to pass, put package imports here. Module
+    # level __getattr__ needs Python 3.7, so older versions import eagerly.
     from .mastercatalog import MasterCatalog
     from .radiosource import RadioSource
     from .utils import ucheck
+    from .store import MeasurementStore
 
@@ -1,11 +1,10 @@
-import regions
 import astropy.units as u
 from astropy.coordinates import SkyCoord
 import astropy.wcs
 import numpy as np
 import warnings
 
-from .utils import ucheck
+from .utils import ucheck, _is_pixcoord
 
 class NoUnitError(Exception):
     pass
@@ -75,7 +74,7 @@ class Aperture():
             self.x_cen = ucheck(self.center.spherical.lon, self.unit)
             self.y_cen = ucheck(self.center.spherical.lat, self.unit)
 
-        elif type(self.center) == regions.PixCoord:
+        elif _is_pixcoord(self.center):
             self.x_cen = ucheck(self.center.x, self.unit)
             self.y_cen = ucheck(self.center.y, self.unit)
 
@@ -101,6 +100,8 @@ class Aperture():
         numpy.ndarray
             A boolean mask for the aperture with the same dimensions as `image`
         """
+        import regions
+
         if wcs is not None and self.frame != astropy.wcs.utils.wcs_to_celestial_frame(wcs).name:
             raise ValueError("Frame mismatch in aperture placement")
         self._refresh_xycen()
@@ -0,0 +1,401 @@
+import io
+import os
+import itertools
+import numpy as np
+from astropy.table import Table, MaskedColumn, vstack
+
+if __package__ == '':
+    __package__ = 'dendrocat'
+
+# Size of the blocks a FITS file is padded to, in bytes
+FITS_BLOCK_SIZE = 2880
+
+# Native astropy writers for each catalog file extension
+CATALOG_FORMATS = {'.ecsv': 'ascii.ecsv',
+                   '.fits': 'fits',
+                   '.fit': 'fits',
+                   '.parquet': 'parquet'}
+
+
+class UnknownFormatError(Exception):
+    pass
+
+
+def _as_table(catalog):
+    """
+    Return the catalog of a `~dendrocat.RadioSource` or
+    `~dendrocat.MasterCatalog`, or the table itself.
+    """
+    return getattr(catalog, 'catalog', catalog)
+
+
+def _iter_tables(catalog, chunk_size):
+    """
+    Yield a catalog in slices of at most `chunk_size` rows. An iterable of
+    tables, like that returned by `~dendrocat.utils.iter_table_chunks`, is
+    passed through as is.
+    """
+    catalog = _as_table(catalog)
+    if isinstance(catalog, Table):
+        for start in range(0, max(len(catalog), 1), chunk_size):
+            yield catalog[start:start+chunk_size]
+    else:
+        for table in catalog:
+            yield _as_table(table)
+
+
+def _accepted(table, skip_rejects):
+    """
+    Drop rejected sources from a table, if it records them.
+    """
+    if skip_rejects and 'rejected' in table.colnames:
+        return table[np.asarray(table['rejected']) == 0]
+    return table
+
+
+REGION_HEADERS = {'ds9': '# Region file format: DS9\nicrs\n',
+                  'crtf': '#CRTFv0\nglobal coord=ICRS\n'}
+
+# Region file line for each source, filled with the center, the semi-major
+# and semi-minor axes, and the position angle (all in degrees) and the name
+REGION_TEMPLATES = {
+    'ds9': 'ellipse({0}, {0}, {0}, {0}, {0}) # text={{%s}}',
+    # CRTF lists the axis along north at zero position angle first
+    'crtf': "ellipse[[{0}deg, {0}deg], [{0}deg, {0}deg], {0}deg], label='%s'",
+}
+
+
+def region_lines(table, format='ds9', precision=8):
+    """
+    Format every source in a catalog as a region file line.
+
+    Each column is converted once, rather than reading the catalog one row at
+    a time.
+
+    Parameters
+    ----------
+    table : `~astropy.table.Table`
+        A source catalog with sky positions and ellipse dimensions in degrees.
+    format : {'ds9', 'crtf'}, optional
+        Region file format. Default is 'ds9'.
+    precision : int, optional
+        Number of decimals written for positions and dimensions, in degrees.
+        Default is 8.
+
+    Returns
+    -------
+    list of str
+        One line per source.
+    """
+    try:
+        template = REGION_TEMPLATES[format]
+    except KeyError:
+        raise UnknownFormatError("Unknown region format '{}'. Use 'ds9' or "
+                                 "'crtf'.".format(format))
+    template = template.format('%.{}f'.format(precision))
+
+    x = np.asarray(table['x_cen'], float)
+    y = np.asarray(table['y_cen'], float)
+    major = np.asarray(table['major_fwhm'], float)/2.
+    minor = np.asarray(table['minor_fwhm'], float)/2.
+    pa = np.asarray(table['position_angle'], float)
+    name = np.asarray(table['_name']).astype(str)
+
+    if format == 'crtf':
+        major, minor = minor, major
+
+    columns = zip(x.tolist(), y.tolist(), major.tolist(), minor.tolist(),
+                  pa.tolist(), name.tolist())
+    return [template % values for values in columns]
+
+
+def write_regions(catalog, outfile, format=None, skip_rejects=True,
+                  precision=8, chunk_size=100000):
+    """
+    Save the source ellipses of a catalog as a DS9 or CASA (CRTF) region file.
+
+    Lines are formatted for a whole chunk of sources at a time, and each
+    chunk is written before the next one is formatted, so large catalogs can
+    be streamed to disk.
+
+    Parameters
+    ----------
+    catalog : `~astropy.table.Table`, RadioSource, MasterCatalog, or iterable
+        The catalog or catalog-containing object from which to extract source
+        coordinates and ellipse properties. An iterable of tables (see
+        `~dendrocat.utils.iter_table_chunks`) is written one table at a time.
+    outfile : str
+        Path to save the region file.
+    format : {'ds9', 'crtf'}, optional
+        Region file format. By default, 'crtf' is used for files ending in
+        '.crtf', and 'ds9' otherwise.
+    skip_rejects : bool, optional
+        If enabled, rejected sources will not be saved. Default is True.
+    precision : int, optional
+        Number of decimals written for positions and dimensions, in degrees.
+        Default is 8.
+    chunk_size : int, optional
+        Number of sources formatted at once. Default is 100000.
+
+    Returns
+    -------
+    int
+        The number of sources written.
+    """
+    if format is None:
+        format = 'crtf' if outfile.lower().endswith('.crtf') else 'ds9'
+    if format not in REGION_TEMPLATES:
+        raise UnknownFormatError("Unknown region format '{}'. Use 'ds9' or "
+                                 "'crtf'.".format(format))
+    header = REGION_HEADERS[format]
+
+    nrows = 0
+    with open(outfile, 'w') as fh:
+        fh.write(header)
+        for table in _iter_tables(catalog, chunk_size):
+            table = _accepted(table, skip_rejects)
+            if len(table) == 0:
+                continue
+            fh.write('\n'.join(region_lines(table, format=format,
+                                            precision=precision)))
+            fh.write('\n')
+            nrows += len(table)
+
+    return nrows
+
+
+def _write_ecsv_chunks(tables, outfile):
+    """
+    Write tables with the same columns to one ECSV file, one at a time.
+    Each table is formatted by astropy, and only the first one's header is
+    kept.
+    """
+    header = None
+    nrows = 0
+    with open(outfile, 'w') as fh:
+        for table in tables:
+            buf = io.StringIO()
+            table.write(buf, format='ascii.ecsv')
+            lines = buf.getvalue().splitlines(True)
+            # The header is followed by a line of column names
+            start = next(i for i, line in enumerate(lines)
+                         if not line.startswith('#')) + 1
+            if header is None:
+                header = lines[:start]
+                fh.writelines(header)
+            elif lines[:start] != header:
+                raise ValueError('All tables must have the same columns to '
+                                 'be written to one ECSV file')
+            fh.writelines(lines[start:])
+            nrows += len(table)
+    return nrows
+
+
+def _write_fits_chunks(tables, outfile):
+    """
+    Write tables with the same columns to one FITS binary table, one at a
+    time. The rows of each table are converted by astropy and appended to
+    the file, and the row count in the header is set once all are written.
+    """
+    from astropy.io import fits
+
+    header = None
+    nrows = 0
+    with open(outfile, 'wb') as fh:
+        fh.write(fits.PrimaryHDU().header.tostring().encode('ascii'))
+        for table in tables:
+            if header is not None:
+                table = _match_string_widths(table, dtypes)
+            hdu = fits.table_to_hdu(table)
+            if hdu.header.get('PCOUNT', 0) > 0:
+                raise ValueError('Variable length columns cannot be written '
+                                 'one table at a time')
+            columns = (hdu.columns.names, hdu.columns.formats,
+                       hdu.columns.nulls)
+            if header is None:
+                header = hdu.header
+                dtypes = {name: table[name].dtype for name in table.colnames}
+                first_columns = columns
+                header_start = fh.tell()
+                fh.write(header.tostring().encode('ascii'))
+            elif columns != first_columns:
+                raise ValueError('All tables must have the same columns to '
+                                 'be written to one FITS table')
+
+            # The rows are the data block of the HDU, before its padding
+            buf = io.BytesIO()
+            hdu.writeto(buf)
+            size = hdu.header['NAXIS1']*hdu.header['NAXIS2']
+            padded = -(-size//FITS_BLOCK_SIZE)*FITS_BLOCK_SIZE
+            raw = buf.getvalue()
+            fh.write(raw[len(raw) - padded:len(raw) - padded + size])
+            nrows += len(table)
+
+        fh.write(b'\0'*(-fh.tell() % FITS_BLOCK_SIZE))
+        header['NAXIS2'] = nrows
+        fh.seek(header_start)
+        fh.write(header.tostring().encode('ascii'))
+    return nrows
+
+
+def _match_string_widths(table, dtypes):
+    """
+    Widen the string columns of a table to the given dtypes, so that its rows
+    have the same layout as those of the first table written.
+    """
+    for name in table.colnames:
+        dtype = dtypes.get(name)
+        if (dtype is not None and table[name].dtype.kind in 'US'
+                and table[name].dtype != dtype):
+            if table[name].dtype.itemsize > dtype.itemsize:
+                raise ValueError("Strings in column '{}' are longer than in "
+                                 "the first table written".format(name))
+            table[name] = table[name].astype(dtype)
+    return table
+
+
+def _encode_parquet(table):
+    """
+    Split a table into the plain columns astropy stores in Parquet files.
+    """
+    from astropy.table import serialize
+    from astropy.utils.data_info import serialize_context_as
+
+    with serialize_context_as('parquet'):
+        return serialize.represent_mixins_as_columns(table)
+
+
+def _write_parquet_chunks(tables, outfile):
+    """
+    Write tables with the same columns to one Parquet file, one at a time,
+    as row groups. The columns are encoded as astropy's Parquet writer does,
+    with the schema and metadata of the first table.
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    from astropy.table import meta
+
+    writer = None
+    nrows = 0
+    try:
+        for table in tables:
+            if writer is None:
+                if len(table) == 0:
+                    continue
+                # Mask columns are only written for columns with masked
+                # values, so take the schema from a row with all of them
+                template = table[:1].copy()
+                for column in template.itercols():
+                    if isinstance(column, MaskedColumn):
+                        column.mask = True
+                encoded = _encode_parquet(template)
+                metadata = {'table_meta_yaml':
+                            '\n'.join(meta.get_yaml_from_table(encoded))}
+                for name, column in encoded.columns.items():
+                    if column.dtype.type is np.str_:
+                        metadata['table::len::'+name] = str(
+                            column.dtype.itemsize//4)
+                    elif column.dtype.type is np.bytes_:
+                        metadata['table::len::'+name] = str(
+                            column.dtype.itemsize)
+                schema = pa.schema(
+                    [(name, pa.from_numpy_dtype(encoded.dtype[name].type))
+                     for name in encoded.colnames],
+                    metadata={k.encode('utf-8'): v.encode('utf-8')
+                              for k, v in metadata.items()})
+                dtypes = {name: table[name].dtype for name in table.colnames}
+                writer = pq.ParquetWriter(outfile, schema)
+            else:
+                table = _match_string_widths(table, dtypes)
+
+            encoded = _encode_parquet(table)
+            if any(name not in schema.names for name in encoded.colnames):
+                raise ValueError('All tables must have the same columns to '
+                                 'be written to one Parquet file')
+            arrays = []
+            for name in schema.names:
+                if name in encoded.colnames:
+                    arrays.append(pa.array(encoded[name]))
+                else:  # A mask column of a table without masked values
+                    arrays.append(pa.array(np.zeros(len(table), dtype=bool)))
+            writer.write_table(pa.Table.from_arrays(arrays, schema=schema))
+            nrows += len(table)
+    finally:
+        if writer is not None:
+            writer.close()
+
+    if writer is None:
+        # Every table was empty
+        table.write(outfile, format='parquet', overwrite=True)
+    return nrows
+
+
+# Writers that stream an iterable of tables to one file, for each format
+CHUNK_WRITERS = {'ascii.ecsv': _write_ecsv_chunks,
+                 'fits': _write_fits_chunks,
+                 'parquet': _write_parquet_chunks}
+
+
+def write_catalog(catalog, outfile, format=None, skip_rejects=False,
+                  overwrite=False):
+    """
+    Save a catalog with astropy's native table writers.
+
+    An iterable of tables, like that returned by
+    `~dendrocat.utils.iter_table_chunks`, is written one table at a time to
+    ECSV, FITS and Parquet files, so catalogs larger than memory can be
+    converted. The tables must have the same columns. Tables written to
+    other formats are stacked in memory first.
+
+    Parameters
+    ----------
+    catalog : `~astropy.table.Table`, RadioSource, MasterCatalog, or iterable
+        The catalog or catalog-containing object to save, or an iterable of
+        tables.
+    outfile : str
+        Path to save the catalog.
+    format : str, optional
+        Any format known to `~astropy.table.Table.write`. By default, it is
+        chosen from the file extension: ECSV ('.ecsv'), FITS binary table
+        ('.fits', '.fit') or Parquet ('.parquet', which requires pyarrow).
+    skip_rejects : bool, optional
+        If enabled, rejected sources will not be saved. Default is False.
+    overwrite : bool, optional
+        If enabled, an existing file is replaced. Default is False.
+
+    Returns
+    -------
+    int
+        The number of sources written.
+    """
+    if format is None:
+        ext = os.path.splitext(outfile)[1].lower()
+        try:
+            format = CATALOG_FORMATS[ext]
+        except KeyError:
+            raise UnknownFormatError("Cannot infer the catalog format from "
+                                     "'{}'. Use the keyword argument "
+                                     "`format=`.".format(outfile))
+
+    table = _as_table(catalog)
+    if isinstance(table, Table):
+        table = _accepted(table, skip_rejects)
+        table.write(outfile, format=format, overwrite=overwrite)
+        return len(table)
+
+    tables = (_accepted(_as_table(t), skip_rejects) for t in table)
+    first = next(tables, None)
+    if first is None:
+        raise ValueError('No tables to write')
+    tables = itertools.chain([first], tables)
+
+    writer = CHUNK_WRITERS.get(format)
+    if writer is None:
+        table = vstack(list(tables))
+        table.write(outfile, format=format, overwrite=overwrite)
+        return len(table)
+
+    if os.path.exists(outfile) and not overwrite:
+        raise OSError("File '{}' already exists. Use overwrite=True to "
+                      "replace it.".format(outfile))
+    return writer(tables, outfile)
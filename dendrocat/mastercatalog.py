@@ -2,18 +2,127 @@ from astropy.table import MaskedColumn, vstack, hstack, Table
 from collections import OrderedDict
 import numpy as np
 import astropy.units as u
-from copy import deepcopy
 from astropy.coordinates import SkyCoord, Angle
+import warnings
+import multiprocessing
+import os
 
 if __package__ == '':
     __package__ = 'dendrocat'
-from .utils import rms, specindex, ucheck
+from .utils import rms, specindex, ucheck, iter_table_chunks, save_pages
+from .utils import get_index_masked
+from .utils import _unit_vectors, _chord
 from .radiosource import RadioSource
-from .aperture import Aperture
+from .aperture import Aperture, Ellipse, Annulus
 
 class ApertureError(Exception):
     pass
 
+def _init_photometer_worker(catalog, rs_objects, apertures):
+    """
+    Keep the catalog, `~dendrocat.RadioSource` objects, and apertures in
+    each worker process, so they are sent once per worker rather than once
+    per job.
+    """
+    global _worker_catalog, _worker_rs_objects, _worker_apertures
+    _worker_catalog = catalog
+    _worker_rs_objects = rs_objects
+    _worker_apertures = apertures
+
+
+def _photometer_job(i):
+    """
+    Measure all apertures on one `~dendrocat.RadioSource` in a worker
+    process.
+
+    Parameters
+    ----------
+    i : int
+        The index of the `~dendrocat.RadioSource`.
+
+    Returns
+    -------
+    dict
+        The photometry statistics of each aperture, keyed by aperture name.
+    """
+    rs_obj = _worker_rs_objects[i]
+    size = rs_obj._cutout_size(*_worker_apertures, catalog=_worker_catalog)
+    record = rs_obj.measure(*_worker_apertures, catalog=_worker_catalog,
+                            cutout_size=size, snr=False, save=False)
+    return record['stats']
+
+
+def _render_seds(args):
+    """
+    Render the SEDs of a batch of sources with the Agg backend, reusing one
+    figure for the whole batch.
+
+    Parameters
+    ----------
+    args : tuple
+        The band frequencies (GHz), and the fluxes, uncertainties, upper
+        limit flags, names, and fitted spectral indices and normalizations of
+        each source, followed by the reference spectral indices, log scale
+        flag, axis label, figure size, dpi, and output files (None to return
+        the pages instead).
+
+    Returns
+    -------
+    list of `~numpy.ndarray`
+        The rendered RGBA pages, if no output files were given.
+    """
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+    (nu, flux, err, upper, names, alpha, norm, alphas, log, ylabel, figsize,
+     dpi, outfiles) = args
+
+    fig = Figure(figsize=figsize, dpi=dpi)
+    canvas = FigureCanvasAgg(fig)
+    ax = fig.add_subplot(111)
+    fig.subplots_adjust(left=0.15, bottom=0.12)
+    x = np.geomspace(0.8*nu.min(), 1.2*nu.max(), 50)
+
+    pages = []
+    for i in range(len(names)):
+        ax.clear()
+        detected = np.isfinite(flux[i]) & ~upper[i]
+        ax.errorbar(nu[detected], flux[i][detected], yerr=err[i][detected],
+                    fmt='o', ms=3, elinewidth=0.75, color='k', zorder=3,
+                    label='Flux')
+        if upper[i].any():
+            ax.plot(nu[upper[i]], flux[i][upper[i]], 'v', color='k',
+                    zorder=3, label='Upper limit')
+
+        if np.isfinite(alpha[i]):
+            ax.plot(x, 10**norm[i]*x**alpha[i], color='C3', zorder=2,
+                    label=r'Fit $\alpha$ = {:.2f}'.format(alpha[i]))
+
+        # Reference spectral indices through the brightest detection
+        if detected.any():
+            k = np.nanargmax(np.where(detected, flux[i], np.nan))
+            for j, a in enumerate(alphas):
+                ax.plot(x, flux[i][k]*(x/nu[k])**a, '--', lw=0.75,
+                        color='C{}'.format(j), zorder=1,
+                        label=r'$\alpha$ = {}'.format(a))
+
+        if log:
+            ax.set_xscale('log')
+            ax.set_yscale('log')
+        ax.set_xlabel('Frequency (GHz)')
+        ax.set_ylabel(ylabel)
+        ax.set_title('Spectral Energy Distribution for {}'.format(names[i]))
+        ax.legend(fontsize=7)
+
+        if outfiles is not None:
+            fig.savefig(outfiles[i], dpi=dpi)
+        else:
+            canvas.draw()
+            pages.append(np.asarray(canvas.buffer_rgba()).copy())
+
+    return pages
+
+
 class MasterCatalog:
     """
     An object to store combined data from two or more RadioSource objects.
@@ -28,7 +137,9 @@ class MasterCatalog:
         catalog : astropy.table.Table object
             The master table from which to build the catalog object.
         *args : radiosource.RadioSource objects
-            RadioSource objects from which the master table was built.
+            RadioSource objects from which the master table was built. They
+            are kept in the ``radiosources`` registry, keyed by freq_id, and
+            as attributes named after each object.
         """
         if catalog is not None:
             self.catalog = catalog
@@ -79,16 +190,68 @@ class MasterCatalog:
         """
         if not hasattr(self, 'other_catalogs'):
             self.other_catalogs = []
+        if 'radiosources' not in self.__dict__:
+            self.radiosources = OrderedDict()
 
         for obj in args:
             if isinstance(obj, MasterCatalog):
-                for key, value in obj.__dict__.items():
-                    if isinstance(value, RadioSource):
-                        self.__dict__[key] = value
+                if hasattr(obj, 'radiosources'):
+                    rs_objects = obj.radiosources.values()
+                else:
+                    rs_objects = [v for v in obj.__dict__.values()
+                                  if isinstance(v, RadioSource)]
+                for rs_obj in rs_objects:
+                    self._register(rs_obj)
             else:
-                objname = [k for k, v in locals().items() if v is obj][0]
                 self.other_catalogs.append(obj)
-                setattr(self, objname, obj)
+                if isinstance(obj, RadioSource):
+                    self._register(obj)
+
+
+    def __setattr__(self, name, value):
+        if isinstance(value, RadioSource):
+            self._register(value, name=name)
+        else:
+            super().__setattr__(name, value)
+
+
+    def _register(self, rs_obj, name=None):
+        """
+        Add a `~dendrocat.RadioSource` object to the registry, keyed by its
+        frequency identifier, and as an attribute named after the object.
+        """
+        if 'radiosources' not in self.__dict__:
+            self.radiosources = OrderedDict()
+        if name is None:
+            name = rs_obj.__name__
+
+        current = self.radiosources.get(rs_obj.freq_id)
+        if current is not None and current is not rs_obj:
+            warnings.warn('Replacing RadioSource {} with {}, which has the '
+                          'same freq_id ({})'.format(current.__name__,
+                                                      rs_obj.__name__,
+                                                      rs_obj.freq_id))
+        self.radiosources[rs_obj.freq_id] = rs_obj
+        if name is not None:
+            self.__dict__[name] = rs_obj
+
+
+    def get_radiosource(self, key):
+        """
+        Look up a registered `~dendrocat.RadioSource` object.
+
+        Parameters
+        ----------
+        key : str or `~dendrocat.RadioSource` object
+            The frequency identifier of the object, or the object itself.
+        """
+        if isinstance(key, RadioSource):
+            return key
+        try:
+            return self.radiosources[key]
+        except KeyError:
+            raise KeyError('No RadioSource with freq_id {}. Registered: '
+                           '{}'.format(key, list(self.radiosources)))
 
 
     def add_sources(self, *args):
@@ -105,112 +268,675 @@ class MasterCatalog:
             self.catalog['_index'] = range(len(self.catalog))
 
 
-    def photometer(self, *args, catalog=None):
+    def photometer(self, *args, catalog=None, nprocs=1):
         """
         Add photometry data columns to the master catalog.
 
+        If a `~dendrocat.RadioSource` has a background map (see
+        `~dendrocat.RadioSource.to_noise_map`), the map's rms and median at
+        each source are also added, as ``<freq_id>_noisemap_rms`` and
+        ``<freq_id>_noisemap_median``.
+
         Parameters
         ----------
         args : `~dendrocat.Aperture` objects
             The apertures to use for photometry. Can be given as either
             instances or objects, to use fixed or variable aperture widths,
-            respectively.
+            respectively. Columns are named after each aperture, so if
+            several apertures have the same name, only the last is used.
 
         catalog : astropy.table.Table object
             The catalog from which to extract source coordinates and ellipse
             parameters.
+
+        nprocs : int, optional
+            Number of processes to measure with. Each
+            `~dendrocat.RadioSource` is measured separately, with the image
+            data memory-mapped (see `~dendrocat.RadioSource.memmap_data`) so
+            that it is not copied to the workers. Default is 1.
         """
 
+        if catalog is None:
+            catalog = self.catalog
+
+        args = tuple(OrderedDict((aperture.__name__, aperture)
+                                 for aperture in args).values())
+        if not args:
+            return
+        rs_objects = list(self.radiosources.values())
+
+        # Each image is cut out once, at the size of the largest aperture,
+        # and every aperture is measured on the same cutouts
+        if nprocs > 1 and len(rs_objects) > 1:
+            workers = []
+            tempfiles = []
+            for rs_obj in rs_objects:
+                worker = rs_obj._worker_copy()
+                if not isinstance(worker.data, np.memmap):
+                    tempfiles.append(worker.memmap_data())
+                workers.append(worker)
+            try:
+                with multiprocessing.Pool(
+                        min(nprocs, len(rs_objects)),
+                        initializer=_init_photometer_worker,
+                        initargs=(catalog, workers, args)) as pool:
+                    results = pool.map(_photometer_job,
+                                       range(len(rs_objects)))
+            finally:
+                for path in tempfiles:
+                    os.remove(path)
+        else:
+            results = []
+            for rs_obj in rs_objects:
+                size = rs_obj._cutout_size(*args, catalog=catalog)
+                record = rs_obj.measure(*args, catalog=catalog,
+                                        cutout_size=size, snr=False,
+                                        save=False)
+                results.append(record['stats'])
+
+        new_cols = []
         for aperture in args:
-            if catalog is None:
-                catalog = self.catalog
+            for rs_obj, stats in zip(rs_objects, results):
+                for stat in ['peak', 'sum', 'rms', 'median', 'npix']:
+                    name = '{}_{}_{}'.format(rs_obj.freq_id,
+                                             aperture.__name__, stat)
+                    data = np.asarray(stats[aperture.__name__][stat],
+                                      dtype=float)
+                    new_cols.append(MaskedColumn(data=data, name=name,
+                                                 mask=np.isnan(data)))
+
+        self.catalog.remove_columns([col.name for col in new_cols
+                                     if col.name in self.catalog.colnames])
+        self.catalog.add_columns(new_cols)
+
+        for rs_obj in rs_objects:
+            if hasattr(rs_obj, 'noise_map'):
+                noise, median = rs_obj.noise_at(catalog)
+                self.catalog[rs_obj.freq_id+'_noisemap_rms'] = MaskedColumn(
+                                            data=noise, mask=np.isnan(noise))
+                self.catalog[rs_obj.freq_id+'_noisemap_median'] = MaskedColumn(
+                                            data=median, mask=np.isnan(median))
+
+
+    def match_external(self, ext, ra='ra', dec='dec', freq='freq',
+                       flux_sum='flux', flux_peak=None, err=None,
+                       shape=Ellipse, tolerance=0.1*u.arcsec,
+                       skip_rejects=True, chunk_size=100000, format=None):
+        """
+        Add photometry from an external catalog to the master catalog.
+
+        Each external source is matched to the nearest source in the master
+        catalog within ``tolerance``. If several external sources at one
+        frequency match the same source, the closest is used. The external
+        fluxes are added as ``<freq_id>_<shape>_sum``,
+        ``<freq_id>_<shape>_peak``, and ``<freq_id>_<shape>_rms`` columns,
+        where the frequency identifier is formatted as for a
+        `~dendrocat.RadioSource`, so that they can be used alongside
+        photometry from `~dendrocat.MasterCatalog.photometer`. The
+        frequencies of the added columns are kept in ``external_freqs``.
 
-            rs_objects = []
-            for i, obj in enumerate(self.__dict__.values()):
-                if isinstance(obj, RadioSource):
-                    rs_objects.append(obj)
-
-            for i, rs_obj in enumerate(rs_objects):
-
-                data = rs_obj.data
-                cutouts, cutout_data = rs_obj._make_cutouts(catalog=catalog,
-                                                            save=False)
-
-                pix_in_aperture = rs_obj.get_pixels(
-                                                    aperture,
-                                                    catalog=catalog,
-                                                    data=data,
-                                                    cutouts=cutouts,
-                                                    )[0]
-
-                names = [
-                    rs_obj.freq_id+'_'+aperture.__name__+'_peak',
-                    rs_obj.freq_id+'_'+aperture.__name__+'_sum',
-                    rs_obj.freq_id+'_'+aperture.__name__+'_rms',
-                    rs_obj.freq_id+'_'+aperture.__name__+'_median',
-                    rs_obj.freq_id+'_'+aperture.__name__+'_npix'
-                ]
-
-                peak_data = np.zeros(len(pix_in_aperture))
-                for j in range(len(pix_in_aperture)):
-                    try:
-                        peak_data[j] = np.max(pix_in_aperture[j])
-                    except ValueError:
-                        peak_data[j] = float('nan')
-                aperture_peak_col = MaskedColumn(data=peak_data,
-                                                 name=names[0])
-
-                sum_data = np.zeros(len(pix_in_aperture))
-                for j in range(len(pix_in_aperture)):
-                    ind = [pix_in_aperture[j] > 0.]
-                    try:
-                        sum_data[j] = np.sum(pix_in_aperture[j][ind])/rs_obj.ppbeam
-                    except TypeError: # Catches single pixel apertures
-                        sum_data[j] = float('nan')
-                aperture_sum_col = MaskedColumn(data=sum_data,
-                                                name=names[1])
-
-                rms_data = np.zeros(len(pix_in_aperture))
-                for j in range(len(pix_in_aperture)):
-                    rms_data[j] = rms(pix_in_aperture[j])
-                aperture_rms_col = MaskedColumn(data=rms_data,
-                                                name=names[2])
-
-                median_data = np.zeros(len(pix_in_aperture))
-                for j in range(len(pix_in_aperture)):
-                    median_data[j] = np.median(pix_in_aperture[j])
-                aperture_median_col = MaskedColumn(data=median_data,
-                                                   name=names[3])
-
-                npix_data = np.zeros(len(pix_in_aperture))
-                for j in range(len(pix_in_aperture)):
-                    if np.isnan(pix_in_aperture[j]).any():
-                        npix_data[j] = float('nan')
-                    else:
-                        npix_data[j] = len(pix_in_aperture[j])
-                    aperture_npix_col = MaskedColumn(data=npix_data,
-                                                     name=names[4])
-
-                try:
-                    self.catalog.remove_columns(names)
-                except KeyError:
+        Parameters
+        ----------
+        ext : `~astropy.table.Table`, iterable of `~astropy.table.Table`, or str
+            The external catalog, as a table, an iterable of tables, or the
+            path to a table file. The catalog is processed ``chunk_size``
+            rows at a time (see `~dendrocat.utils.iter_table_chunks`).
+        ra, dec : str, optional
+            Names of the coordinate columns. Taken to be in degrees if the
+            columns have no units.
+        freq : str or `~astropy.units.Quantity`, optional
+            Name of the frequency column, which is taken to be in GHz if the
+            column has no unit, or a single frequency for the whole catalog.
+        flux_sum : str, optional
+            Name of the integrated flux column.
+        flux_peak : str, optional
+            Name of the peak flux column.
+        err : str, optional
+            Name of the flux uncertainty column.
+        shape : `~dendrocat.Aperture` or str, optional
+            The aperture, or the name to use in place of an aperture name,
+            in the new column names. Default is
+            `~dendrocat.aperture.Ellipse`, so that the columns are used
+            alongside those made by `~dendrocat.MasterCatalog.photometer`.
+        tolerance : `~astropy.units.Quantity`, optional
+            Largest separation between matched sources. Default is 0.1
+            arcsec.
+        skip_rejects : bool, optional
+            If enabled, rejected sources are not matched. Enabled by
+            default.
+        chunk_size : int, optional
+            Number of external rows to process at a time. Default is 100000.
+        format : str, optional
+            The astropy table format, if ``ext`` is a file path.
+        """
+        from scipy.spatial import cKDTree
+
+        shape = getattr(shape, '__name__', shape)
+        catalog = self.catalog
+        candidates = np.arange(len(catalog))
+        if skip_rejects:
+            candidates = candidates[np.asarray(catalog['rejected']) != 1]
+
+        tree = cKDTree(_unit_vectors(catalog['x_cen'][candidates],
+                                     catalog['y_cen'][candidates]))
+        max_chord = _chord(ucheck(tolerance, unit=u.arcsec).to(u.deg).value)
+
+        fields = OrderedDict([('sum', flux_sum), ('peak', flux_peak),
+                              ('rms', err)])
+        fields = OrderedDict((k, v) for k, v in fields.items()
+                             if v is not None)
+
+        if not hasattr(self, 'external_freqs'):
+            self.external_freqs = OrderedDict()
+
+        # Closest match so far at each frequency, and its fluxes
+        best = OrderedDict()
+
+        for chunk in iter_table_chunks(ext, chunk_size=chunk_size,
+                                       format=format):
+
+            lon = chunk[ra].quantity if chunk[ra].unit else chunk[ra]*u.deg
+            lat = chunk[dec].quantity if chunk[dec].unit else chunk[dec]*u.deg
+            dist, nearest = tree.query(
+                _unit_vectors(lon.to(u.deg).value, lat.to(u.deg).value),
+                distance_upper_bound=max_chord)
+            found = np.isfinite(dist)
+            if not found.any():
+                continue
+            dist = dist[found]
+            rows = candidates[nearest[found]]
+
+            if isinstance(freq, str):
+                nu = (chunk[freq].quantity if chunk[freq].unit
+                      else chunk[freq]*u.GHz)[found].to(u.GHz).value
+            else:
+                nu = np.full(len(rows), ucheck(freq, unit=u.GHz)
+                                        .to(u.GHz).value)
+
+            for value in np.unique(nu):
+                freq_id = '{:.1f}'.format(value*u.GHz).replace(' ', '')
+                self.external_freqs[freq_id] = value*u.GHz
+                if freq_id not in best:
+                    best[freq_id] = OrderedDict(
+                        [('dist', np.full(len(catalog), np.inf))]
+                        + [(k, np.full(len(catalog), np.nan))
+                           for k in fields])
+                record = best[freq_id]
+
+                # Closest external source per master source in this chunk
+                here = np.where(nu == value)[0]
+                order = here[np.lexsort((dist[here], rows[here]))]
+                first = np.r_[True, rows[order][1:] != rows[order][:-1]]
+                order = order[first]
+                better = dist[order] < record['dist'][rows[order]]
+                order = order[better]
+
+                record['dist'][rows[order]] = dist[order]
+                for k, colname in fields.items():
+                    values = np.ma.filled(np.ma.asarray(
+                        chunk[colname][found], dtype=float), np.nan)
+                    record[k][rows[order]] = values[order]
+
+        for freq_id, record in best.items():
+            for k in fields:
+                name = '{}_{}_{}'.format(freq_id, shape, k)
+                self.catalog[name] = MaskedColumn(
+                    data=record[k], mask=np.isnan(record[k]))
+
+
+    def _valid_rows(self, colnames, skip_rejects=True):
+        """
+        Find the catalog rows with unmasked values in all of the given
+        columns, without copying the catalog.
+
+        Parameters
+        ----------
+        colnames : list of str
+            Names of the columns that must have values.
+        skip_rejects : bool, optional
+            If enabled, rejected sources are not valid. Enabled by default.
+
+        Returns
+        -------
+        `~numpy.ndarray`
+            Boolean mask of the valid rows.
+        """
+        valid = np.ones(len(self.catalog), dtype=bool)
+        valid[get_index_masked(self.catalog, colnames)] = False
+        if skip_rejects:
+            valid &= np.asarray(self.catalog['rejected']) != 1
+        return valid
+
+
+    def _column_values(self, colname, rows=None):
+        """
+        Return the data of a catalog column as a float array, optionally for
+        a selection of rows only.
+        """
+        values = np.ma.getdata(self.catalog[colname])
+        if rows is not None:
+            values = values[rows]
+        return np.asarray(values, dtype=float)
+
+
+    def _bands(self, aperture=None, stat='sum'):
+        """
+        Return the frequency of every band with photometry, keyed by
+        freq_id and sorted by frequency. Includes both registered
+        `~dendrocat.RadioSource` objects and external catalogs added with
+        `~dendrocat.MasterCatalog.match_external`.
+
+        If an aperture name is given, bands without any unmasked
+        ``<freq_id>_<aperture>_<stat>`` values are left out.
+        """
+        bands = OrderedDict()
+        for freq_id, rs_obj in self.radiosources.items():
+            bands[freq_id] = rs_obj.nu.to(u.GHz)
+        for freq_id, nu in getattr(self, 'external_freqs', {}).items():
+            bands.setdefault(freq_id, nu.to(u.GHz))
+
+        if aperture is not None:
+            for freq_id in list(bands):
+                colname = '{}_{}_{}'.format(freq_id, aperture, stat)
+                if (colname not in self.catalog.colnames
+                        or np.ma.getmaskarray(self.catalog[colname]).all()):
+                    del bands[freq_id]
+
+        return OrderedDict(sorted(bands.items(), key=lambda b: b[1].value))
+
+
+    def _flux_matrix(self, aperture, bkg_aperture=None, peak=False):
+        """
+        Gather the fluxes of every source in every band.
+
+        Photometry is run first for any registered `~dendrocat.RadioSource`
+        without columns for the given apertures. Bands without any fluxes
+        for the aperture are left out. External bands (see
+        `~dendrocat.MasterCatalog.match_external`) have no background
+        aperture, so their own ``<freq_id>_<aperture>_rms`` column is used
+        as the uncertainty instead.
+
+        Parameters
+        ----------
+        aperture : `~dendrocat.Aperture` or str
+            The source aperture, or the name used in place of it for
+            external photometry.
+        bkg_aperture : `~dendrocat.Aperture` or str, optional
+            The aperture whose rms is used as the flux uncertainty.
+        peak : bool, optional
+            If enabled, peak fluxes are used instead of aperture sums.
+
+        Returns
+        -------
+        list of str, `~astropy.units.Quantity`, `~numpy.ma.MaskedArray`, `~numpy.ma.MaskedArray`
+            The freq_id and frequency of each band, and the fluxes and
+            uncertainties with shape (number of sources, number of bands).
+            Entries without photometry are masked.
+        """
+        names = [getattr(a, '__name__', a) for a in (aperture, bkg_aperture)]
+        stat = 'peak' if peak else 'sum'
+
+        to_measure = [a for a in (aperture, bkg_aperture)
+                      if a is not None and not isinstance(a, str)]
+        needed = []
+        for freq_id in self.radiosources:
+            needed.append('{}_{}_{}'.format(freq_id, names[0], stat))
+            if names[1] is not None:
+                needed.append('{}_{}_rms'.format(freq_id, names[1]))
+        missing = [c for c in needed if c not in self.catalog.colnames]
+        if to_measure and missing:
+            self.photometer(*to_measure)
+
+        bands = self._bands(names[0], stat)
+        shape = (len(self.catalog), len(bands))
+        flux = np.ma.masked_all(shape)
+        err = np.ma.masked_all(shape)
+        for j, freq_id in enumerate(bands):
+            err_colname = '{}_{}_rms'.format(freq_id, names[1])
+            if (freq_id in getattr(self, 'external_freqs', {})
+                    and err_colname not in self.catalog.colnames):
+                err_colname = '{}_{}_rms'.format(freq_id, names[0])
+            for values, colname in (
+                    (flux, '{}_{}_{}'.format(freq_id, names[0], stat)),
+                    (err, err_colname)):
+                if colname in self.catalog.colnames:
+                    column = self.catalog[colname]
+                    values[:, j] = np.ma.getdata(column)
+                    values.mask[:, j] = np.ma.getmaskarray(column)
+
+        nu = u.Quantity(list(bands.values()), u.GHz)
+        return list(bands), nu, flux, err
+
+
+    def fit_spectral_indices(self, aperture=Ellipse, bkg_aperture=Annulus,
+                             peak=False, limit=3.):
+        """
+        Fit a power law to the spectrum of every source at once, and add the
+        spectral index and its uncertainty to the master catalog.
+
+        Each source's fluxes S at frequencies nu are fit with a weighted
+        least-squares line in log(S) against log(nu), whose slope is the
+        spectral index. The fit for all sources is solved in closed form
+        over the (source, band) flux matrix. Bands without photometry are
+        skipped, and bands where the flux is below ``limit`` times its
+        uncertainty are treated as upper limits and left out of the fit.
+
+        Three columns are added: ``<aperture>_alpha``,
+        ``<aperture>_alpha_err``, and ``<aperture>_alpha_nbands`` (the number
+        of bands fit), with ``_peak`` after the aperture name if ``peak`` is
+        enabled. Sources with fewer than two bands are masked.
+
+        Parameters
+        ----------
+        aperture : `~dendrocat.Aperture` or str, optional
+            The source aperture. Default is `~dendrocat.aperture.Ellipse`.
+        bkg_aperture : `~dendrocat.Aperture` or str, optional
+            The aperture whose rms is used as the flux uncertainty. If None,
+            all bands are weighted equally and the uncertainty comes from the
+            scatter about the fit. Default is `~dendrocat.aperture.Annulus`.
+        peak : bool, optional
+            If enabled, peak fluxes are used instead of aperture sums.
+            Disabled by default.
+        limit : float, optional
+            Signal-to-noise ratio below which a flux is an upper limit.
+            Default is 3.
+        """
+        freq_ids, nu, flux, err = self._flux_matrix(aperture, bkg_aperture,
+                                                    peak=peak)
+        values = np.ma.filled(flux, np.nan)
+        x = np.log10(nu.to(u.GHz).value)[None, :]
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            y = np.log10(values)
+            if bkg_aperture is None:
+                weight = np.where(np.isfinite(y), 1., 0.)
+            else:
+                errors = np.ma.filled(err, np.nan)
+                use = (values >= limit*errors) & (errors > 0)
+                sigma = errors/(values*np.log(10))
+                weight = np.where(use & np.isfinite(y), 1/sigma**2, 0.)
+
+        y = np.where(weight > 0, y, 0.)
+        nbands = np.count_nonzero(weight, axis=1)
+
+        # Normal equations of the weighted line fit, for every source
+        s0 = weight.sum(axis=1)
+        sx = (weight*x).sum(axis=1)
+        sy = (weight*y).sum(axis=1)
+        sxx = (weight*x**2).sum(axis=1)
+        sxy = (weight*x*y).sum(axis=1)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            det = s0*sxx - sx**2
+            alpha = (s0*sxy - sx*sy)/det
+            alpha_err = np.sqrt(s0/det)
+            if bkg_aperture is None:
+                intercept = (sy - alpha*sx)/s0
+                resid = (weight*(y - intercept[:, None]
+                                 - alpha[:, None]*x)**2).sum(axis=1)
+                alpha_err = np.sqrt(resid/(nbands - 2)/(sxx - sx**2/s0))
+
+        bad = (nbands < 2) | ~np.isfinite(alpha)
+        name = getattr(aperture, '__name__', aperture)
+        if peak:
+            name += '_peak'
+        self.catalog[name+'_alpha'] = MaskedColumn(alpha, mask=bad)
+        self.catalog[name+'_alpha_err'] = MaskedColumn(
+            alpha_err, mask=bad | ~np.isfinite(alpha_err))
+        self.catalog[name+'_alpha_nbands'] = nbands
+
+
+    def plot_seds(self, outfile, aperture=Ellipse, bkg_aperture=Annulus,
+                  peak=False, alphas=None, fit=True, limit=3., log=True,
+                  skip_rejects=True, figsize=(6, 4.5), dpi=100,
+                  batch_size=50, nprocs=None):
+        """
+        Plot the spectral energy distribution of every source.
+
+        The frequencies, fluxes, and uncertainties of all sources are
+        gathered once (see `~dendrocat.MasterCatalog.fit_spectral_indices`),
+        and batches of sources are rendered in parallel with the Agg
+        backend, each worker reusing one figure for its whole batch.
+
+        Parameters
+        ----------
+        outfile : str
+            If the path ends in '.pdf', all SEDs are written to a single
+            multi-page PDF, one source per page. Otherwise, it is taken as a
+            directory in which each SED is saved as a PNG named after the
+            source.
+        aperture : `~dendrocat.Aperture` or str, optional
+            The source aperture. Default is `~dendrocat.aperture.Ellipse`.
+        bkg_aperture : `~dendrocat.Aperture` or str, optional
+            The aperture whose rms is used for the error bars. Default is
+            `~dendrocat.aperture.Annulus`.
+        peak : bool, optional
+            If enabled, peak fluxes are used instead of aperture sums.
+            Disabled by default.
+        alphas : list, optional
+            Spectral indices to plot through each source's brightest flux.
+        fit : bool, optional
+            If enabled, the fitted power law from
+            `~dendrocat.MasterCatalog.fit_spectral_indices` is overplotted.
+            Enabled by default.
+        limit : float, optional
+            Signal-to-noise ratio below which a flux is plotted as an upper
+            limit, at ``limit`` times its uncertainty. Default is 3.
+        log : bool, optional
+            If enabled, SEDs are shown on log-log axes. Enabled by default.
+        skip_rejects : bool, optional
+            If enabled, rejected sources are not plotted. Enabled by default.
+        figsize : tuple, optional
+            Page size in inches. Default is (6, 4.5).
+        dpi : int, optional
+            Resolution of each page. Default is 100.
+        batch_size : int, optional
+            Number of sources rendered by each job. Default is 50.
+        nprocs : int, optional
+            Number of worker processes used to render. Defaults to the
+            number of available CPUs. Use 1 to render in this process.
+
+        Returns
+        -------
+        int
+            The number of SEDs written.
+        """
+        if alphas is None:
+            alphas = []
+
+        freq_ids, nu, flux, err = self._flux_matrix(aperture, bkg_aperture,
+                                                    peak=peak)
+        nu = nu.to(u.GHz).value
+        values = np.ma.filled(flux, np.nan)
+        errors = np.ma.filled(err, np.nan)
+        with np.errstate(invalid='ignore'):
+            upper = np.isfinite(values) & (values < limit*errors)
+        values = np.where(upper, limit*errors, values)
+        errors = np.where(upper | ~np.isfinite(errors), 0., errors)
+
+        name = getattr(aperture, '__name__', aperture) + ('_peak' if peak
+                                                          else '')
+        alpha = np.full(len(self.catalog), np.nan)
+        norm = np.full(len(self.catalog), np.nan)
+        if fit:
+            self.fit_spectral_indices(aperture, bkg_aperture, peak=peak,
+                                      limit=limit)
+            alpha = np.ma.filled(self.catalog[name+'_alpha'].astype(float),
+                                 np.nan)
+
+            # Normalization of each fit, from the weighted mean in log space
+            with np.errstate(invalid='ignore', divide='ignore'):
+                logs = np.log10(values) - alpha[:, None]*np.log10(nu)
+                use = np.isfinite(logs) & ~upper
+                norm = (np.where(use, logs, 0).sum(axis=1)
+                        / use.sum(axis=1))
+
+        rows = np.arange(len(self.catalog))
+        if skip_rejects:
+            rows = rows[np.asarray(self.catalog['rejected']) != 1]
+        names = np.asarray(self.catalog['_name']).astype(str)
+
+        ylabel = '{} Flux'.format('Peak' if peak else 'Integrated')
+
+        pdf = outfile.lower().endswith('.pdf')
+        if not pdf:
+            os.makedirs(outfile, exist_ok=True)
+
+        jobs = []
+        for start in range(0, len(rows), batch_size):
+            batch = rows[start:start+batch_size]
+            if pdf:
+                outfiles = None
+            else:
+                outfiles = [os.path.join(outfile, 'sed_{}.png'.format(n))
+                            for n in names[batch]]
+            jobs.append((nu, values[batch], errors[batch], upper[batch],
+                         names[batch], alpha[batch], norm[batch], alphas,
+                         log, ylabel, figsize, dpi, outfiles))
+
+        if nprocs is None:
+            nprocs = os.cpu_count()
+
+        if nprocs == 1 or len(jobs) <= 1:
+            batches = map(_render_seds, jobs)
+            pool = None
+        else:
+            pool = multiprocessing.Pool(min(nprocs, len(jobs)))
+            batches = pool.imap(_render_seds, jobs)
+
+        try:
+            pages = (page for batch in batches for page in batch)
+            if pdf:
+                save_pages(pages, outfile, dpi=dpi)
+            else:
+                for _ in pages:
                     pass
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+        return len(rows)
+
+
+    def ffplot_matrix(self, aperture=Ellipse, bkg_aperture=Annulus,
+                      alphas=None, peak=False, log=True, skip_rejects=True,
+                      outfile=None, figsize=None, dpi=150):
+        """
+        Produce flux-flux plots for every pair of bands at once, as a
+        corner-style grid.
 
-                self.catalog.add_columns([
-                    aperture_peak_col,
-                    aperture_sum_col,
-                    aperture_rms_col,
-                    aperture_median_col,
-                    aperture_npix_col
-                ])
+        The fluxes of all bands are gathered once (see
+        `~dendrocat.MasterCatalog.ffplot`), and each panel compares a lower
+        frequency band (x) with a higher one (y), with lines of constant
+        spectral index for reference.
 
-                # Mask NaN values
-                for col in self.catalog.colnames:
-                    try:
-                        isnan = np.argwhere(np.isnan(list(self.catalog[col])))
-                        self.catalog.mask[col][isnan] = True
-                    except TypeError:
-                        pass
+        Parameters
+        ----------
+        aperture : `~dendrocat.Aperture`, optional
+            The source aperture. Default is `~dendrocat.aperture.Ellipse`.
+        bkg_aperture : `~dendrocat.Aperture`, optional
+            The aperture whose rms is used for the error bars. Default is
+            `~dendrocat.aperture.Annulus`.
+        alphas : list, optional
+            Spectral indices to overplot. 1, 2, and 3 will be used by
+            default.
+        peak : bool, optional
+            If enabled, peak flux inside the aperture is used instead of
+            aperture sum. Disabled by default.
+        log : bool, optional
+            If enabled, results will be shown on log-log axes. Enabled by
+            default.
+        skip_rejects : bool, optional
+            If enabled, rejected sources are not plotted. Enabled by default.
+        outfile : str, optional
+            If provided, the grid will be saved to this file path.
+        figsize : tuple, optional
+            Size of the figure in inches. Scales with the number of bands by
+            default.
+        dpi : int, optional
+            Resolution of the saved figure. Default is 150.
+
+        Returns
+        -------
+        `~matplotlib.figure.Figure`
+        """
+        from matplotlib import rcParams
+        from matplotlib.figure import Figure
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+        if alphas is None:
+            alphas = [1, 2, 3]
+
+        freq_ids, nu, flux, err = self._flux_matrix(aperture, bkg_aperture,
+                                                    peak=peak)
+
+        use = ~np.ma.getmaskarray(flux)
+        if log:
+            use &= np.ma.filled(flux, 0) > 0
+        if skip_rejects:
+            use &= (np.asarray(self.catalog['rejected']) != 1)[:, None]
+
+        # Leave out bands with nothing to plot
+        keep = use.any(axis=0)
+        freq_ids = [f for f, k in zip(freq_ids, keep) if k]
+        nu, flux, err = nu[keep], flux[:, keep], err[:, keep]
+        use = use[:, keep]
+        nbands = len(freq_ids)
+        if nbands < 2:
+            raise ValueError('At least two bands with photometry are needed')
+        values = np.ma.getdata(flux)
+        errors = np.ma.filled(err, 0.)
+
+        # Reference lines through the middle of each x band's range, for
+        # every band pair and spectral index at once
+        lo = np.array([values[use[:, j], j].min() if use[:, j].any()
+                       else np.nan for j in range(nbands)])
+        hi = np.array([values[use[:, j], j].max() if use[:, j].any()
+                       else np.nan for j in range(nbands)])
+        xline = np.linspace(lo, hi, 10).T
+        ratio = (nu.value[:, None]/nu.value[None, :])
+        yline = (xline[None, :, None, :]
+                 * ratio[:, :, None, None]**np.asarray(alphas)[None, None,
+                                                              :, None])
+
+        if figsize is None:
+            figsize = (3*(nbands - 1), 3*(nbands - 1))
+        fig = Figure(figsize=figsize, dpi=dpi)
+        FigureCanvasAgg(fig)
+        grid = fig.add_gridspec(nbands - 1, nbands - 1, wspace=0.05,
+                                hspace=0.05)
+        colors = rcParams['axes.prop_cycle'].by_key()['color']
+
+        for i in range(1, nbands):
+            for j in range(i):
+                ax = fig.add_subplot(grid[i - 1, j])
+                both = use[:, i] & use[:, j]
+                ax.errorbar(values[both, j], values[both, i],
+                            xerr=errors[both, j], yerr=errors[both, i],
+                            fmt='o', ms=2, alpha=0.75, elinewidth=0.5,
+                            color=colors[0])
+                for k, alpha in enumerate(alphas):
+                    ax.plot(xline[j], yline[i, j, k], '--',
+                            color=colors[(k + 1) % len(colors)],
+                            label='Spectral Index = {}'.format(alpha))
+                if log:
+                    ax.set_xscale('log')
+                    ax.set_yscale('log')
+                if i == nbands - 1:
+                    ax.set_xlabel('Flux {}'.format(freq_ids[j]))
+                else:
+                    ax.tick_params(labelbottom=False)
+                if j == 0:
+                    ax.set_ylabel('Flux {}'.format(freq_ids[i]))
+                else:
+                    ax.tick_params(labelleft=False)
+                if i == 1 and j == 0:
+                    ax.legend(fontsize=7)
+
+        if outfile is not None:
+            fig.savefig(outfile, dpi=dpi, bbox_inches='tight')
+
+        return fig
 
 
     def ffplot(self, rsobj1, rsobj2, apertures=[], bkg_apertures=[],
@@ -221,12 +947,12 @@ class MasterCatalog:
 
         Parameters
         ----------
-        rsobj1 : `~dendrocat.RadioSource` object
+        rsobj1 : `~dendrocat.RadioSource` object or str
             One of two radio source objects from which to make a flux-flux
-            plot.
-        rsobj2 : `~dendrocat.RadioSource` object
+            plot, or its freq_id.
+        rsobj2 : `~dendrocat.RadioSource` object or str
             The other of two radio source objects from which to make a
-            flux-flux plot.
+            flux-flux plot, or its freq_id.
         apertures : list
             List of `~dendrocat.Aperture` objects to use for source apertures.
         bkg_apertures : list
@@ -260,42 +986,36 @@ class MasterCatalog:
             raise ApertureError('Must give equal number of apertures and '
                                 'background apertures')
 
+        rsobj1 = self.get_radiosource(rsobj1)
+        rsobj2 = self.get_radiosource(rsobj2)
+
         if rsobj1.nu > rsobj2.nu:
             rsobj1, rsobj2 = rsobj2, rsobj1
 
-        catalog = deepcopy(self.catalog)
         colors = plt.rcParams['axes.prop_cycle'].by_key()['color']
 
         if alphas is None:
             alphas = [1, 2, 3]
 
+        stat = 'peak' if peak else 'sum'
         cols = []
         for aperture in apertures:
-
-            if peak:
-                cols.append(rsobj1.freq_id+'_'+aperture.__name__+'_peak')
-                cols.append(rsobj2.freq_id+'_'+aperture.__name__+'_peak')
-            else:
-                cols.append(rsobj1.freq_id+'_'+aperture.__name__+'_sum')
-                cols.append(rsobj2.freq_id+'_'+aperture.__name__+'_sum')
+            cols.append('{}_{}_{}'.format(rsobj1.freq_id, aperture.__name__,
+                                          stat))
+            cols.append('{}_{}_{}'.format(rsobj2.freq_id, aperture.__name__,
+                                          stat))
 
         for bkg_aperture in bkg_apertures:
-            cols.append(rsobj1.freq_id+'_'+bkg_aperture.__name__+'_rms')
-            cols.append(rsobj2.freq_id+'_'+bkg_aperture.__name__+'_rms')
+            cols.append('{}_{}_rms'.format(rsobj1.freq_id,
+                                           bkg_aperture.__name__))
+            cols.append('{}_{}_rms'.format(rsobj2.freq_id,
+                                           bkg_aperture.__name__))
 
-        try:
-            index = list(set(range(len(catalog)))^
-                         set(np.nonzero(catalog.mask[cols])[0])
-                         .union(set(np.where(catalog['rejected']==1)[0])))
-        except KeyError:
-            for aperture in apertures:
-                self.photometer(aperture)
-            catalog = deepcopy(self.catalog)
-            index = list(set(range(len(catalog)))^
-                         set(np.nonzero(catalog.mask[cols])[0])
-                         .union(set(np.where(catalog['rejected']==1)[0])))
+        if any(col not in self.catalog.colnames for col in cols):
+            self.photometer(*OrderedDict.fromkeys(apertures + bkg_apertures))
 
-        catalog = catalog[index]
+        catalog = self.catalog
+        valid = self._valid_rows(cols)
 
         flux1 = []
         flux2 = []
@@ -303,23 +1023,18 @@ class MasterCatalog:
         err2 = []
 
         for aperture in apertures:
-
-            if peak:
-                flux1.append(catalog['{}_{}_peak'.format(rsobj1.freq_id,
-                                                         aperture.__name__)])
-                flux2.append(catalog['{}_{}_peak'.format(rsobj2.freq_id,
-                                                         aperture.__name__)])
-            else:
-                flux1.append(catalog['{}_{}_sum'.format(rsobj1.freq_id,
-                                                         aperture.__name__)])
-                flux2.append(catalog['{}_{}_sum'.format(rsobj2.freq_id,
-                                                         aperture.__name__)])
+            flux1.append(self._column_values('{}_{}_{}'.format(
+                rsobj1.freq_id, aperture.__name__, stat), valid))
+            flux2.append(self._column_values('{}_{}_{}'.format(
+                rsobj2.freq_id, aperture.__name__, stat), valid))
 
         for bkg_aperture in bkg_apertures:
-            err1.append(catalog[rsobj1.freq_id+bkg_aperture.__name__+'_rms'])
-            err2.append(catalog[rsobj2.freq_id+bkg_aperture.__name__+'_rms'])
+            err1.append(self._column_values('{}_{}_rms'.format(
+                rsobj1.freq_id, bkg_aperture.__name__), valid))
+            err2.append(self._column_values('{}_{}_rms'.format(
+                rsobj2.freq_id, bkg_aperture.__name__), valid))
 
-        marker_labels = catalog['_name']
+        marker_labels = catalog['_name'][valid]
 
         xflux = np.linspace(np.min(flux1), np.max(flux1), 10)
         yfluxes = []
@@ -328,11 +1043,11 @@ class MasterCatalog:
             yfluxes.append(specindex(rsobj1.nu, rsobj2.nu, xflux, alpha))
 
         n_images = len(apertures)
-        xplots = int(np.around(np.sqrt(n_images)))
+        xplots = int(np.ceil(np.sqrt(n_images)))
         yplots = xplots
         fig, axes = plt.subplots(ncols=yplots, nrows=xplots, figsize=(12, 12))
 
-        for i in range(len(apertures)-1):
+        for i in range(len(apertures)):
             ax = np.ndarray.flatten(np.array(axes))[i]
             ax.errorbar(flux1[i], flux2[i], xerr=err1[i], yerr=err2[i], ms=2,
                         alpha=0.75, elinewidth=0.5, color=colors[i], fmt='o',
@@ -352,25 +1067,29 @@ class MasterCatalog:
                                 size=8)
             if peak:
                 if log:
-                    plt.xlabel('Log Peak Flux {}'.format(rsobj1.freq_id))
-                    plt.ylabel('Log Peak Flux {}'.format(rsobj2.freq_id))
-                    plt.xscale('log')
-                    plt.yscale('log')
+                    ax.set_xlabel('Log Peak Flux {}'.format(rsobj1.freq_id))
+                    ax.set_ylabel('Log Peak Flux {}'.format(rsobj2.freq_id))
+                    ax.set_xscale('log')
+                    ax.set_yscale('log')
                 else:
-                    plt.xlabel('Peak Flux {}'.format(rsobj1.freq_id))
-                    plt.ylabel('Peak Flux {}'.format(rsobj2.freq_id))
+                    ax.set_xlabel('Peak Flux {}'.format(rsobj1.freq_id))
+                    ax.set_ylabel('Peak Flux {}'.format(rsobj2.freq_id))
             else:
                 if log:
-                    plt.xlabel('Log Flux {}'.format(rsobj1.freq_id))
-                    plt.ylabel('Log Flux {}'.format(rsobj2.freq_id))
-                    plt.xscale('log')
-                    plt.yscale('log')
+                    ax.set_xlabel('Log Flux {}'.format(rsobj1.freq_id))
+                    ax.set_ylabel('Log Flux {}'.format(rsobj2.freq_id))
+                    ax.set_xscale('log')
+                    ax.set_yscale('log')
                 else:
-                    plt.xlabel('Flux {}'.format(rsobj1.freq_id))
-                    plt.ylabel('Flux {}'.format(rsobj2.freq_id))
+                    ax.set_xlabel('Flux {}'.format(rsobj1.freq_id))
+                    ax.set_ylabel('Flux {}'.format(rsobj2.freq_id))
             plt.suptitle('{} Flux v. {} Flux'.format(rsobj2.freq_id,
                                                      rsobj1.freq_id))
-            plt.legend()
+            ax.legend()
+
+        # Hide unused panels of the grid
+        for ax in np.ndarray.flatten(np.array(axes))[n_images:]:
+            ax.axis('off')
 
-            if outfile is not None:
-                plt.savefig(outfile, dpi=300, bbox_inches='tight')
+        if outfile is not None:
+            plt.savefig(outfile, dpi=300, bbox_inches='tight')
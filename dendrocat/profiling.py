@@ -0,0 +1,352 @@
+"""
+Opt-in timing and memory instrumentation of the pipeline stages.
+
+Nothing is instrumented until `enable` is called, which wraps each registered
+stage (see `STAGES`) in place. `disable` puts the original functions back, so
+there is no cost at all while instrumentation is off.
+
+    >>> from dendrocat import profiling
+    >>> with profiling.profile():
+    ...     source_object.autoreject()
+    ...     mc = match(source_object1, source_object2)
+    >>> profiling.report(format='table')
+
+Each call of a stage records its wall time, CPU time, growth of the peak
+resident set size, and counts of the items it processed (sources, pixels,
+cutouts, images). Functions must be looked up through their module or class
+at call time to be instrumented, e.g. ``dendrocat.utils.match(...)`` rather
+than a name imported before `enable` was called. Work done in worker
+processes (``nprocs > 1``) is included in the wall time of the stage that
+started it, but not in its CPU time.
+"""
+import sys
+import time
+import json
+import functools
+import importlib
+from collections import OrderedDict
+
+import numpy as np
+from astropy.table import Table
+
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
+
+if __package__ == '':
+    __package__ = 'dendrocat'
+
+
+def _count_dendrogram(obj, args, result):
+    return {'pixels': obj.data.size, 'sources': len(result.leaves)}
+
+
+def _count_catalog(obj, args, result):
+    return {'sources': len(result)}
+
+
+def _count_cutouts(obj, args, result):
+    return {'cutouts': len(result[0])}
+
+
+def _count_pixels(obj, args, result):
+    pixels = sum(np.size(p) for p in result[0] if np.ndim(p) > 0)
+    return {'sources': len(result[0]), 'pixels': pixels}
+
+
+def _count_sources(obj, args, result):
+    return {'sources': len(obj.catalog)}
+
+
+def _count_measured(obj, args, result):
+    return {'sources': len(result['catalog'])}
+
+
+def _count_images(obj, args, result):
+    return {'sources': len(obj.catalog), 'images': len(obj.radiosources)}
+
+
+def _count_matched(obj, args, result):
+    return {'sources': len(result.catalog), 'images': len(args)}
+
+
+# Stages instrumented by `enable`, as 'module:attribute' targets and the
+# function that counts the items each call processed, given the instance (or
+# None), the positional arguments, and the return value.
+STAGES = OrderedDict([
+    ('dendrocat.radiosource:RadioSource.to_dendrogram', _count_dendrogram),
+    ('dendrocat.radiosource:RadioSource.to_catalog', _count_catalog),
+    ('dendrocat.radiosource:RadioSource.to_noise_map', None),
+    ('dendrocat.radiosource:RadioSource._make_cutouts', _count_cutouts),
+    ('dendrocat.radiosource:RadioSource.get_pixels', _count_pixels),
+    ('dendrocat.radiosource:RadioSource.get_snr', _count_catalog),
+    ('dendrocat.radiosource:RadioSource.measure', _count_measured),
+    ('dendrocat.radiosource:RadioSource.autoreject', _count_sources),
+    ('dendrocat.radiosource:RadioSource.plot_grid_pages', _count_sources),
+    ('dendrocat.mastercatalog:MasterCatalog.photometer', _count_images),
+    ('dendrocat.mastercatalog:MasterCatalog.match_external', _count_sources),
+    ('dendrocat.mastercatalog:MasterCatalog.fit_spectral_indices',
+     _count_sources),
+    ('dendrocat.mastercatalog:MasterCatalog.plot_seds', None),
+    ('dendrocat.utils:match', _count_matched),
+    ('dendrocat.utils:match_nway', _count_matched),
+    ('dendrocat.utils:match_probabilistic', _count_matched),
+])
+
+_originals = OrderedDict()
+_records = []
+_stack = []
+_hooks = []
+
+
+def _resolve(target):
+    """
+    Return the object owning a 'module:attribute' target, and the attribute
+    name.
+    """
+    modname, _, path = target.partition(':')
+    owner = importlib.import_module(modname)
+    parts = path.split('.')
+    for part in parts[:-1]:
+        owner = getattr(owner, part)
+    return owner, parts[-1]
+
+
+def _maxrss():
+    """
+    Peak resident set size of this process so far, in bytes.
+    """
+    if resource is None:
+        return 0
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss if sys.platform == 'darwin' else maxrss*1024
+
+
+def _instrument(func, stage, count, method):
+    """
+    Wrap a function so that every call is recorded under `stage`.
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        record = OrderedDict([('stage', stage),
+                              ('parent', _stack[-1][0] if _stack else None)])
+        for hook in _hooks:
+            hook('start', record)
+
+        # Wall time spent in nested stages is collected in the stack entry
+        frame = [stage, 0.]
+        _stack.append(frame)
+        rss = _maxrss()
+        cpu = time.process_time()
+        wall = time.perf_counter()
+        finished = False
+        try:
+            result = func(*args, **kwargs)
+            finished = True
+        finally:
+            record['wall'] = time.perf_counter() - wall
+            record['self'] = record['wall'] - frame[1]
+            record['cpu'] = time.process_time() - cpu
+            record['rss'] = _maxrss() - rss
+            _stack.pop()
+            if _stack:
+                _stack[-1][1] += record['wall']
+            _records.append(record)
+
+            # Items are only counted for calls that returned
+            if finished and count is not None:
+                obj, rest = (args[0], args[1:]) if method else (None, args)
+                try:
+                    record.update(count(obj, rest, result))
+                except Exception:
+                    pass
+
+            for hook in _hooks:
+                hook('stop', record)
+        return result
+
+    return wrapper
+
+
+def register(target, count=None):
+    """
+    Add a stage to be instrumented.
+
+    Parameters
+    ----------
+    target : str
+        The function or method, as 'module:attribute', e.g.
+        'dendrocat.radiosource:RadioSource.get_snr'.
+    count : callable, optional
+        Called with the instance (None for functions), the other positional
+        arguments, and the return value of each call. Returns a dict of item
+        counts to record.
+    """
+    STAGES[target] = count
+    if is_enabled():
+        _patch(target, count)
+
+
+def _patch(target, count):
+    if target in _originals:
+        return
+    owner, name = _resolve(target)
+    func = getattr(owner, name)
+    method = isinstance(owner, type)
+    modname, _, stage = target.partition(':')
+    if not method:
+        stage = '{}.{}'.format(modname.rpartition('.')[2], stage)
+    _originals[target] = (owner, name, func)
+    setattr(owner, name, _instrument(func, stage, count, method))
+
+
+def enable():
+    """
+    Start recording every call of the registered stages.
+    """
+    for target, count in STAGES.items():
+        _patch(target, count)
+
+
+def disable():
+    """
+    Stop recording and restore the original functions. Records are kept
+    until `reset` is called.
+    """
+    while _originals:
+        target, (owner, name, func) = _originals.popitem()
+        setattr(owner, name, func)
+
+
+def is_enabled():
+    """
+    Whether the stages are currently instrumented.
+    """
+    return bool(_originals)
+
+
+def reset():
+    """
+    Discard all records.
+    """
+    del _records[:]
+
+
+class profile:
+    """
+    Context manager that records the stages run within it.
+
+    Parameters
+    ----------
+    reset : bool, optional
+        If enabled, earlier records are discarded on entry. Default is True.
+    """
+    def __init__(self, reset=True):
+        self.reset = reset
+
+    def __enter__(self):
+        if self.reset:
+            reset()
+        self._was_enabled = is_enabled()
+        enable()
+        return self
+
+    def __exit__(self, *exc):
+        if not self._was_enabled:
+            disable()
+        return False
+
+
+def add_hook(hook):
+    """
+    Call a function whenever a stage starts and stops, e.g. to drive an
+    external profiler or tracer.
+
+    Parameters
+    ----------
+    hook : callable
+        Called as ``hook(event, record)``, where `event` is 'start' or 'stop'
+        and `record` is the dict for that call. On 'start', the record only
+        holds the 'stage' and 'parent' names. 'stop' is also called if the
+        stage raises an exception, without any item counts.
+    """
+    if hook not in _hooks:
+        _hooks.append(hook)
+
+
+def remove_hook(hook):
+    """
+    Stop calling a function added with `add_hook`.
+    """
+    if hook in _hooks:
+        _hooks.remove(hook)
+
+
+def records():
+    """
+    Return the record of every call, in the order the calls finished.
+
+    Returns
+    -------
+    list of dict
+        Each holds the 'stage' name, the 'parent' stage it was called from
+        (or None), 'wall' and 'cpu' times in seconds, the wall time spent
+        outside of nested stages 'self', growth of the peak resident set size
+        'rss' in bytes, and any item counts.
+    """
+    return [OrderedDict(record) for record in _records]
+
+
+def report(format='dict'):
+    """
+    Summarize the records by stage.
+
+    Parameters
+    ----------
+    format : {'dict', 'table', 'json'}, optional
+        Return a dict keyed by stage, an `~astropy.table.Table` with one row
+        per stage, or a JSON string. Default is 'dict'.
+
+    Returns
+    -------
+    dict, `~astropy.table.Table`, or str
+        Number of calls, total wall and CPU times (including nested stages),
+        total wall time outside of nested stages, the largest growth of the
+        peak resident set size, and total item counts for each stage.
+    """
+    summary = OrderedDict()
+    for record in _records:
+        stats = summary.setdefault(record['stage'], OrderedDict(
+            [('calls', 0), ('wall', 0.), ('self', 0.), ('cpu', 0.),
+             ('rss', 0)]))
+        stats['calls'] += 1
+        stats['wall'] += record['wall']
+        stats['self'] += record['self']
+        stats['cpu'] += record['cpu']
+        stats['rss'] = max(stats['rss'], record['rss'])
+        for key, value in record.items():
+            if key not in ('stage', 'parent', 'wall', 'self', 'cpu', 'rss'):
+                stats[key] = stats.get(key, 0) + value
+
+    if format == 'dict':
+        return summary
+    elif format == 'json':
+        return json.dumps(summary, indent=2)
+    elif format == 'table':
+        keys = ['calls', 'wall', 'self', 'cpu', 'rss']
+        for stats in summary.values():
+            keys += [key for key in stats if key not in keys]
+        table = Table()
+        table['stage'] = list(summary.keys())
+        for key in keys:
+            values = [stats.get(key, 0) for stats in summary.values()]
+            table[key] = np.array(values, dtype=int if key not in
+                                  ('wall', 'self', 'cpu') else float)
+        for key in ('wall', 'self', 'cpu'):
+            table[key].unit = 's'
+        table['rss'].unit = 'byte'
+        return table
+    else:
+        raise ValueError("Unknown report format '{}'. Use 'dict', 'table', "
+                         "or 'json'.".format(format))
@@ -1,26 +1,156 @@
-from astropy.io import fits
 from astropy import wcs
-import radio_beam
 import numpy as np
 import astropy.units as u
 from astropy import coordinates
 from astropy.nddata.utils import Cutout2D, NoOverlapError
 from astropy.table import Column, Table, vstack
-from astrodendro import Dendrogram, pp_catalog
-import regions
 import pickle
+import os
+import multiprocessing
+from collections import OrderedDict
 from copy import deepcopy
 import warnings
-warnings.filterwarnings('ignore')
 
 if __package__ == '':
     __package__ = 'dendrocat'
 from .aperture import Aperture, Ellipse, Circle, Annulus
-from .utils import rms, ucheck
+from .utils import rms, ucheck, save_pages
 
 class UnknownApertureError(Exception):
     pass
 
+def _aperture_key(aperture):
+    """
+    Identify an aperture for reusing saved measurements: an aperture class,
+    whose size is set by each source, by its name, and a fixed aperture
+    instance also by its size.
+    """
+    if isinstance(aperture, type):
+        return aperture.__name__
+    if hasattr(aperture, 'aperture_inner'):
+        size = (aperture.aperture_inner.major, aperture.aperture_outer.major)
+    else:
+        size = (aperture.major, aperture.minor, aperture.pa)
+    return ((getattr(aperture, '__name__', type(aperture).__name__),)
+            + tuple(str(value) for value in size))
+
+
+def _noise_strip(args):
+    """
+    Find the sigma-clipped rms and median of each block in a strip of image
+    rows.
+
+    Parameters
+    ----------
+    args : tuple
+        The strip of image data, the block size in pixels, and the clipping
+        threshold in standard deviations.
+
+    Returns
+    -------
+    `~numpy.ndarray`, `~numpy.ndarray`
+        The rms and median of each block in the strip.
+    """
+    from astropy.stats import sigma_clip, mad_std
+
+    strip, box_size, sigma = args
+
+    # Pad the strip to a whole number of blocks, then put each block's
+    # pixels along the last axis
+    nbx = int(np.ceil(strip.shape[1]/box_size))
+    padded = np.full((box_size, nbx*box_size), np.nan)
+    padded[:strip.shape[0], :strip.shape[1]] = strip
+    blocks = (padded.reshape(box_size, nbx, box_size)
+                    .transpose(1, 0, 2)
+                    .reshape(nbx, box_size**2))
+
+    clipped = sigma_clip(np.ma.masked_invalid(blocks), sigma=sigma, axis=1)
+    median = np.ma.median(clipped, axis=1).filled(np.nan)
+    noise = mad_std(clipped.filled(np.nan), axis=1, ignore_nan=True)
+    return noise, median
+
+
+def _init_noise_worker(path):
+    """
+    Open the memory-mapped image data once in each worker process.
+    """
+    global _worker_data
+    _worker_data = np.load(path, mmap_mode='r')
+
+
+def _noise_strip_job(args):
+    """
+    Find the background of one strip of the memory-mapped image in a worker
+    process.
+
+    Parameters
+    ----------
+    args : tuple
+        The first row of the strip, the block size in pixels, and the
+        clipping threshold in standard deviations.
+
+    Returns
+    -------
+    `~numpy.ndarray`, `~numpy.ndarray`
+        The rms and median of each block in the strip.
+    """
+    y, box_size, sigma = args
+    return _noise_strip((_worker_data[y:y+box_size], box_size, sigma))
+
+
+def _render_grid_page(args):
+    """
+    Render one page of a source grid with the Agg backend.
+
+    Parameters
+    ----------
+    args : tuple
+        Cutout data, aperture masks, SNRs, names, and rejection flags of the
+        sources on the page, followed by the grid shape, figure size, dpi, and
+        output file.
+
+    Returns
+    -------
+    `~numpy.ndarray` or None
+        The rendered RGBA page, if no output file was given.
+    """
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+    (cutout_data, masks, snr_vals, names, rejected, shape, figsize, dpi,
+     outfile) = args
+
+    fig = Figure(figsize=figsize, dpi=dpi)
+    canvas = FigureCanvasAgg(fig)
+    grid = fig.add_gridspec(shape[0], shape[1], wspace=0.0, hspace=0.0)
+
+    for i in range(len(cutout_data)):
+        ax = fig.add_subplot(grid[i])
+
+        if rejected[i] == 1:
+            ax.imshow(cutout_data[i], origin='lower', cmap='gray')
+        else:
+            ax.imshow(cutout_data[i], origin='lower')
+
+        # A single overlay for all apertures instead of one image per mask
+        overlay = np.sum([m[i] for m in masks], axis=0)
+        ax.imshow(overlay, origin='lower', cmap='gray', alpha=0.3,
+                  vmin=0, vmax=len(masks))
+
+        ax.text(0, 0, 'SN {:.1f}'.format(snr_vals[i]), fontsize=7, color='w',
+                ha='left', va='bottom', transform=ax.transAxes)
+        ax.text(0, 1, names[i], fontsize=7, color='w', ha='left', va='top',
+                transform=ax.transAxes)
+        ax.set_xticks([])
+        ax.set_yticks([])
+
+    if outfile is not None:
+        fig.savefig(outfile, dpi=dpi)
+        return None
+
+    canvas.draw()
+    return np.asarray(canvas.buffer_rgba()).copy()
+
 class RadioSource:
     """
     An object to store radio image data.
@@ -39,6 +169,8 @@ class RadioSource:
             An identifier specifying the observation frequency (Ex: 226.0GHz).
             If not specified, it will be generated from the FITS image header.
         """
+        import radio_beam
+
         self.hdu = hdu
         self.header = hdu[0].header
         self.data = hdu[0].data.squeeze()
@@ -46,7 +178,10 @@ class RadioSource:
 
         self.__name__ = name
 
-        self.wcs = wcs.WCS(self.header).celestial
+        with warnings.catch_warnings():
+            # Telescope headers routinely carry keywords that astropy fixes
+            warnings.simplefilter('ignore', wcs.FITSFixedWarning)
+            self.wcs = wcs.WCS(self.header).celestial
         self.beam = radio_beam.Beam.from_fits_header(self.header)
         self.pixel_scale = (np.abs(self.wcs.pixel_scale_matrix.diagonal()
                             .prod())**0.5 * u.deg)
@@ -154,6 +289,8 @@ class RadioSource:
             A dendrogram object calculated from the radio image.
         """
 
+        from astrodendro import Dendrogram
+
         if not min_value:
             min_value = self.min_value
 
@@ -190,6 +327,8 @@ class RadioSource:
         `~astropy.table.Table`
         """
 
+        from astrodendro import pp_catalog
+
         if not dendrogram:
             try:
                 dendrogram = self.dendrogram
@@ -226,7 +365,7 @@ class RadioSource:
                        name=self.freq_id+'_detected')
 
         self.catalog = Table(cat, masked=True)
-        return Table(cat, masked=True)
+        return self.catalog
 
 
     def add_sources(self, *args):
@@ -245,13 +384,183 @@ class RadioSource:
             self.catalog['_index'] = range(len(self.catalog))
 
 
-    def _make_cutouts(self, catalog=None, data=None, save=True):
+    def to_noise_map(self, box_size=None, sigma=3., nprocs=1, save=True):
+        """
+        Estimate the background rms and median of the image on a coarse grid.
+
+        The image is split into square blocks, and the sigma-clipped rms and
+        median are found for each block. The image is read one strip of
+        blocks at a time, so memory-mapped data is never loaded in full.
+
+        Parameters
+        ----------
+        box_size : int, optional
+            Width of each block in pixels. Defaults to eight beam widths.
+        sigma : float, optional
+            Number of standard deviations at which to clip pixels, so that
+            sources do not contribute to the background. Default is 3.
+        nprocs : int, optional
+            Number of worker processes. Default is 1, which computes the map
+            in this process. Workers read the image from a memory-mapped
+            file (see `~dendrocat.RadioSource.memmap_data`), which is
+            written temporarily if the data are not memory-mapped already.
+        save : bool, optional
+            If enabled, the maps and block size will be saved as the
+            ``noise_map``, ``median_map`` and ``noise_box`` instance
+            attributes. Default is True.
+
+        Returns
+        -------
+        `~numpy.ndarray`, `~numpy.ndarray`
+            The rms and median maps, with one value per block.
+        """
+
+        if box_size is None:
+            beam_pix = (self.beam.major/self.pixel_scale).decompose().value
+            box_size = max(int(np.ceil(8*beam_pix)), 16)
+        box_size = int(box_size)
+
+        starts = range(0, self.data.shape[0], box_size)
+
+        if nprocs == 1:
+            strips = [_noise_strip((self.data[y:y+box_size], box_size, sigma))
+                      for y in starts]
+        else:
+            # Workers read their strips from the memory-mapped image, so
+            # only the strip bounds are sent to them
+            temp_path = None
+            if (isinstance(self.data, np.memmap)
+                    and getattr(self, '_data_file', None) is not None):
+                path = self._data_file
+            else:
+                path = temp_path = self._worker_copy().memmap_data()
+            try:
+                with multiprocessing.Pool(nprocs,
+                                          initializer=_init_noise_worker,
+                                          initargs=(path,)) as pool:
+                    strips = pool.map(_noise_strip_job,
+                                      [(y, box_size, sigma) for y in starts])
+            finally:
+                if temp_path is not None:
+                    os.remove(temp_path)
+
+        noise_map = np.array([strip[0] for strip in strips])
+        median_map = np.array([strip[1] for strip in strips])
+
+        if save:
+            self.noise_map = noise_map
+            self.median_map = median_map
+            self.noise_box = box_size
+
+        return noise_map, median_map
+
+
+    def noise_at(self, catalog=None):
+        """
+        Interpolate the background maps to the position of each source.
+
+        Parameters
+        ----------
+        catalog : `~astropy.table.Table`, optional
+            The catalog of sources at which to find the background.
+
+        Returns
+        -------
+        `~numpy.ndarray`, `~numpy.ndarray`
+            The background rms and median at each source.
+        """
+
+        if catalog is None:
+            try:
+                catalog = self.catalog
+            except AttributeError:
+                catalog = self.to_catalog()
+
+        if not hasattr(self, 'noise_map'):
+            self.to_noise_map()
+
+        x, y = self.wcs.wcs_world2pix(np.asarray(catalog['x_cen'], float),
+                                      np.asarray(catalog['y_cen'], float), 0)
+
+        # Position in units of blocks, relative to the first block center
+        nby, nbx = self.noise_map.shape
+        half = (self.noise_box - 1)/2.
+        gy = np.clip(np.nan_to_num((y - half)/self.noise_box), 0, nby - 1)
+        gx = np.clip(np.nan_to_num((x - half)/self.noise_box), 0, nbx - 1)
+        y0 = np.clip(np.floor(gy).astype(int), 0, max(nby - 2, 0))
+        x0 = np.clip(np.floor(gx).astype(int), 0, max(nbx - 2, 0))
+        y1 = np.minimum(y0 + 1, nby - 1)
+        x1 = np.minimum(x0 + 1, nbx - 1)
+        wy = gy - y0
+        wx = gx - x0
+
+        results = []
+        for grid in (self.noise_map, self.median_map):
+            results.append(grid[y0, x0]*(1 - wy)*(1 - wx)
+                           + grid[y0, x1]*(1 - wy)*wx
+                           + grid[y1, x0]*wy*(1 - wx)
+                           + grid[y1, x1]*wy*wx)
+        return results[0], results[1]
+
+
+    def _cutout_size(self, *apertures, catalog=None):
+        """
+        Find the cutout width needed to hold the largest of the given
+        apertures around any source in the catalog.
+
+        Cutouts hold the full extent of each aperture, with a pixel to spare
+        on each side, so that the photometry of an aperture does not depend
+        on which others are measured with it. The `~dendrocat.aperture.Annulus`
+        class keeps the default size of `~dendrocat.RadioSource._make_cutouts`,
+        so that its statistics match those of
+        `~dendrocat.RadioSource.measure`.
+
+        Parameters
+        ----------
+        *apertures : `~dendrocat.aperture.Aperture`
+            Aperture classes, sized by each source, or instances with fixed
+            dimensions.
+        catalog : `~astropy.table.Table`, optional
+            The catalog of sources.
+
+        Returns
+        -------
+        `~astropy.units.Quantity`
+        """
+        if catalog is None:
+            catalog = self.catalog
+
+        major = np.max(catalog['major_fwhm'])*u.deg
+        margin = 2*self.pixel_scale
+        widths = []
+        for aperture in apertures:
+            if isinstance(aperture, Aperture):
+                if isinstance(aperture, Annulus):
+                    width = aperture.aperture_outer.major
+                else:
+                    width = aperture.major
+                if width.unit.is_equivalent(u.pix):
+                    width = width.to(u.pix).value*self.pixel_scale
+                widths.append(width.to(u.deg) + margin)
+            elif aperture == Annulus:
+                widths.append(0.7*(major + self.annulus_padding
+                                   + self.annulus_width))
+            else:
+                widths.append(major + margin)
+
+        return max(widths).to(u.deg)
+
+
+    def _make_cutouts(self, catalog=None, data=None, size=None, save=True):
         """
         Make a cutout of cutout regions around all source centers in the
         catalog.
 
         Parameters
         ----------
+        size : `~astropy.units.Quantity`, optional
+            Width of each cutout. By default, cutouts are made large enough
+            to hold the annulus of the largest source in the catalog.
         save : bool, optional
             If enabled, the cutouts and cutout data will both be saved as
             instance attributes. Default is True.
@@ -271,9 +580,10 @@ class RadioSource:
         if data is None:
             data = self.data
 
-        size = 0.7*(np.max(catalog['major_fwhm'])*u.deg
-                + self.annulus_padding
-                + self.annulus_width)
+        if size is None:
+            size = 0.7*(np.max(catalog['major_fwhm'])*u.deg
+                    + self.annulus_padding
+                    + self.annulus_width)
 
         cutouts = []
         cutout_data = []
@@ -305,7 +615,10 @@ class RadioSource:
                 cutout_data.append(float('nan'))
 
         cutouts = np.array(cutouts)
-        cutout_data = np.array(cutout_data)
+        with warnings.catch_warnings():
+            # Sources off the image leave NaN in place of their cutout
+            warnings.simplefilter('ignore', np.VisibleDeprecationWarning)
+            cutout_data = np.array(cutout_data)
 
         if save:
             self._cutouts = cutouts
@@ -354,6 +667,14 @@ class RadioSource:
         pix_arrays = []
         masks = []
 
+        # Tag the source parameters with units once, so that the apertures
+        # built below don't have to validate them one source at a time
+        centers = np.column_stack([catalog['x_cen'],
+                                   catalog['y_cen']]).astype(float)*u.deg
+        majors = np.asarray(catalog['major_fwhm'], dtype=float)*u.deg
+        minors = np.asarray(catalog['minor_fwhm'], dtype=float)*u.deg
+        pas = np.asarray(catalog['position_angle'], dtype=float)*u.deg
+
         for i in range(len(cutouts)):
 
             if isinstance(cutouts[i], Cutout2D):
@@ -365,11 +686,10 @@ class RadioSource:
 
             frame = wcs.utils.wcs_to_celestial_frame(cutouts[i].wcs).name
 
-            x_cen = catalog['x_cen'][i]
-            y_cen = catalog['y_cen'][i]
-            major = catalog['major_fwhm'][i]
-            minor = catalog['minor_fwhm'][i]
-            pa = catalog['position_angle'][i]
+            cen = centers[i]
+            major = majors[i]
+            minor = minors[i]
+            pa = pas[i]
 
             if isinstance(aperture, Aperture):
                 # If this is the case, then aperture has already been given
@@ -377,13 +697,11 @@ class RadioSource:
                 # replace the center value with the centers from the sources.
 
                 if aperture.unit.is_equivalent(u.deg):
-                    aperture.center = coordinates.SkyCoord(x_cen*u.deg,
-                                                           y_cen*u.deg,
+                    aperture.center = coordinates.SkyCoord(cen[0], cen[1],
                                                            frame=frame)
                 elif aperture.unit.is_equivalent(u.pix):
-                    sky = coordinates.SkyCoord(x_cen*u.deg, y_cen*u.deg,
-                                               frame=frame)
-                    pixel = ucheck(sky.to_pixel(cutouts[i].wcs), u.pix)
+                    sky = coordinates.SkyCoord(cen[0], cen[1], frame=frame)
+                    pixel = np.array(sky.to_pixel(cutouts[i].wcs))*u.pix
                     aperture.center = pixel
                     aperture.x_cen, aperture.y_cen = pixel[0], pixel[1]
 
@@ -392,14 +710,13 @@ class RadioSource:
                 # specified and doesn't have any parameters associated to it.
 
                 # DEFAULTS FOR VARIABLE APERTURES STORED HERE
-                cen = [x_cen, y_cen]
                 if aperture == Ellipse:
                     aperture = Ellipse(cen, major, minor, pa, unit=u.deg,
                                        frame=frame)
 
                 elif aperture == Annulus:
-                    inner_r = major*u.deg+self.annulus_padding
-                    outer_r = major*u.deg+self.annulus_padding+self.annulus_width
+                    inner_r = major+self.annulus_padding
+                    outer_r = major+self.annulus_padding+self.annulus_width
                     aperture = Annulus(cen, inner_r, outer_r, unit=u.deg, frame=frame)
 
                 elif aperture == Circle:
@@ -418,16 +735,23 @@ class RadioSource:
             masks.append(this_mask)
             aperture = aperture_original # reset the aperture for the next source
 
+        with warnings.catch_warnings():
+            # Each source has its own number of pixels and cutout shape
+            warnings.simplefilter('ignore', np.VisibleDeprecationWarning)
+            pix_arrays = np.array(pix_arrays)
+            masks = np.array(masks)
+
         if save:
             self.__dict__['pixels_{}'
-                          .format(aperture.__name__)] = np.array(pix_arrays)
+                          .format(aperture.__name__)] = pix_arrays
             self.__dict__['mask_{}'
-                          .format(aperture.__name__)] = np.array(masks)
-        return np.array(pix_arrays), np.array(masks)
+                          .format(aperture.__name__)] = masks
+        return pix_arrays, masks
 
 
     def get_snr(self, source=None, background=None, catalog=None, data=None,
-                cutouts=None, cutout_data=None, peak=True, save=True):
+                cutouts=None, cutout_data=None, peak=True, save=True,
+                noise_map=False):
         """
         Return the SNR of all sources in the catalog.
 
@@ -452,6 +776,11 @@ class RadioSource:
         save : bool, optional
             If enabled, the snr will be saved as a column in the source catalog
             and as an instance attribute. Default is True.
+        noise_map : bool, optional
+            If enabled, the noise is read from the background map made by
+            `~dendrocat.RadioSource.to_noise_map` instead of being measured
+            in an annulus around each source. ``background`` is then taken to
+            be the noise at each source, if given. Default is False.
 
         Returns
         -------
@@ -466,73 +795,127 @@ class RadioSource:
                 catalog = self.to_catalog()
 
         # Cascade check
-        if source is None or background is None:
-
-            if data is None:
-                data = self.data
-
-            if cutouts is None or cutout_data is None:
-                #size = 2.2*(np.max(catalog['major_fwhm'])*u.deg
-                #            + self.annulus_padding
-                #            + self.annulus_width)
-                cutouts, cutout_data = self._make_cutouts(catalog=catalog,
-                                                          data=data)
-
-            background = self.get_pixels(Annulus,
-                                         catalog=catalog,
-                                         data=data,
-                                         cutouts=cutouts)[0]
-
-            source = self.get_pixels(Ellipse,
-                                     catalog=catalog,
-                                     data=data,
-                                     cutouts=cutouts)[0]
+        if source is None:
+            return self.measure(catalog=catalog, data=data, cutouts=cutouts,
+                                cutout_data=cutout_data, noise_map=noise_map,
+                                save=save)['snr']
+
+        if background is None:
+            if noise_map:
+                background = self.noise_at(catalog)[0]
+            else:
+                return self.measure(catalog=catalog, data=data,
+                                    cutouts=cutouts, cutout_data=cutout_data,
+                                    save=save)['snr']
 
         snr_vals = []
         for i in range(len(catalog)):
             try:
-                snr = np.max(source[i]) / rms(background[i])
+                if noise_map:
+                    noise = background[i]
+                else:
+                    noise = rms(background[i])
+                snr = np.max(source[i]) / noise
             except (ZeroDivisionError, ValueError) as e:
                 snr = 0.0
             snr_vals.append(snr)
+        snr_vals = np.array(snr_vals)
 
         if save:
-            self.snr = np.array(snr_vals)
-            try:
-                catalog.remove_column(self.freq_id+'_snr')
-            except KeyError:
-                pass
-            catalog.add_column(Column(snr_vals), name=self.freq_id+'_snr')
+            self.snr = snr_vals
+            catalog[self.freq_id+'_snr'] = snr_vals
 
-        return np.array(snr_vals)
+        return snr_vals
 
 
-    def plot_grid(self, catalog=None, data=None, cutouts=None,
-                  cutout_data=None, source_aperture=None, bkg_aperture=None,
-                  skip_rejects=True, outfile=None, figurekwargs={}):
+    def _aperture_stats(self, pix_arrays):
         """
-        Plot sources in a grid.
+        Calculate photometry statistics for the pixels in an aperture.
 
         Parameters
         ----------
-        catalog : astropy.table.Table object, optional
-            The catalog used to extract source positions.
-        data : numpy.ndarray, optional
-            The image data displayed and used to make cutouts.
-        cutouts : list of astropy.nddata.utils.Cutout2D objects, optional
-            Image cutout regions to save computation time, if they have already
-            been calculated.
-        cutout_data : list of numpy.ndarrays, optional
-            Image cutout region data to save on computation time, if it has
-            already been calculated.
-        apertures : list of dendrocat.aperture functions, optional
-            Apertures to plot over the image cutouts.
-        skip_rejects : bool, optional
-            If enabled, don't plot rejected sources. Default is True.
+        pix_arrays : `~numpy.ndarray`
+            Pixels inside the aperture for each source, as returned by
+            `~dendrocat.RadioSource.get_pixels`.
+
+        Returns
+        -------
+        dict
+            Arrays of the peak, sum, rms, median, and number of pixels in the
+            aperture for each source, ignoring NaN pixels. Sums are over
+            positive pixels only, in units of flux per beam. Sources without
+            any finite pixels are NaN.
         """
 
-        import matplotlib.gridspec as gs
-        import matplotlib.pyplot as plt
+        n = len(pix_arrays)
+        stats = OrderedDict((name, np.full(n, np.nan))
+                            for name in ['peak', 'sum', 'rms', 'median',
+                                         'npix'])
+
+        for j in range(n):
+            # Blanked pixels, e.g. at the edge of a mosaic, are ignored
+            pix = np.atleast_1d(pix_arrays[j])
+            pix = pix[np.isfinite(pix)]
+            if pix.size == 0:
+                continue
+            stats['peak'][j] = np.max(pix)
+            stats['sum'][j] = np.sum(pix[pix > 0.])/self.ppbeam
+            stats['rms'][j] = rms(pix)
+            stats['median'][j] = np.median(pix)
+            stats['npix'][j] = len(pix)
+
+        return stats
+
+
+    def measure(self, *apertures, catalog=None, data=None, cutouts=None,
+                cutout_data=None, cutout_size=None, source_aperture=None,
+                bkg_aperture=None, snr=True, noise_map=False, save=True):
+        """
+        Measure all sources in the catalog in a single pass.
+
+        Cutouts are made once, and the pixels, masks, and photometry
+        statistics are found once for every aperture. The resulting record is
+        used by `~dendrocat.RadioSource.autoreject`,
+        `~dendrocat.RadioSource.plot_grid` and
+        `~dendrocat.MasterCatalog.photometer`, so none of them need to
+        repeat the work.
+
+        Parameters
+        ----------
+        *apertures : `~dendrocat.aperture.Aperture`, optional
+            Additional apertures to measure.
+        catalog : `~astropy.table.Table`, optional
+            The catalog of sources to measure.
+        data : array-like, optional
+            Image data for the sources in the catalog.
+        cutouts, cutout_data : optional
+            Precomputed cutouts, as returned by
+            `~dendrocat.RadioSource._make_cutouts`.
+        cutout_size : `~astropy.units.Quantity`, optional
+            Width of the cutouts to make, if none are given.
+        source_aperture, bkg_aperture : `~dendrocat.aperture.Aperture`, optional
+            Apertures used to calculate the SNR. Defaults are
+            `~dendrocat.aperture.Ellipse` and `~dendrocat.aperture.Annulus`.
+        snr : bool, optional
+            If enabled, the source and background apertures are measured and
+            the SNR is calculated. Default is True.
+        noise_map : bool, optional
+            If enabled, the SNR uses the noise from the background map made
+            by `~dendrocat.RadioSource.to_noise_map`, and the background
+            aperture is not measured. Default is False.
+        save : bool, optional
+            If enabled, the record is saved as the ``measurement`` instance
+            attribute, and the SNR is saved as a catalog column. Default is
+            True.
+
+        Returns
+        -------
+        dict
+            The measurement record, with keys ``catalog``, ``data``,
+            ``cutouts``, ``cutout_data``, ``apertures``, ``pixels``,
+            ``masks``, ``stats`` (each keyed by aperture name), ``snr``, and
+            ``noise`` and ``noise_median`` if a background map is available.
+        """
 
         if catalog is None:
             try:
@@ -549,29 +932,166 @@ class RadioSource:
         if bkg_aperture is None:
             bkg_aperture = Annulus
 
-        # Get cutouts
         if cutouts is None or cutout_data is None:
             cutouts, cutout_data = self._make_cutouts(catalog=catalog,
-                                                      data=data)
+                                                      data=data,
+                                                      size=cutout_size,
+                                                      save=save)
+
+        to_measure = list(apertures)
+        if snr and noise_map:
+            to_measure = [source_aperture] + to_measure
+            bkg_name = None
+        elif snr:
+            to_measure = [source_aperture, bkg_aperture] + to_measure
+            bkg_name = bkg_aperture.__name__
+        else:
+            bkg_name = bkg_aperture.__name__
+
+        record = {
+            'catalog': catalog,
+            'data': data,
+            'cutouts': cutouts,
+            'cutout_data': cutout_data,
+            'cutout_size': cutout_size,
+            'apertures': OrderedDict(),
+            'pixels': OrderedDict(),
+            'masks': OrderedDict(),
+            'stats': OrderedDict(),
+            'snr': None,
+            'noise': None,
+            'noise_median': None,
+            'source_aperture': source_aperture.__name__,
+            'bkg_aperture': bkg_name,
+            'settings': self._measurement_settings(source_aperture,
+                                                   bkg_aperture),
+                  }
+
+        if noise_map or hasattr(self, 'noise_map'):
+            record['noise'], record['noise_median'] = self.noise_at(catalog)
+
+        for aperture in to_measure:
+            if aperture.__name__ in record['pixels']:
+                continue
+            pixels, masks = self.get_pixels(aperture, catalog=catalog,
+                                            data=data, cutouts=cutouts,
+                                            save=save)
+            record['apertures'][aperture.__name__] = aperture
+            record['pixels'][aperture.__name__] = pixels
+            record['masks'][aperture.__name__] = masks
+            record['stats'][aperture.__name__] = self._aperture_stats(pixels)
+
+        if snr and noise_map:
+            record['snr'] = self.get_snr(
+                                source=record['pixels'][record['source_aperture']],
+                                background=record['noise'],
+                                catalog=catalog, save=save, noise_map=True)
+        elif snr:
+            record['snr'] = self.get_snr(
+                                source=record['pixels'][record['source_aperture']],
+                                background=record['pixels'][record['bkg_aperture']],
+                                catalog=catalog, save=save)
 
-        # Get pixels and masks in each aperture
-        ap_names = []
-        pixels = []
-        masks = []
+        if save:
+            self.measurement = record
+
+        return record
+
+
+    def _measurement_settings(self, source_aperture, bkg_aperture):
+        """
+        Return the aperture sizes and annulus settings a measurement depends
+        on, besides the catalog and data.
+        """
+        return (_aperture_key(source_aperture), _aperture_key(bkg_aperture),
+                str(self.annulus_padding), str(self.annulus_width))
+
+    def _get_measurement(self, catalog=None, data=None, source_aperture=None,
+                         bkg_aperture=None):
+        """
+        Return the saved measurement record if it still applies to the given
+        catalog, data, apertures, and annulus settings. Otherwise, measure
+        without saving.
+        """
+
+        if catalog is None:
+            try:
+                catalog = self.catalog
+            except AttributeError:
+                catalog = self.to_catalog()
+
+        if data is None:
+            data = self.data
+
+        if source_aperture is None:
+            source_aperture = Ellipse
+
+        if bkg_aperture is None:
+            bkg_aperture = Annulus
 
-        for aperture in [source_aperture, bkg_aperture]:
-            some_pixels, a_mask = self.get_pixels(aperture, catalog=catalog,
-                                                  data=data, cutouts=cutouts)
-            ap_names.append(aperture.__name__)
-            pixels.append(some_pixels)
-            masks.append(a_mask)
+        record = getattr(self, 'measurement', None)
+        if (record is not None
+                and record['catalog'] is catalog
+                and record['data'] is data
+                and len(record['cutout_data']) == len(catalog)
+                and record['source_aperture'] == source_aperture.__name__
+                and record['bkg_aperture'] == bkg_aperture.__name__
+                and record.get('settings') == self._measurement_settings(
+                    source_aperture, bkg_aperture)
+                and record['snr'] is not None):
+            return record
+
+        return self.measure(catalog=catalog, data=data,
+                            source_aperture=source_aperture,
+                            bkg_aperture=bkg_aperture, save=False)
+
+    def _grid_sources(self, catalog=None, data=None, cutouts=None,
+                      cutout_data=None, source_aperture=None,
+                      bkg_aperture=None, skip_rejects=True):
+        """
+        Gather the cutouts, aperture masks, and SNRs of the sources shown in
+        a source grid.
+
+        Parameters
+        ----------
+        catalog : astropy.table.Table object, optional
+            The catalog used to extract source positions.
+        data : numpy.ndarray, optional
+            The image data displayed and used to make cutouts.
+        cutouts : list of astropy.nddata.utils.Cutout2D objects, optional
+            Image cutout regions to save computation time, if they have already
+            been calculated.
+        cutout_data : list of numpy.ndarrays, optional
+            Image cutout region data to save on computation time, if it has
+            already been calculated.
+        source_aperture, bkg_aperture : `~dendrocat.aperture.Aperture`, optional
+            Apertures to plot over the image cutouts.
+        skip_rejects : bool, optional
+            If enabled, rejected sources are left out. Default is True.
+
+        Returns
+        -------
+        cutout_data, masks, snr_vals, names, rejected
+            Cutout data for each plotted source, a list of mask arrays (one
+            per aperture), and the SNR, name, and rejection flag of each
+            source.
+        """
 
-        # Find SNR
-        ellipse_pix = pixels[0]
-        annulus_pix = pixels[1]
+        if cutouts is not None and cutout_data is not None:
+            record = self.measure(catalog=catalog, data=data, cutouts=cutouts,
+                                  cutout_data=cutout_data,
+                                  source_aperture=source_aperture,
+                                  bkg_aperture=bkg_aperture, save=False)
+        else:
+            record = self._get_measurement(catalog=catalog, data=data,
+                                           source_aperture=source_aperture,
+                                           bkg_aperture=bkg_aperture)
 
-        snr_vals = self.get_snr(source=ellipse_pix, background=annulus_pix,
-                                catalog=catalog)
+        catalog = record['catalog']
+        cutout_data = record['cutout_data']
+        masks = [record['masks'][record['source_aperture']],
+                 record['masks'][record['bkg_aperture']]]
+        snr_vals = record['snr']
 
         names = np.array(catalog['_name'])
         rejected = np.array(catalog['rejected'])
@@ -580,20 +1100,14 @@ class RadioSource:
             accepted_indices = np.where(catalog['rejected'] == 0)[0]
             snr_vals = snr_vals[accepted_indices]
             cutout_data = cutout_data[accepted_indices]
-            cutouts = cutouts[accepted_indices]
             names = names[accepted_indices]
             rejected = rejected[accepted_indices]
             for k in range(len(masks)):
                 masks[k] = masks[k][accepted_indices]
 
-        an = np.ones(len(cutouts), dtype='bool')
-        for i in range(len(cutouts)):
-            try:
-                # check whether cutouts[i] is a cutout or is NaN
-                np.isnan(cutouts[i])
-                an[i] = False
-            except TypeError:
-                pass
+        # Sources without a cutout have NaN in place of the cutout data
+        an = np.array([np.ndim(image) == 2 for image in cutout_data],
+                      dtype='bool')
 
         snr_vals = snr_vals[an]
         cutout_data = cutout_data[an]
@@ -602,6 +1116,45 @@ class RadioSource:
         names = names[an]
         rejected = rejected[an]
 
+        return cutout_data, masks, snr_vals, names, rejected
+
+
+    def plot_grid(self, catalog=None, data=None, cutouts=None,
+                  cutout_data=None, source_aperture=None, bkg_aperture=None,
+                  skip_rejects=True, outfile=None, figurekwargs={}):
+        """
+        Plot sources in a grid.
+
+        Parameters
+        ----------
+        catalog : astropy.table.Table object, optional
+            The catalog used to extract source positions.
+        data : numpy.ndarray, optional
+            The image data displayed and used to make cutouts.
+        cutouts : list of astropy.nddata.utils.Cutout2D objects, optional
+            Image cutout regions to save computation time, if they have already
+            been calculated.
+        cutout_data : list of numpy.ndarrays, optional
+            Image cutout region data to save on computation time, if it has
+            already been calculated.
+        apertures : list of dendrocat.aperture functions, optional
+            Apertures to plot over the image cutouts.
+        skip_rejects : bool, optional
+            If enabled, don't plot rejected sources. Default is True.
+        """
+
+        import matplotlib.gridspec as gs
+        import matplotlib.pyplot as plt
+
+        cutout_data, masks, snr_vals, names, rejected = self._grid_sources(
+                                            catalog=catalog,
+                                            data=data,
+                                            cutouts=cutouts,
+                                            cutout_data=cutout_data,
+                                            source_aperture=source_aperture,
+                                            bkg_aperture=bkg_aperture,
+                                            skip_rejects=skip_rejects)
+
         n_images = len(cutout_data)
         xplots = int(np.around(np.sqrt(n_images)))
         yplots = xplots + 1
@@ -638,7 +1191,238 @@ class RadioSource:
         else:
             plt.show()
 
-    def autoreject(self, threshold=None):
+
+    def plot_grid_pages(self, outfile, catalog=None, data=None, cutouts=None,
+                        cutout_data=None, source_aperture=None,
+                        bkg_aperture=None, skip_rejects=True, nrows=6,
+                        ncols=6, figsize=(8.5, 11), dpi=150, nprocs=None):
+        """
+        Plot sources in a grid spread over fixed-size pages.
+
+        Pages are rendered in parallel with the Agg backend, so this scales to
+        thousands of sources where `~dendrocat.RadioSource.plot_grid` would
+        produce a single unreadable figure.
+
+        Parameters
+        ----------
+        outfile : str
+            If the path ends in '.pdf', all pages are written to a single
+            multi-page PDF. Otherwise, it is taken as a directory in which
+            each page is saved as a numbered PNG.
+        catalog : astropy.table.Table object, optional
+            The catalog used to extract source positions.
+        data : numpy.ndarray, optional
+            The image data displayed and used to make cutouts.
+        cutouts : list of astropy.nddata.utils.Cutout2D objects, optional
+            Image cutout regions to save computation time, if they have already
+            been calculated.
+        cutout_data : list of numpy.ndarrays, optional
+            Image cutout region data to save on computation time, if it has
+            already been calculated.
+        source_aperture, bkg_aperture : `~dendrocat.aperture.Aperture`, optional
+            Apertures to plot over the image cutouts.
+        skip_rejects : bool, optional
+            If enabled, don't plot rejected sources. Default is True.
+        nrows, ncols : int, optional
+            Number of rows and columns of sources on each page. Default is 6.
+        figsize : tuple, optional
+            Page size in inches. Default is (8.5, 11).
+        dpi : int, optional
+            Resolution of each page. Default is 150.
+        nprocs : int, optional
+            Number of worker processes used to render pages. Defaults to the
+            number of available CPUs. Use 1 to render in this process.
+
+        Returns
+        -------
+        int
+            The number of pages written.
+        """
+
+        cutout_data, masks, snr_vals, names, rejected = self._grid_sources(
+                                            catalog=catalog,
+                                            data=data,
+                                            cutouts=cutouts,
+                                            cutout_data=cutout_data,
+                                            source_aperture=source_aperture,
+                                            bkg_aperture=bkg_aperture,
+                                            skip_rejects=skip_rejects)
+
+        pdf = outfile.lower().endswith('.pdf')
+        if not pdf:
+            os.makedirs(outfile, exist_ok=True)
+
+        per_page = nrows*ncols
+        jobs = []
+        for k, start in enumerate(range(0, len(cutout_data), per_page)):
+            stop = start + per_page
+            if pdf:
+                page_file = None
+            else:
+                page_file = os.path.join(outfile, 'page_{:04d}.png'.format(k))
+            jobs.append((list(cutout_data[start:stop]),
+                         [m[start:stop] for m in masks],
+                         snr_vals[start:stop],
+                         names[start:stop],
+                         rejected[start:stop],
+                         (nrows, ncols), figsize, dpi, page_file))
+
+        if nprocs is None:
+            nprocs = os.cpu_count()
+
+        if nprocs == 1 or len(jobs) <= 1:
+            pages = map(_render_grid_page, jobs)
+            pool = None
+        else:
+            pool = multiprocessing.Pool(min(nprocs, len(jobs)))
+            pages = pool.imap(_render_grid_page, jobs)
+
+        try:
+            if pdf:
+                save_pages(pages, outfile, dpi=dpi)
+            else:
+                for _ in pages:
+                    pass
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+        return len(jobs)
+
+    def plot_atlas(self, outfile, catalog=None, data=None, cutouts=None,
+                   cutout_data=None, source_aperture=None, bkg_aperture=None,
+                   skip_rejects=True, ncols=None, zoom=4, cmap='viridis',
+                   labels=True, dpi=100):
+        """
+        Save a thumbnail atlas of all sources as a single image.
+
+        Unlike `~dendrocat.RadioSource.plot_grid`, the stamps are composed
+        directly into one RGB array, without a matplotlib axes per source.
+        Rejected sources are shown in grey and aperture outlines in white.
+
+        Parameters
+        ----------
+        outfile : str
+            Path to save the atlas image.
+        catalog : astropy.table.Table object, optional
+            The catalog used to extract source positions.
+        data : numpy.ndarray, optional
+            The image data displayed and used to make cutouts.
+        cutouts : list of astropy.nddata.utils.Cutout2D objects, optional
+            Image cutout regions to save computation time, if they have already
+            been calculated.
+        cutout_data : list of numpy.ndarrays, optional
+            Image cutout region data to save on computation time, if it has
+            already been calculated.
+        source_aperture, bkg_aperture : `~dendrocat.aperture.Aperture`, optional
+            Apertures to outline on the image cutouts.
+        skip_rejects : bool, optional
+            If enabled, don't plot rejected sources. Default is True.
+        ncols : int, optional
+            Number of stamps per row. Defaults to a square atlas.
+        zoom : int, optional
+            Integer factor by which each stamp is enlarged. Default is 4.
+        cmap : str, optional
+            Name of the matplotlib colormap used for accepted sources.
+        labels : bool, optional
+            If enabled, the name and SNR of each source are written on its
+            stamp. Default is True.
+        dpi : int, optional
+            Resolution used when writing labels. Default is 100.
+
+        Returns
+        -------
+        `~numpy.ndarray`
+            The RGB atlas image.
+        """
+        import matplotlib
+
+        cutout_data, masks, snr_vals, names, rejected = self._grid_sources(
+                                            catalog=catalog,
+                                            data=data,
+                                            cutouts=cutouts,
+                                            cutout_data=cutout_data,
+                                            source_aperture=source_aperture,
+                                            bkg_aperture=bkg_aperture,
+                                            skip_rejects=skip_rejects)
+
+        n_images = len(cutout_data)
+        if n_images == 0:
+            raise ValueError('No sources to plot')
+
+        # Flip vertically so stamps appear with origin='lower'
+        stamps = np.stack(list(cutout_data)).astype(float)[:, ::-1]
+        outlines = np.zeros(stamps.shape, dtype='bool')
+        for mask in masks:
+            mask = np.stack(list(mask)).astype(bool)[:, ::-1]
+            inner = mask.copy()
+            inner[:, 1:, :] &= mask[:, :-1, :]
+            inner[:, :-1, :] &= mask[:, 1:, :]
+            inner[:, :, 1:] &= mask[:, :, :-1]
+            inner[:, :, :-1] &= mask[:, :, 1:]
+            outlines |= mask & ~inner
+
+        # Normalize each stamp to its own range
+        lo = np.nanmin(stamps, axis=(1, 2), keepdims=True)
+        hi = np.nanmax(stamps, axis=(1, 2), keepdims=True)
+        span = np.where(hi > lo, hi - lo, 1.)
+        level = np.nan_to_num((stamps - lo)/span)
+        level = (np.clip(level, 0., 1.)*255).astype(np.uint8)
+
+        # Colormap lookup tables
+        try:
+            colormaps = matplotlib.colormaps
+        except AttributeError:  # matplotlib < 3.5
+            from matplotlib.cm import cmap_d as colormaps
+        ramp = np.linspace(0., 1., 256)
+        color_lut = (colormaps[cmap](ramp)[:, :3]*255).astype(np.uint8)
+        gray_lut = (colormaps['gray'](ramp)[:, :3]*255).astype(np.uint8)
+        rgb = np.where((np.asarray(rejected) == 1)[:, None, None, None],
+                       gray_lut[level], color_lut[level])
+        rgb[outlines] = 255
+
+        if zoom > 1:
+            rgb = rgb.repeat(zoom, axis=1).repeat(zoom, axis=2)
+
+        # Tile the stamps, with a one pixel border around each
+        if ncols is None:
+            ncols = int(np.ceil(np.sqrt(n_images)))
+        nrows = int(np.ceil(n_images/ncols))
+        rgb = np.pad(rgb, ((0, nrows*ncols - n_images), (1, 0), (1, 0), (0, 0)))
+        _, h, w, _ = rgb.shape
+        canvas = (rgb.reshape(nrows, ncols, h, w, 3)
+                     .transpose(0, 2, 1, 3, 4)
+                     .reshape(nrows*h, ncols*w, 3))
+
+        if not labels:
+            import matplotlib.image
+            matplotlib.image.imsave(outfile, canvas)
+            return canvas
+
+        from matplotlib.figure import Figure
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+        height, width = canvas.shape[:2]
+        fig = Figure(figsize=(width/dpi, height/dpi), dpi=dpi)
+        FigureCanvasAgg(fig)
+        fig.figimage(canvas, origin='upper')
+
+        fontsize = max(2., 0.12*w*72./dpi)
+        for i in range(n_images):
+            row, col = divmod(i, ncols)
+            left = (col*w + 2.)/width
+            top = 1. - (row*h + 2.)/height
+            bottom = 1. - ((row + 1)*h - 2.)/height
+            fig.text(left, top, names[i], fontsize=fontsize, color='w',
+                     ha='left', va='top')
+            fig.text(left, bottom, 'SN {:.1f}'.format(snr_vals[i]),
+                     fontsize=fontsize, color='w', ha='left', va='bottom')
+
+        fig.savefig(outfile, dpi=dpi)
+        return canvas
+
+    def autoreject(self, threshold=None, noise_map=False):
         """
         Reject noisy detections.
 
@@ -646,12 +1430,16 @@ class RadioSource:
         ----------
         threshold : float, optional
             The signal-to-noise threshold below which sources are rejected
+        noise_map : bool, optional
+            If enabled, the noise is read from the background map made by
+            `~dendrocat.RadioSource.to_noise_map`, so bright neighbors in a
+            source's annulus do not lower its SNR. Default is False.
         """
 
         if threshold is None:
             threshold = self.threshold
 
-        snrs = self.get_snr()
+        snrs = self.measure(noise_map=noise_map)['snr']
 
         try:
             self.catalog['rejected'] = np.zeros(len(self.catalog), dtype=int)
@@ -659,9 +1447,7 @@ class RadioSource:
             self.catalog.add_column(Column(np.zeros(len(self.catalog))),
                                     name='rejected')
 
-        for i in range(len(self.catalog)):
-            if snrs[i] <= threshold or np.isnan(snrs[i]):
-                self.catalog['rejected'][i] = 1
+        self.catalog['rejected'][(snrs <= threshold) | np.isnan(snrs)] = 1
 
         self.accepted = self.catalog[self.catalog['rejected']==0]
         self.rejected = self.catalog[self.catalog['rejected']==1]
@@ -739,6 +1525,73 @@ class RadioSource:
             return self.catalog[self.catalog['_name']==str(name)]
 
 
+    def memmap_data(self, path=None):
+        """
+        Move the image data into a memory-mapped file, so it can be shared
+        with worker processes without being copied.
+
+        Once the data is memory-mapped, pickling the object (including
+        `~dendrocat.RadioSource.dump`) stores the path to the file in place
+        of the image data and the FITS HDU, so the file must be kept for as
+        long as the pickle is used.
+
+        Parameters
+        ----------
+        path : str, optional
+            Path of the ``.npy`` file to write. By default, a temporary file
+            is created.
+
+        Returns
+        -------
+        str
+            The path to the file.
+        """
+        import tempfile
+
+        if path is None:
+            fd, path = tempfile.mkstemp(suffix='.npy', prefix='dendrocat_')
+            os.close(fd)
+
+        np.save(path, np.ascontiguousarray(self.data))
+        self.data = np.load(path, mmap_mode='r')
+        self._data_file = path
+        return path
+
+
+    def _worker_copy(self):
+        """
+        Return a shallow copy without the dendrogram, saved measurements,
+        cutouts, or pixels, to send to worker processes.
+        """
+        worker = RadioSource.__new__(RadioSource)
+        worker.__dict__ = {k: v for k, v in self.__dict__.items()
+                           if k not in ('dendrogram', 'measurement',
+                                        '_cutouts', '_cutout_data')
+                           and not k.startswith(('pixels_', 'mask_'))}
+        return worker
+
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        if (state.get('_data_file') is not None
+                and isinstance(self.data, np.memmap)):
+            state['data'] = None
+            state.pop('hdu', None)
+            record = state.get('measurement')
+            if record is not None and record['data'] is self.data:
+                state['measurement'] = dict(record, data=None)
+        return state
+
+
+    def __setstate__(self, state):
+        if state.get('_data_file') is not None and state['data'] is None:
+            state['data'] = np.load(state['_data_file'], mmap_mode='r')
+            record = state.get('measurement')
+            if record is not None and record['data'] is None:
+                record['data'] = state['data']
+        self.__dict__.update(state)
+
+
     def dump(self, outfile):
         """
         Dump the `~dendrocat.RadioSource` object via pickle.
@@ -750,4 +1603,4 @@ class RadioSource:
         """
         outfile = outfile.split('.')[0]+'.pickle'
         with open(outfile, 'wb') as output:
-            pickle.dump(obj, output, protocol=pickle.HIGHEST_PROTOCOL)
+            pickle.dump(self, output, protocol=pickle.HIGHEST_PROTOCOL)
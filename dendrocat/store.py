@@ -0,0 +1,530 @@
+import os
+import json
+import hashlib
+import datetime
+from collections import OrderedDict
+import numpy as np
+import astropy.units as u
+from astropy.table import Table
+
+if __package__ == '':
+    __package__ = 'dendrocat'
+
+FORMAT_VERSION = 1
+
+# Catalog columns that determine a source's cutout and apertures
+INPUT_COLUMNS = ['x_cen', 'y_cen', 'major_fwhm', 'minor_fwhm',
+                 'position_angle']
+
+
+class StoreVersionError(Exception):
+    pass
+
+
+def image_hash(data, rows=256):
+    """
+    Hash image data a block of rows at a time, so memory-mapped images are
+    never read in full.
+
+    Parameters
+    ----------
+    data : `~numpy.ndarray`
+        The image data to hash.
+    rows : int, optional
+        Number of rows hashed at once.
+
+    Returns
+    -------
+    str
+    """
+    sha = hashlib.sha1()
+    sha.update(str((data.shape, data.dtype.str)).encode())
+    for i in range(0, data.shape[0], rows):
+        sha.update(np.ascontiguousarray(data[i:i+rows]).tobytes())
+    return sha.hexdigest()
+
+
+def _stack(arrays, shape, fill, dtype):
+    """
+    Stack per-source arrays, using `fill` for sources without a cutout.
+    """
+    stack = np.full((len(arrays),) + tuple(shape), fill, dtype=dtype)
+    for i, array in enumerate(arrays):
+        if np.ndim(array) == 2:
+            stack[i] = array
+    return stack
+
+
+def _aperture_spec(aperture):
+    """
+    Describe an aperture in JSON, so that it can be made again. Returns None
+    for apertures other than those of `dendrocat.aperture`.
+    """
+    from .aperture import Ellipse, Annulus, Circle
+
+    if isinstance(aperture, type):
+        if aperture in (Ellipse, Annulus, Circle):
+            return {'class': aperture.__name__}
+        return None
+
+    if type(aperture) is Ellipse:
+        dims = [aperture.major, aperture.minor, aperture.pa]
+    elif type(aperture) is Annulus:
+        dims = [aperture.aperture_inner.major, aperture.aperture_outer.major]
+    elif type(aperture) is Circle:
+        dims = [aperture.radius]
+    else:
+        return None
+    return {'class': type(aperture).__name__, 'name': aperture.__name__,
+            'dims': [str(dim) for dim in dims], 'frame': aperture.frame}
+
+
+def _aperture_from_spec(spec):
+    """
+    Make the aperture described by `_aperture_spec` again.
+    """
+    from . import aperture
+
+    cls = getattr(aperture, spec['class'])
+    if 'dims' not in spec:
+        return cls
+    dims = [u.Quantity(dim) for dim in spec['dims']]
+    return cls([0, 0], *dims, unit=dims[0].unit, frame=spec['frame'],
+               name=spec['name'])
+
+
+def _as_tuples(value):
+    """
+    Turn the lists of a value read from JSON back into tuples.
+    """
+    if isinstance(value, list):
+        return tuple(_as_tuples(item) for item in value)
+    return value
+
+
+class MeasurementStore:
+    """
+    A directory of saved `~dendrocat.RadioSource` measurements.
+
+    The store holds the source catalog (``catalog.ecsv``), the stack of
+    cutout data (``cutout_data.npy``), one stack of masks per aperture
+    (``masks_<aperture>.npy``), the photometry statistics and SNR
+    (``stats.npz``), and a manifest with version stamps and the inputs the
+    measurements depend on (``manifest.json``). Arrays are memory-mapped when
+    read, so loading a store is fast regardless of its size.
+    """
+
+    def __init__(self, path):
+        """
+        Parameters
+        ----------
+        path : str
+            Directory of the store. It is created on the first save.
+        """
+        self.path = path
+        self._catalog = None
+        self._manifest = None
+        self._hashed = None
+
+    def _file(self, name):
+        return os.path.join(self.path, name)
+
+    def _save_array(self, name, array):
+        # Write to a new file and swap it in, so arrays that are still
+        # memory-mapped from the old file stay valid
+        tmp = self._file(name+'.tmp')
+        with open(tmp, 'wb') as fh:
+            np.save(fh, array)
+        os.replace(tmp, self._file(name))
+
+    def exists(self):
+        """
+        Return True if a store has been saved at this path.
+        """
+        return os.path.exists(self._file('manifest.json'))
+
+    @property
+    def manifest(self):
+        if self._manifest is None:
+            with open(self._file('manifest.json')) as fh:
+                self._manifest = json.load(fh)
+            if self._manifest['format_version'] > FORMAT_VERSION:
+                raise StoreVersionError('Store format version {} is newer '
+                                        'than this version of dendrocat '
+                                        'supports'.format(
+                                        self._manifest['format_version']))
+        return self._manifest
+
+    @property
+    def catalog(self):
+        if self._catalog is None:
+            self._catalog = Table.read(self._file('catalog.ecsv'),
+                                       format='ascii.ecsv')
+        return self._catalog
+
+    @property
+    def cutout_data(self):
+        return np.load(self._file('cutout_data.npy'), mmap_mode='r')
+
+    @property
+    def overlap(self):
+        return np.load(self._file('overlap.npy'))
+
+    def masks(self, aperture):
+        """
+        Return the stack of masks for an aperture, memory-mapped.
+
+        Parameters
+        ----------
+        aperture : str or `~dendrocat.aperture.Aperture`
+            The aperture, or its name.
+        """
+        name = getattr(aperture, '__name__', aperture)
+        return np.load(self._file('masks_{}.npy'.format(name)),
+                       mmap_mode='r')
+
+    def stats(self, aperture):
+        """
+        Return the photometry statistics for an aperture.
+
+        Parameters
+        ----------
+        aperture : str or `~dendrocat.aperture.Aperture`
+            The aperture, or its name.
+        """
+        name = getattr(aperture, '__name__', aperture)
+        with np.load(self._file('stats.npz')) as npz:
+            prefix = name+':'
+            return OrderedDict((key[len(prefix):], npz[key])
+                               for key in npz.files
+                               if key.startswith(prefix))
+
+    @property
+    def snr(self):
+        with np.load(self._file('stats.npz')) as npz:
+            if 'snr' in npz.files:
+                return npz['snr']
+
+    def _inputs(self, rs):
+        """
+        Return the image-wide inputs that all measurements depend on.
+        """
+        # Hashing reads the whole image, so only do it once per data array
+        if self._hashed is None or self._hashed[0] is not rs.data:
+            self._hashed = (rs.data, image_hash(rs.data))
+
+        return {
+            'freq_id': rs.freq_id,
+            'image_hash': self._hashed[1],
+            'annulus_width': rs.annulus_width.to(u.deg).value,
+            'annulus_padding': rs.annulus_padding.to(u.deg).value,
+               }
+
+    def save(self, rs, record=None):
+        """
+        Save the catalog and measurements of a `~dendrocat.RadioSource`.
+
+        Parameters
+        ----------
+        rs : `~dendrocat.RadioSource`
+            The object to save.
+        record : dict, optional
+            The measurement record to save. Defaults to ``rs.measurement``,
+            which is made with `~dendrocat.RadioSource.measure` if missing.
+        """
+        from . import __version__
+
+        if record is None:
+            record = getattr(rs, 'measurement', None)
+            if record is None or record['catalog'] is not rs.catalog:
+                record = rs.measure()
+
+        catalog = record['catalog']
+        cutout_data = record['cutout_data']
+        overlap = np.array([np.ndim(image) == 2 for image in cutout_data])
+        if not overlap.any():
+            raise ValueError('No sources overlap the image')
+        shape = np.shape(cutout_data[np.argmax(overlap)])
+
+        os.makedirs(self.path, exist_ok=True)
+        catalog.write(self._file('catalog.ecsv'), format='ascii.ecsv',
+                      overwrite=True)
+        self._save_array('cutout_data.npy',
+                         _stack(cutout_data, shape, np.nan, float))
+        self._save_array('overlap.npy', overlap)
+        for name, masks in record['masks'].items():
+            self._save_array('masks_{}.npy'.format(name),
+                             _stack(masks, shape, False, bool))
+
+        stats = OrderedDict()
+        for name, aperture_stats in record['stats'].items():
+            for stat, values in aperture_stats.items():
+                stats['{}:{}'.format(name, stat)] = values
+        for key in ['snr', 'noise', 'noise_median']:
+            if record.get(key) is not None:
+                stats[key] = record[key]
+        tmp = self._file('stats.npz.tmp')
+        with open(tmp, 'wb') as fh:
+            np.savez(fh, **stats)
+        os.replace(tmp, self._file('stats.npz'))
+
+        cutout_size = record.get('cutout_size')
+        if cutout_size is None:
+            cutout_size = 0.7*(np.max(catalog['major_fwhm'])*u.deg
+                               + rs.annulus_padding + rs.annulus_width)
+
+        manifest = self._inputs(rs)
+        manifest.update({
+            'format_version': FORMAT_VERSION,
+            'dendrocat_version': __version__,
+            'saved': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            'nsources': len(catalog),
+            'cutout_size': cutout_size.to(u.deg).value,
+            'apertures': list(record['masks'].keys()),
+            'aperture_specs': OrderedDict(
+                (name, _aperture_spec(aperture))
+                for name, aperture in record.get('apertures', {}).items()),
+            'source_aperture': record['source_aperture'],
+            'bkg_aperture': record['bkg_aperture'],
+            'settings': record.get('settings'),
+                        })
+        with open(self._file('manifest.json'), 'w') as fh:
+            json.dump(manifest, fh, indent=2)
+
+        self._catalog = None
+        self._manifest = None
+
+    def load(self, rs):
+        """
+        Attach the saved catalog and measurements to a
+        `~dendrocat.RadioSource`, without recomputing anything.
+
+        The cutout data and masks stay memory-mapped. The record has no
+        ``cutouts`` or ``pixels``; it is meant for plotting and photometry
+        statistics.
+
+        Parameters
+        ----------
+        rs : `~dendrocat.RadioSource`
+            The object made from the same image the store was saved from.
+
+        Returns
+        -------
+        dict
+            The measurement record, also set as ``rs.measurement``.
+        """
+        record = self._read(rs)
+        rs.catalog = record['catalog']
+        rs.measurement = record
+        return record
+
+    def _read(self, rs):
+        """
+        Read the saved measurement record, checking that it was saved from
+        the same image as the given `~dendrocat.RadioSource`.
+        """
+        inputs = self._inputs(rs)
+        if any(self.manifest[key] != value for key, value in inputs.items()):
+            raise ValueError('The store was saved from a different image or '
+                             'with different annulus settings')
+
+        overlap = self.overlap
+        cutout_data = self.cutout_data
+        record = {
+            'catalog': self.catalog,
+            'data': rs.data,
+            'cutouts': None,
+            'cutout_data': self._unstack(cutout_data, overlap),
+            'cutout_size': self.manifest['cutout_size']*u.deg,
+            'pixels': OrderedDict(),
+            'masks': OrderedDict(),
+            'stats': OrderedDict(),
+            'source_aperture': self.manifest['source_aperture'],
+            'bkg_aperture': self.manifest['bkg_aperture'],
+            'settings': _as_tuples(self.manifest.get('settings')),
+                 }
+        for name in self.manifest['apertures']:
+            record['masks'][name] = self._unstack(self.masks(name), overlap)
+            record['stats'][name] = self.stats(name)
+        with np.load(self._file('stats.npz')) as npz:
+            for key in ['snr', 'noise', 'noise_median']:
+                record[key] = npz[key] if key in npz.files else None
+
+        return record
+
+    def _unstack(self, stack, overlap):
+        """
+        Return a per-source object array of views into a stack, with NaN for
+        sources without a cutout.
+        """
+        items = np.empty(len(stack), dtype=object)
+        for i in range(len(stack)):
+            items[i] = stack[i] if overlap[i] else float('nan')
+        return items
+
+    def stale(self, rs, catalog=None):
+        """
+        Find the sources whose measurements need to be recomputed.
+
+        Parameters
+        ----------
+        rs : `~dendrocat.RadioSource`
+            The object to compare with the store.
+        catalog : `~astropy.table.Table`, optional
+            The catalog to compare. Defaults to ``rs.catalog``.
+
+        Returns
+        -------
+        `~numpy.ndarray`
+            True for each row of the catalog that is new, or whose position
+            or shape has changed since the store was saved. All rows are stale
+            if the image or annulus settings have changed.
+        """
+        if catalog is None:
+            catalog = rs.catalog
+
+        if not self.exists():
+            return np.ones(len(catalog), dtype=bool)
+
+        manifest = self.manifest
+        inputs = self._inputs(rs)
+        if any(manifest[key] != value for key, value in inputs.items()):
+            return np.ones(len(catalog), dtype=bool)
+
+        saved = self.catalog
+        index = {name: i for i, name in enumerate(saved['_name'])}
+        rows = np.array([index.get(name, -1) for name in catalog['_name']])
+        found = rows >= 0
+
+        stale = ~found
+        for col in INPUT_COLUMNS:
+            new = np.asarray(catalog[col], dtype=float)[found]
+            old = np.asarray(saved[col], dtype=float)[rows[found]]
+            stale[found] |= ~np.isclose(new, old, rtol=0, atol=1e-12)
+        return stale
+
+    def apertures(self):
+        """
+        Make the saved apertures again, to measure more sources with.
+
+        Returns
+        -------
+        `~collections.OrderedDict`
+            The aperture classes or instances, keyed by name.
+        """
+        specs = self.manifest.get('aperture_specs')
+        if not specs or any(spec is None for spec in specs.values()):
+            raise ValueError('The apertures of the store cannot be made '
+                             'again. Measure the sources and save the store '
+                             'again instead of updating it.')
+        return OrderedDict((name, _aperture_from_spec(spec))
+                           for name, spec in specs.items())
+
+    def update(self, rs, catalog=None):
+        """
+        Recompute the measurements of stale sources only, and save.
+
+        Stale sources are measured with the apertures the store was saved
+        with (see `~dendrocat.MeasurementStore.apertures`).
+
+        Parameters
+        ----------
+        rs : `~dendrocat.RadioSource`
+            The object to measure.
+        catalog : `~astropy.table.Table`, optional
+            The catalog to measure. Defaults to ``rs.catalog``.
+
+        Returns
+        -------
+        int
+            The number of sources that were recomputed.
+        """
+        if catalog is None:
+            catalog = rs.catalog
+
+        if not self.exists():
+            self.save(rs, record=rs.measure(catalog=catalog, save=False))
+            return len(catalog)
+
+        apertures = self.apertures()
+        if self.manifest['source_aperture'] not in apertures:
+            raise ValueError('The store has no SNR measurements to update')
+        source_aperture = apertures[self.manifest['source_aperture']]
+        bkg_aperture = apertures.get(self.manifest['bkg_aperture'])
+        extra = [aperture for aperture in apertures.values()
+                 if aperture is not source_aperture
+                 and aperture is not bkg_aperture]
+
+        def measure(catalog, **kwargs):
+            record = rs.measure(*extra, catalog=catalog,
+                                source_aperture=source_aperture,
+                                bkg_aperture=bkg_aperture,
+                                noise_map=bkg_aperture is None, save=False,
+                                **kwargs)
+            record['apertures'] = apertures
+            return record
+
+        stale = self.stale(rs, catalog=catalog)
+        if stale.all():
+            self.save(rs, record=measure(catalog))
+            return len(catalog)
+
+        saved = self._read(rs)
+        cutout_size = saved['cutout_size']
+        index = {name: i for i, name in enumerate(saved['catalog']['_name'])}
+        rows = np.array([index.get(name, -1) for name in catalog['_name']])
+
+        if stale.any():
+            fresh = measure(catalog[stale], cutout_size=cutout_size)
+            # Sources outside the image are rejected on the measured copy
+            catalog['rejected'][stale] = fresh['catalog']['rejected']
+        else:
+            fresh = None
+
+        def merge(old, new):
+            merged = np.empty(len(catalog), dtype=object)
+            # Saved rows stay memory-mapped; saving swaps in new files, so
+            # the old ones remain readable while they are copied
+            for i in np.where(~stale)[0]:
+                merged[i] = old[rows[i]]
+            for i, item in zip(np.where(stale)[0], new):
+                merged[i] = item
+            return merged
+
+        def merge_values(old, new):
+            merged = np.full(len(catalog), np.nan)
+            merged[~stale] = np.asarray(old)[rows[~stale]]
+            merged[stale] = new
+            return merged
+
+        record = dict(saved)
+        record['catalog'] = catalog
+        record['apertures'] = apertures
+        record['cutout_data'] = merge(saved['cutout_data'],
+                                      fresh['cutout_data'] if fresh else [])
+        record['masks'] = OrderedDict()
+        record['stats'] = OrderedDict()
+        for name in saved['masks']:
+            if fresh is not None and name not in fresh['masks']:
+                continue
+            record['masks'][name] = merge(saved['masks'][name],
+                                          fresh['masks'][name] if fresh else [])
+            record['stats'][name] = OrderedDict(
+                (stat, merge_values(values,
+                                    fresh['stats'][name][stat] if fresh
+                                    else np.nan))
+                for stat, values in saved['stats'][name].items())
+        for key in ['snr', 'noise', 'noise_median']:
+            if saved.get(key) is None:
+                continue
+            if fresh is not None and fresh[key] is None:
+                record[key] = None
+            else:
+                record[key] = merge_values(saved[key],
+                                           fresh[key] if fresh else np.nan)
+
+        if record['snr'] is not None:
+            catalog[rs.freq_id+'_snr'] = record['snr']
+
+        self.save(rs, record=record)
+        return int(stale.sum())
@@ -0,0 +1,73 @@
+import numpy as np
+import pytest
+from astropy.table import Table, MaskedColumn
+
+from ..export import write_regions, write_catalog, UnknownFormatError
+
+
+def make_catalog(n=10):
+    catalog = Table(masked=True)
+    catalog['_name'] = ['src{}'.format(i) for i in range(n)]
+    catalog['x_cen'] = 290.9 + 1e-3*np.arange(n)
+    catalog['y_cen'] = 14.5 + 1e-3*np.arange(n)
+    catalog['x_cen'].unit = catalog['y_cen'].unit = 'deg'
+    catalog['major_fwhm'] = np.full(n, 2e-4)
+    catalog['minor_fwhm'] = np.full(n, 1e-4)
+    catalog['position_angle'] = np.full(n, 30.)
+    catalog['flux'] = MaskedColumn(np.arange(n, dtype=float),
+                                   mask=np.arange(n) % 3 == 0)
+    catalog['rejected'] = (np.arange(n) % 4 == 0).astype(int)
+    return catalog
+
+
+def test_write_regions(tmpdir):
+    catalog = make_catalog()
+    outfile = str(tmpdir.join('sources.reg'))
+    chunks = [catalog[:3], catalog[3:]]
+    assert write_regions(chunks, outfile, precision=5) == 7
+
+    lines = open(outfile).read().splitlines()
+    assert lines[:2] == ['# Region file format: DS9', 'icrs']
+    assert len(lines) == 9
+    assert lines[2] == ('ellipse(290.90100, 14.50100, 0.00010, 0.00005, '
+                        '30.00000) # text={src1}')
+
+    outfile = str(tmpdir.join('sources.crtf'))
+    assert write_regions(catalog, outfile, skip_rejects=False) == 10
+    assert open(outfile).readline() == '#CRTFv0\n'
+
+    with pytest.raises(UnknownFormatError):
+        write_regions(catalog, outfile, format='kvis')
+
+
+@pytest.mark.parametrize('ext', ['.ecsv', '.fits', '.parquet'])
+def test_write_catalog_chunks(tmpdir, ext):
+    if ext == '.parquet':
+        pytest.importorskip('pyarrow')
+    catalog = make_catalog()
+    catalog['_name'][1] = 'long_source_name'
+    whole = str(tmpdir.join('whole' + ext))
+    chunked = str(tmpdir.join('chunked' + ext))
+
+    # Names are only as wide as the longest in each chunk, as if read from
+    # a file one chunk at a time
+    chunks = []
+    for start in range(0, len(catalog), 4):
+        chunk = catalog[start:start+4]
+        chunk['_name'] = np.array(chunk['_name'].tolist())
+        chunks.append(chunk)
+
+    assert write_catalog(catalog, whole, skip_rejects=True) == 7
+    assert write_catalog(iter(chunks), chunked, skip_rejects=True) == 7
+
+    expected = Table.read(whole)
+    result = Table.read(chunked)
+    assert result.colnames == expected.colnames
+    for name in result.colnames:
+        assert np.all(result[name] == expected[name])
+        assert np.all(np.ma.getmaskarray(result[name])
+                      == np.ma.getmaskarray(expected[name]))
+    assert result['x_cen'].unit == 'deg'
+
+    with pytest.raises(OSError):
+        write_catalog(iter(chunks), chunked)
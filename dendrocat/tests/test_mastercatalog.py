@@ -0,0 +1,140 @@
+import re
+from copy import deepcopy
+
+import numpy as np
+import astropy.units as u
+from astropy.table import Table, MaskedColumn
+
+from ..mastercatalog import MasterCatalog
+from ..aperture import Ellipse, Annulus
+
+
+def make_mastercatalog():
+    catalog = Table(masked=True)
+    catalog['_name'] = ['a', 'b', 'c']
+    catalog['x_cen'] = 290.9 + np.array([0., 1e-3, 2e-3])
+    catalog['y_cen'] = 14.5 + np.array([0., 1e-3, -1e-3])
+    catalog['rejected'] = np.zeros(3, dtype=int)
+    return MasterCatalog(catalog=catalog)
+
+
+def make_external(mc, nu, alpha=2.):
+    flux = 1e-3*(nu/10.)**alpha*np.ones(len(mc.catalog))
+    ext = Table()
+    ext['ra'] = mc.catalog['x_cen'] + 1e-6
+    ext['dec'] = mc.catalog['y_cen']
+    ext['flux'] = flux
+    ext['flux_err'] = flux/100.
+    return ext
+
+
+def test_fit_spectral_indices_external():
+    mc = make_mastercatalog()
+    for nu in (4.9, 8.5):
+        mc.match_external(make_external(mc, nu), freq=nu*u.GHz,
+                          err='flux_err')
+    mc.fit_spectral_indices(aperture='Ellipse', bkg_aperture='Annulus')
+    assert np.all(mc.catalog['Ellipse_alpha_nbands'] == 2)
+    assert np.allclose(mc.catalog['Ellipse_alpha'], 2.)
+    assert not np.any(mc.catalog['Ellipse_alpha_err'].mask)
+
+
+def test_plot_seds(tmp_path):
+    mc = make_mastercatalog()
+    for nu in (4.9, 8.5):
+        mc.match_external(make_external(mc, nu), freq=nu*u.GHz,
+                          err='flux_err')
+    mc.catalog['rejected'][1] = 1
+    outfile = str(tmp_path / 'seds.pdf')
+    assert mc.plot_seds(outfile, aperture='Ellipse', bkg_aperture='Annulus',
+                        nprocs=1) == 2
+    with open(outfile, 'rb') as f:
+        assert len(re.findall(rb'/Type\s*/Page\b', f.read())) == 2
+
+    outdir = tmp_path / 'seds'
+    assert mc.plot_seds(str(outdir), aperture='Ellipse',
+                        bkg_aperture='Annulus', batch_size=1, nprocs=2) == 2
+    assert sorted(path.name for path in outdir.iterdir()) == [
+        'sed_a.png', 'sed_c.png']
+
+
+def test_bands_without_flux_are_skipped():
+    mc = make_mastercatalog()
+    for nu in (4.9, 8.5):
+        mc.match_external(make_external(mc, nu), freq=nu*u.GHz,
+                          err='flux_err')
+    mc.match_external(make_external(mc, 1.4), freq=1.4*u.GHz,
+                      err='flux_err', shape='Gaussian')
+    freq_ids = mc._flux_matrix('Ellipse', 'Annulus')[0]
+    assert freq_ids == ['4.9GHz', '8.5GHz']
+    fig = mc.ffplot_matrix(aperture='Ellipse', bkg_aperture='Annulus')
+    assert len(fig.axes) == 1
+
+
+def test_match_external():
+    mc = make_mastercatalog()
+    ext = make_external(mc, 8.5)
+    ext['ra'][0] += 1.  # Too far from any source
+    mc.match_external(ext[::-1], freq=8.5*u.GHz, err='flux_err')
+    assert list(mc.external_freqs) == ['8.5GHz']
+    flux = mc.catalog['8.5GHz_Ellipse_sum']
+    assert list(flux.mask) == [True, False, False]
+    assert np.allclose(flux[1:], ext['flux'][1:])
+    assert '8.5GHz_Ellipse_rms' in mc.catalog.colnames
+
+
+def test_valid_rows():
+    mc = make_mastercatalog()
+    mc.catalog['flux'] = MaskedColumn([1., 2., 3.], mask=[False, True, False])
+    mc.catalog['rejected'][2] = 1
+    assert list(mc._valid_rows(['flux'])) == [True, False, False]
+    assert list(mc._valid_rows(['flux'], skip_rejects=False)) == [True, False,
+                                                                  True]
+
+
+class Band:
+    """
+    Stands in for a registered `~dendrocat.RadioSource`, which ffplot only
+    needs the frequency of.
+    """
+    def __init__(self, nu):
+        self.nu = nu*u.GHz
+        self.freq_id = '{:.1f}GHz'.format(nu)
+
+
+def test_ffplot_valid_rows():
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+
+    mc = make_mastercatalog()
+    rng = np.random.default_rng(0)
+    n = 20
+    mc.catalog = mc.catalog[np.arange(n) % 3]
+    mc.catalog['_name'] = ['s{}'.format(i) for i in range(n)]
+    mc.catalog['rejected'] = (np.arange(n) % 7 == 0).astype(int)
+    bands = [Band(93.0), Band(226.1)]
+    for band in bands:
+        for name in ['Ellipse_sum', 'Annulus_rms']:
+            mc.catalog['{}_{}'.format(band.freq_id, name)] = MaskedColumn(
+                rng.uniform(1., 2., n), mask=rng.uniform(size=n) < 0.2)
+    mc.radiosources = {band.freq_id: band for band in bands}
+
+    # Rows selected by copying and masking the catalog, as before
+    cols = ['{}_{}'.format(band.freq_id, name) for band in bands
+            for name in ['Ellipse_sum', 'Annulus_rms']]
+    catalog = deepcopy(mc.catalog)
+    index = list(set(range(len(catalog)))
+                 ^ set(np.nonzero(catalog.mask[cols])[0])
+                 .union(set(np.where(catalog['rejected'] == 1)[0])))
+    expected = catalog[sorted(index)]
+
+    plt.close('all')
+    mc.ffplot('226.1GHz', '93.0GHz', apertures=[Ellipse],
+              bkg_apertures=[Annulus], log=False)
+    points = plt.gcf().axes[0].lines[0].get_xydata()
+    plt.close('all')
+
+    assert 0 < len(points) < n
+    assert np.allclose(points[:, 0], expected['93.0GHz_Ellipse_sum'])
+    assert np.allclose(points[:, 1], expected['226.1GHz_Ellipse_sum'])
@@ -0,0 +1,155 @@
+import numpy as np
+import pytest
+import astropy.units as u
+from astropy.table import Table
+
+from ..utils import (NonEquivalentError, commonbeam_array, get_index_masked,
+                     match, match_nway, match_probabilistic, ucheck)
+
+
+class CatalogHolder:
+    """
+    Stands in for a `~dendrocat.RadioSource`, which only needs a catalog to
+    be matched.
+    """
+    def __init__(self, catalog):
+        self.catalog = catalog
+
+
+def make_catalog(freq_id, ra, dec, rejected=0):
+    n = len(ra)
+    catalog = Table(masked=True)
+    catalog['_idx'] = np.arange(n)
+    catalog['_index'] = np.arange(n)
+    catalog['_name'] = ['{}{:03d}'.format(freq_id, i) for i in range(n)]
+    catalog['x_cen'] = np.asarray(ra, dtype=float)
+    catalog['y_cen'] = np.asarray(dec, dtype=float)
+    catalog['major_fwhm'] = np.full(n, 2e-5)
+    catalog['minor_fwhm'] = np.full(n, 1e-5)
+    catalog['position_angle'] = np.full(n, 30.)
+    catalog['rejected'] = np.full(n, rejected, dtype=int)
+    catalog['{}_detected'.format(freq_id)] = np.ones(n, dtype=int)
+    catalog['{}_snr'.format(freq_id)] = np.full(n, 20.)
+    return CatalogHolder(catalog)
+
+
+def field(offset=0., rejected=0):
+    ra = 290.9 + np.array([0., 1e-3, 2e-3])
+    dec = 14.5 + np.array([0., 1e-3, -1e-3])
+    return (make_catalog('226.1GHz', ra, dec, rejected=rejected),
+            make_catalog('93.0GHz', ra + offset, dec, rejected=rejected))
+
+
+def test_match_probabilistic_overlapping():
+    mc = match_probabilistic(*field(), verbose=False)
+    assert len(mc.catalog) == 3
+    assert np.all(mc.catalog['match_prob'] > 0.5)
+
+
+def test_match_probabilistic_disjoint():
+    mc = match_probabilistic(*field(offset=1.), verbose=False)
+    assert len(mc.catalog) == 6
+    assert np.all(mc.catalog['match_prob'].mask)
+    assert len(match_nway(*field(offset=1.), verbose=False).catalog) == 6
+
+
+def test_match_probabilistic_all_rejected():
+    mc = match_probabilistic(*field(rejected=1), verbose=False)
+    assert len(mc.catalog) == 6
+    assert np.all(mc.catalog['rejected'] == 1)
+
+
+def test_match_probabilistic_empty():
+    first, second = field()
+    first.catalog = first.catalog[:0]
+    second.catalog = second.catalog[:0]
+    assert len(match_probabilistic(first, second, verbose=False).catalog) == 0
+    assert len(match_nway(first, second, verbose=False).catalog) == 0
+
+
+def test_commonbeam_array_matches_radio_beam():
+    from radio_beam import Beams
+
+    pairs = [(4., 1., 30., 2., 1.5, -20.),
+             (3., 1., 0., 2., 1.5, 60.),
+             (5., 4., 10., 2., 1., 50.),
+             (2., 1., 80., 3., 2., -45.)]
+    majors, minors, pas = commonbeam_array(*np.transpose(pairs))
+    for pair, major, minor, pa in zip(pairs, majors, minors, pas):
+        beams = Beams(pair[0::3]*u.arcsec, pair[1::3]*u.arcsec,
+                      pair[2::3]*u.deg)
+        common = beams.common_beam()
+        assert np.isclose(major, common.major.to(u.arcsec).value, rtol=1e-4)
+        assert np.isclose(minor, common.minor.to(u.arcsec).value, rtol=1e-4)
+        diff = (pa - common.pa.to(u.deg).value) % 180.
+        assert min(diff, 180. - diff) < 1e-2
+
+
+def test_match_threshold():
+    # One pair of sources just inside the threshold, one just outside it
+    ra = [290.9, 290.91]
+    dec = np.array([14.5, 14.5])
+    first = make_catalog('226.1GHz', ra, dec)
+    second = make_catalog('93.0GHz', ra, dec + np.array([0.9, 1.1])/3600)
+    mc = match(first, second, verbose=False, threshold=1*u.arcsec)
+    assert len(mc.catalog) == 3
+    paired = np.isclose(mc.catalog['x_cen'], ra[0])
+    assert paired.sum() == 1
+    assert np.isclose(mc.catalog['y_cen'][paired][0], 14.5 + 0.45/3600)
+    assert np.isclose(mc.catalog['x_cen'], ra[1]).sum() == 2
+
+
+def test_match_merges_columns():
+    first = make_catalog('226.1GHz', [290.9, 290.91], [14.5, 14.5])
+    first.catalog['226.1GHz_snr'] = [10., 30.]
+    second = make_catalog('93.0GHz', [290.9], [14.5])
+    second.catalog['93.0GHz_snr'] = [5.]
+    mc = match(first, second, verbose=False)
+    assert len(mc.catalog) == 2
+
+    # The matched source takes each band's values from its own catalog
+    both = np.isclose(mc.catalog['x_cen'], 290.9)
+    assert mc.catalog['226.1GHz_snr'][both][0] == 10.
+    assert mc.catalog['93.0GHz_snr'][both][0] == 5.
+    assert not mc.catalog['93.0GHz_detected'].mask[both][0]
+
+    # The source in one catalog only is masked in the other band
+    one = ~both
+    assert mc.catalog['226.1GHz_snr'][one][0] == 30.
+    assert mc.catalog['93.0GHz_snr'].mask[one][0]
+    assert mc.catalog['93.0GHz_detected'].mask[one][0]
+
+
+def test_get_index_masked_columns():
+    table = Table(masked=True)
+    table['a'] = [1, 2, 3, 4]
+    table['b'] = [1., 2., 3., 4.]
+    table['c'] = ['w', 'x', 'y', 'z']
+    table['a'].mask = [True, False, False, False]
+    table['b'].mask = [False, False, True, False]
+    assert list(get_index_masked(table)) == [0, 2]
+    assert list(get_index_masked(table, columns=['a'])) == [0]
+    assert list(get_index_masked(table, columns=['b', 'c'])) == [2]
+    assert list(get_index_masked(table, columns=['c'])) == []
+    assert list(get_index_masked(table, columns=[])) == []
+    assert list(get_index_masked(table['b'])) == [2]
+
+
+def test_ucheck():
+    # Quantities are returned as they are, or converted
+    angle = 3*u.arcsec
+    assert ucheck(angle, u.arcsec) is angle
+    assert np.isclose(ucheck(angle, u.deg).value, 3/3600)
+    assert ucheck(angle, u.deg).unit == u.deg
+    with pytest.raises(NonEquivalentError):
+        ucheck(angle, u.Jy)
+
+    # Plain numbers and arrays are tagged with the unit
+    assert ucheck(2, u.deg) == 2*u.deg
+    assert ucheck(2.5, u.deg) == 2.5*u.deg
+    assert np.all(ucheck(np.arange(3.), u.deg) == np.arange(3.)*u.deg)
+
+    # Units may be given as strings
+    assert ucheck(2, 'deg') == 2*u.deg
+    assert ucheck(angle, 'arcsec') is angle
+    assert np.isclose(ucheck(angle, 'deg').value, 3/3600)
@@ -0,0 +1,47 @@
+import pytest
+
+from .. import profiling
+from .test_radiosource import make_radiosource
+
+
+def test_report():
+    rs = make_radiosource()
+    with profiling.profile():
+        rs.measure(catalog=rs.catalog[:2])
+        rs.measure()
+    assert not profiling.is_enabled()
+
+    summary = profiling.report()
+    assert summary['RadioSource.measure']['calls'] == 2
+    assert summary['RadioSource.measure']['sources'] == 5
+    assert summary['RadioSource._make_cutouts']['cutouts'] == 5
+    assert summary['RadioSource.measure']['wall'] > 0
+
+    table = profiling.report(format='table')
+    assert 'RadioSource.measure' in list(table['stage'])
+    assert table['wall'].unit == 's'
+    with pytest.raises(ValueError):
+        profiling.report(format='xml')
+
+
+def test_hooks_on_error():
+    events = []
+
+    def hook(event, record):
+        events.append((event, record['stage']))
+
+    rs = make_radiosource()
+    rs.catalog.remove_column('x_cen')
+    profiling.add_hook(hook)
+    try:
+        with profiling.profile():
+            with pytest.raises(KeyError):
+                rs.measure()
+    finally:
+        profiling.remove_hook(hook)
+
+    assert events[0] == ('start', 'RadioSource.measure')
+    assert events[-1] == ('stop', 'RadioSource.measure')
+    assert (len([e for e in events if e[0] == 'start'])
+            == len([e for e in events if e[0] == 'stop']))
+    assert 'sources' not in profiling.records()[-1]
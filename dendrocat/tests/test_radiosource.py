@@ -0,0 +1,181 @@
+import os
+import re
+import subprocess
+import sys
+
+import numpy as np
+import astropy.units as u
+from astropy.io import fits
+from astropy.table import Table
+
+from .. import radiosource
+from ..radiosource import RadioSource
+from ..mastercatalog import MasterCatalog
+from ..aperture import Ellipse, Annulus
+
+# Pixel positions of the sources injected into the test image
+POSITIONS = [(40., 50.), (90., 80.), (60., 100.)]
+
+
+def make_radiosource(size=128, noise=1e-4, peak=5e-3):
+    """
+    Make a small ALMA-like image with Gaussian sources, and a catalog of
+    them.
+    """
+    data = np.random.default_rng(0).normal(0., noise, (size, size))
+    yy, xx = np.mgrid[:size, :size]
+    for x, y in POSITIONS:
+        data += peak*np.exp(-((xx - x)**2 + (yy - y)**2)/(2*2.**2))
+
+    header = fits.Header()
+    header['NAXIS'] = 4
+    for i, (ctype, crval, cdelt, cunit) in enumerate([
+            ('RA---SIN', 290.9, -1e-5, 'deg'),
+            ('DEC--SIN', 14.5, 1e-5, 'deg'),
+            ('FREQ', 226.1e9, 1.875e9, 'Hz'),
+            ('STOKES', 1., 1., '')]):
+        header['CTYPE{}'.format(i+1)] = ctype
+        header['CRVAL{}'.format(i+1)] = crval
+        header['CDELT{}'.format(i+1)] = cdelt
+        header['CRPIX{}'.format(i+1)] = size/2 if i < 2 else 1.
+        header['CUNIT{}'.format(i+1)] = cunit
+    header['BMAJ'] = header['BMIN'] = 4.7e-5
+    header['BPA'] = 0.
+    header['BUNIT'] = 'Jy/beam'
+    header['TELESCOP'] = 'ALMA'
+    header['RADESYS'] = 'ICRS'
+    header['EQUINOX'] = 2000.
+    rs = RadioSource(fits.HDUList([fits.PrimaryHDU(
+        data=data[None, None], header=header)]))
+
+    x, y = np.transpose(POSITIONS)
+    ra, dec = rs.wcs.all_pix2world(x, y, 0)
+    catalog = Table(masked=True)
+    catalog['_idx'] = np.arange(len(x))
+    catalog['_name'] = ['src{}'.format(i) for i in range(len(x))]
+    catalog['x_cen'] = ra
+    catalog['y_cen'] = dec
+    catalog['major_fwhm'] = np.full(len(x), 6e-5)
+    catalog['minor_fwhm'] = np.full(len(x), 5e-5)
+    catalog['position_angle'] = np.zeros(len(x))
+    catalog['rejected'] = np.zeros(len(x), dtype=int)
+    rs.catalog = catalog
+    return rs
+
+
+def test_measure():
+    rs = make_radiosource()
+    record = rs.measure()
+    assert set(record['stats']) == {'Ellipse', 'Annulus'}
+    stats = record['stats']
+    assert np.all(stats['Ellipse']['peak'] > 10*stats['Annulus']['rms'])
+    assert np.all(np.asarray(rs.catalog['226.1GHz_snr']) > 10)
+    assert rs.measurement is record
+
+
+def test_photometer_duplicate_apertures():
+    rs = make_radiosource()
+    mc = MasterCatalog(rs, catalog=rs.catalog)
+    small = Ellipse([0, 0], 2*u.pix, 2*u.pix, 0*u.deg, name='fixed')
+    large = Ellipse([0, 0], 8*u.pix, 8*u.pix, 0*u.deg, name='fixed')
+    mc.photometer(small, large)
+    npix = np.asarray(mc.catalog['226.1GHz_fixed_npix'])
+    mc.photometer(large)
+    assert np.all(npix == np.asarray(mc.catalog['226.1GHz_fixed_npix']))
+
+
+def test_plot_atlas(tmpdir):
+    rs = make_radiosource()
+    rs.measure()
+    outfile = str(tmpdir.join('atlas.png'))
+    atlas = rs.plot_atlas(outfile, ncols=2, labels=False)
+    assert atlas.ndim == 3 and atlas.shape[2] == 3
+    assert tmpdir.join('atlas.png').check()
+
+
+def test_plot_grid_pages(tmp_path):
+    rs = make_radiosource()
+    rs.measure()
+    outfile = str(tmp_path / 'grid.pdf')
+    assert rs.plot_grid_pages(outfile, nrows=1, ncols=2, nprocs=1) == 2
+    with open(outfile, 'rb') as f:
+        assert len(re.findall(rb'/Type\s*/Page\b', f.read())) == 2
+
+    outdir = tmp_path / 'grid'
+    assert rs.plot_grid_pages(str(outdir), nrows=1, ncols=1, nprocs=2) == 3
+    assert sorted(path.name for path in outdir.iterdir()) == [
+        'page_0000.png', 'page_0001.png', 'page_0002.png']
+
+
+def test_to_noise_map_nprocs():
+    rs = make_radiosource()
+    noise, median = rs.to_noise_map(box_size=32, save=False)
+    assert noise.shape == median.shape == (4, 4)
+    assert np.allclose(np.median(noise), 1e-4, rtol=0.2)
+    noise2, median2 = rs.to_noise_map(box_size=32, nprocs=2, save=False)
+    assert np.allclose(noise, noise2) and np.allclose(median, median2)
+    assert not isinstance(rs.data, np.memmap)
+
+
+def test_get_measurement_settings():
+    rs = make_radiosource()
+    record = rs.measure()
+    assert rs._get_measurement() is record
+
+    small = Ellipse([0, 0], 2*u.pix, 2*u.pix, 0*u.deg, name='Ellipse')
+    assert rs._get_measurement(source_aperture=small) is not record
+
+    rs.annulus_width = 2*rs.annulus_width
+    assert rs._get_measurement() is not record
+
+
+def test_photometer_independent_of_other_apertures():
+    rs = make_radiosource()
+    alone = MasterCatalog(rs, catalog=rs.catalog.copy())
+    alone.photometer(Ellipse)
+    both = MasterCatalog(rs, catalog=rs.catalog.copy())
+    both.photometer(Ellipse, Annulus)
+    for stat in ['peak', 'sum', 'rms', 'median', 'npix']:
+        name = '226.1GHz_Ellipse_{}'.format(stat)
+        assert np.all(alone.catalog[name] == both.catalog[name])
+
+
+def test_photometer_without_apertures():
+    rs = make_radiosource()
+    mc = MasterCatalog(rs, catalog=rs.catalog.copy())
+    mc.photometer()
+    assert mc.catalog.colnames == rs.catalog.colnames
+
+
+def test_aperture_stats_ignore_nan():
+    rs = make_radiosource()
+    pixels = np.empty(3, dtype=object)
+    pixels[0] = np.array([1., 2., np.nan, 4.])
+    pixels[1] = np.array([np.nan, np.nan])
+    pixels[2] = np.array([])
+    stats = rs._aperture_stats(pixels)
+    assert stats['peak'][0] == 4.
+    assert np.isclose(stats['sum'][0], 7./rs.ppbeam)
+    assert stats['median'][0] == 2.
+    assert stats['npix'][0] == 3
+    assert np.isfinite(stats['rms'][0])
+    for name in stats:
+        assert np.all(np.isnan(stats[name][1:]))
+
+
+def test_import_keeps_warning_filters():
+    # Import the dependencies first, as they add filters of their own, then
+    # check that importing dendrocat itself adds none
+    code = """
+import warnings
+import numpy, astropy.units, astropy.table, astropy.wcs, astropy.coordinates
+import astropy.nddata
+filters = list(warnings.filters)
+import dendrocat
+for name in dendrocat._SUBMODULES:
+    getattr(dendrocat, name)
+assert warnings.filters == filters, warnings.filters
+"""
+    root = os.path.dirname(os.path.dirname(
+        os.path.abspath(radiosource.__file__)))
+    subprocess.run([sys.executable, '-c', code], cwd=root, check=True)
@@ -0,0 +1,68 @@
+import numpy as np
+import pytest
+import astropy.units as u
+from astropy.table import vstack
+
+from ..store import MeasurementStore
+from ..aperture import Ellipse, Annulus
+from .test_radiosource import make_radiosource
+
+
+def test_update_rejects_new_sources_outside_image(tmpdir):
+    rs = make_radiosource()
+    store = MeasurementStore(str(tmpdir.join('store')))
+    rs.measure()
+    store.save(rs)
+
+    outside = rs.catalog[:1].copy()
+    outside['_name'] = 'outside'
+    outside['x_cen'] += 1.
+    rs.catalog = vstack([rs.catalog, outside])
+
+    assert list(store.stale(rs)) == [False, False, False, True]
+    assert store.update(rs) == 1
+    assert list(rs.catalog['rejected']) == [0, 0, 0, 1]
+    assert list(store.catalog['rejected']) == [0, 0, 0, 1]
+    assert not store.stale(rs).any()
+
+
+def test_load_is_reused(tmpdir):
+    rs = make_radiosource()
+    store = MeasurementStore(str(tmpdir.join('store')))
+    rs.measure()
+    store.save(rs)
+
+    rs = make_radiosource()
+    record = store.load(rs)
+    assert rs._get_measurement() is record
+    assert np.all(np.asarray(record['snr']) > 10)
+
+
+def test_update_with_saved_apertures(tmpdir):
+    rs = make_radiosource()
+    store = MeasurementStore(str(tmpdir.join('store')))
+    fixed = Ellipse([0, 0], 4*u.pix, 3*u.pix, 0*u.deg, name='fixed')
+    ring = Annulus([0, 0], 8*u.pix, 12*u.pix, name='ring')
+    rs.measure(fixed, bkg_aperture=ring)
+    store.save(rs)
+    assert set(store.apertures()) == {'Ellipse', 'ring', 'fixed'}
+
+    moved = rs.catalog['x_cen'][1] + 1e-6
+    rs.catalog['x_cen'][1] = moved
+    assert store.update(rs) == 1
+    assert store.manifest['bkg_aperture'] == 'ring'
+    assert np.all(np.isfinite(store.stats('fixed')['sum']))
+    npix = store.stats('fixed')['npix']
+    assert np.all(npix == npix[0])
+
+    expected = rs.measure(fixed, bkg_aperture=ring, save=False)
+    assert np.allclose(store.snr, expected['snr'])
+
+
+def test_update_without_aperture_specs(tmpdir):
+    rs = make_radiosource()
+    store = MeasurementStore(str(tmpdir.join('store')))
+    store.save(rs)
+    del store.manifest['aperture_specs']
+    with pytest.raises(ValueError):
+        store.update(rs)
@@ -1,44 +1,46 @@
+import sys
+import numbers
 import numpy as np
-from radio_beam import Beams
-from radio_beam.utils import BeamError
 import astropy.units as u
 from astropy.table import MaskedColumn, Column, vstack
 from astropy.coordinates import SkyCoord
-from astropy.utils.console import ProgressBar
-from astropy.stats import mad_std
-from copy import deepcopy
 import warnings
-import regions
 
 
 class NonEquivalentError(Exception):
     pass
 
-def get_index_masked(table):
+def get_index_masked(table, columns=None):
     """
     Returns indices of rows in a table that contain one or more masked entries.
 
     Parameters
     ----------
-    table : ~astropy.table.Table
+    table : ~astropy.table.Table or ~astropy.table.Column
         The table to check for masked entries.
+    columns : list of str, optional
+        Names of the columns to check. By default, all columns are checked.
 
     Returns
     -------
     ~numpy.ndarray
     """
+    if not hasattr(table, 'colnames'):
+        mask = np.ma.getmaskarray(table)
+        return np.flatnonzero(mask.any(axis=tuple(range(1, mask.ndim))))
 
-    ind = []
-    try:
-        for i, row in enumerate(table.mask):
-            if np.array(list(row)).any():
-                ind.append(i)
-    except TypeError:
-        for i, somebool in enumerate(table.mask):
-            if somebool:
-                ind.append(i)
+    if columns is None:
+        columns = table.colnames
 
-    return np.array(ind)
+    masks = [np.zeros(len(table), dtype=bool)]
+    for name in columns:
+        mask = getattr(table[name], 'mask', None)
+        if mask is None or mask is np.ma.nomask:
+            continue
+        mask = np.asarray(mask, dtype=bool)
+        masks.append(mask.any(axis=tuple(range(1, mask.ndim))))
+
+    return np.flatnonzero(np.logical_or.reduce(masks))
 
 
 def specindex(nu1, nu2, f1, alpha):
@@ -63,6 +65,7 @@ def rms(x, mean_abs_dev=False):
     if mean_abs_dev:
         return (np.absolute(np.mean(x**2) - (np.mean(x))**2))**0.5
     else:
+        from astropy.stats import mad_std
         return mad_std(x)
 
 def load(infile):
@@ -83,10 +86,26 @@ def ucheck(quantity, unit):
     quantity : scalar, array, or `~astropy.units.Unit`
         The quantity to check for units. If scalar, units will assumed to be
         the same as in the "unit" argument.
-    unit : `~astropy.units.Unit`
+    unit : `~astropy.units.Unit` or str
         The unit to check against. If the "quantity" argument already has an
         associated unit, a conversion will be attempted.
     """
+    if not isinstance(unit, u.UnitBase):
+        unit = u.Unit(unit)
+
+    # Fast paths for quantities that are already tagged with a unit, and for
+    # plain numbers, which need no further validation
+    if isinstance(quantity, u.Quantity):
+        if quantity.unit == unit:
+            return quantity
+        try:
+            return quantity.to(unit)
+        except u.UnitsError:
+            raise NonEquivalentError("Non-equivalent units")
+
+    elif isinstance(quantity, numbers.Number) or type(quantity) is np.ndarray:
+        return quantity * unit
+
     if isinstance(quantity, Column):
         name = quantity.name
         if quantity.unit is None:
@@ -109,7 +128,7 @@ def ucheck(quantity, unit):
         else:
             raise NonEquivalentError("Non-equivalent units")
 
-    elif isinstance(quantity, regions.PixCoord):
+    elif _is_pixcoord(quantity):
         if unit.is_equivalent(u.pix):
             return quantity
         else:
@@ -156,11 +175,22 @@ def ucheck(quantity, unit):
             return quantity * unit
             warnings.warn("Assuming quantity is in {}".format(unit))
 
+def _is_pixcoord(obj):
+    """
+    Check if an object is a `~regions.PixCoord`, without importing regions.
+    """
+    regions = sys.modules.get('regions')
+    return regions is not None and isinstance(obj, regions.PixCoord)
+
+
 def commonbeam(major1, minor1, pa1, major2, minor2, pa2):
     """
     Create a smallest bounding ellipse around two other ellipses.
     Give ellipse dimensions as astropy units quantities.
     """
+    from radio_beam import Beams
+    from radio_beam.utils import BeamError
+
     major1 = ucheck(major1, unit=u.deg)
     minor1 = ucheck(minor1, unit=u.deg)
     pa1 = ucheck(pa1, unit=u.deg)
@@ -185,6 +215,90 @@ def commonbeam(major1, minor1, pa1, major2, minor2, pa2):
 
     return new_major.to(u.deg), new_minor.to(u.deg), new_pa
 
+def _ellipse_matrix(major, minor, pa):
+    """
+    Return the matrix R diag(major**2, minor**2) R^T of each ellipse, where R
+    rotates by the position angle.
+    """
+    theta = np.radians(pa)
+    cos, sin = np.cos(theta), np.sin(theta)
+    a2, b2 = major**2, minor**2
+    matrix = np.empty(np.shape(major) + (2, 2))
+    matrix[..., 0, 0] = a2*cos**2 + b2*sin**2
+    matrix[..., 1, 1] = a2*sin**2 + b2*cos**2
+    matrix[..., 0, 1] = matrix[..., 1, 0] = (a2 - b2)*cos*sin
+    return matrix
+
+
+def commonbeam_array(major1, minor1, pa1, major2, minor2, pa2):
+    """
+    Find the smallest bounding ellipse around each of many pairs of
+    ellipses at once.
+
+    The pair is stretched so that the first ellipse becomes a unit circle;
+    the smallest ellipse containing a unit circle and another ellipse shares
+    that ellipse's axes, so the result follows in closed form. Pairs where
+    the first ellipse has no area fall back to `~dendrocat.utils.commonbeam`.
+
+    Parameters
+    ----------
+    major1, minor1, pa1, major2, minor2, pa2 : array-like
+        Dimensions of each pair of ellipses. Axes may be given in any unit,
+        but without astropy units attached. Position angles are in degrees.
+
+    Returns
+    -------
+    `~numpy.ndarray`, `~numpy.ndarray`, `~numpy.ndarray`
+        Major axes, minor axes (same unit as the input), and position angles
+        (degrees) of the bounding ellipses.
+    """
+    major1, minor1, pa1, major2, minor2, pa2 = np.broadcast_arrays(
+        *[np.asarray(x, dtype=float) for x in (major1, minor1, pa1,
+                                                major2, minor2, pa2)])
+
+    # Square root of the first ellipse's matrix, and its inverse
+    theta = np.radians(pa1)
+    rot = np.empty(major1.shape + (2, 2))
+    rot[..., 0, 0] = rot[..., 1, 1] = np.cos(theta)
+    rot[..., 1, 0] = np.sin(theta)
+    rot[..., 0, 1] = -rot[..., 1, 0]
+
+    degenerate = ~((major1 > 0) & (minor1 > 0)
+                   & np.isfinite(major2) & np.isfinite(minor2))
+    safe_major1 = np.where(degenerate, 1., major1)
+    safe_minor1 = np.where(degenerate, 1., minor1)
+    scale = np.zeros(major1.shape + (2, 2))
+    scale[..., 0, 0] = safe_major1
+    scale[..., 1, 1] = safe_minor1
+    root = rot @ scale @ np.swapaxes(rot, -1, -2)
+    scale[..., 0, 0] = 1/safe_major1
+    scale[..., 1, 1] = 1/safe_minor1
+    inv_root = rot @ scale @ np.swapaxes(rot, -1, -2)
+
+    # In the stretched frame, keep the second ellipse's axes but make each
+    # at least as long as the unit circle's
+    stretched = inv_root @ _ellipse_matrix(major2, minor2, pa2) @ inv_root
+    values, vectors = np.linalg.eigh(stretched)
+    values = np.maximum(values, 1.)
+    common = (vectors * values[..., None, :]) @ np.swapaxes(vectors, -1, -2)
+    common = root @ common @ root
+
+    values, vectors = np.linalg.eigh(common)
+    new_major = np.sqrt(values[..., 1])
+    new_minor = np.sqrt(values[..., 0])
+    new_pa = np.degrees(np.arctan2(vectors[..., 1, 1],
+                                   vectors[..., 0, 1])) % 180.
+
+    for i in zip(*np.nonzero(degenerate)):
+        new_maj, new_min, pa = commonbeam(major1[i]*u.deg, minor1[i]*u.deg,
+                                          pa1[i]*u.deg, major2[i]*u.deg,
+                                          minor2[i]*u.deg, pa2[i]*u.deg)
+        new_major[i] = new_maj.to(u.deg).value
+        new_minor[i] = new_min.to(u.deg).value
+        new_pa[i] = pa.to(u.deg).value
+
+    return new_major, new_minor, new_pa
+
 def saveregions(catalog, outfile, skip_rejects=True):
     """
     Save a catalog as a a DS9 region file.
@@ -198,22 +312,198 @@ def saveregions(catalog, outfile, skip_rejects=True):
         Path to save the region file.
     skip_rejects : bool, optional
         If enabled, rejected sources will not be saved. Default is True
+
+    See Also
+    --------
+    `~dendrocat.export.write_regions`
     """
+    from .export import write_regions
 
     if outfile.split('.')[-1] != 'reg':
         warnings.warn('Invalid or missing file extension. Self-correcting.')
         outfile = outfile.split('.')[0]+'.reg'
 
-    if skip_rejects:
-        catalog = catalog[np.where(catalog['rejected'] == 0)]
+    write_regions(catalog, outfile, format='ds9', skip_rejects=skip_rejects)
+
+
+save_regions = saveregions
+
+
+def save_pages(pages, outfile, dpi=150):
+    """
+    Save a sequence of rendered pages as a multi-page PDF.
+
+    Parameters
+    ----------
+    pages : iterable of `~numpy.ndarray`
+        RGBA images, one per page. May be a generator, so that pages are
+        written as soon as they are rendered.
+    outfile : str
+        Path to save the PDF.
+    dpi : int, optional
+        Resolution the pages were rendered at. Default is 150.
+    """
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_pdf import PdfPages
+
+    with PdfPages(outfile) as pdf:
+        for page in pages:
+            height, width = page.shape[:2]
+            fig = Figure(figsize=(width/dpi, height/dpi), dpi=dpi)
+            fig.figimage(page, origin='upper')
+            pdf.savefig(fig, dpi=dpi)
+
+
+def iter_table_chunks(table, chunk_size=100000, format=None):
+    """
+    Read a table in chunks of rows, so that large catalogs do not need to
+    fit in memory.
+
+    Parameters
+    ----------
+    table : `~astropy.table.Table`, iterable of `~astropy.table.Table`, or str
+        The table, an iterable of tables (such as a generator), or the path
+        to a table file. FITS files are memory-mapped. Line-based text
+        tables, including IPAC tables, are read a block of lines at a time.
+    chunk_size : int, optional
+        Largest number of rows per chunk. Default is 100000.
+    format : str, optional
+        The astropy table format of a table file. Inferred from the file
+        extension if not given.
+
+    Yields
+    ------
+    `~astropy.table.Table`
+    """
+    from astropy.table import Table
+
+    if isinstance(table, Table):
+        tables = [table]
+    elif not isinstance(table, str):
+        tables = table
+    else:
+        if format is None:
+            extension = table.lower().split('.')[-1]
+            format = {'fits': 'fits', 'fit': 'fits', 'tbl': 'ascii.ipac',
+                      'ipac': 'ascii.ipac', 'csv': 'ascii.csv',
+                      'ecsv': 'ascii.ecsv'}.get(extension, 'ascii')
+
+        if format == 'fits':
+            tables = [Table.read(table, format='fits', memmap=True)]
+
+        elif format in ('ascii.ecsv', 'votable', 'hdf5', 'parquet'):
+            tables = [Table.read(table, format=format)]
+
+        else:
+            tables = _iter_text_chunks(table, chunk_size, format)
+
+    for table in tables:
+        for start in range(0, len(table), chunk_size):
+            yield table[start:start+chunk_size]
+
+
+def _iter_text_chunks(path, chunk_size, format):
+    """
+    Read a line-based text table in blocks of lines, parsing each block
+    together with the table's header.
+    """
+    from itertools import chain, islice
+    from astropy.table import Table
+
+    ipac = format in ('ipac', 'ascii.ipac')
+    with open(path) as f:
+        header = []
+        lines = f
+        for line in f:
+            if line.startswith(('\\', '|', '#')) or not line.strip():
+                header.append(line)
+            elif ipac:
+                lines = chain([line], f)
+                break
+            else:
+                # Column names of other tables are on the first other line
+                header.append(line)
+                break
+
+        while True:
+            chunk = list(islice(lines, chunk_size))
+            if not chunk:
+                break
+            yield Table.read(header + chunk, format=format)
+
+
+def _unit_vectors(lon, lat):
+    """
+    Convert sky coordinates in degrees to cartesian unit vectors.
+    """
+    lon = np.radians(np.asarray(lon, dtype=float))
+    lat = np.radians(np.asarray(lat, dtype=float))
+    return np.column_stack([np.cos(lat)*np.cos(lon),
+                            np.cos(lat)*np.sin(lon),
+                            np.sin(lat)])
+
+
+def _chord(angle):
+    """
+    Convert an angular separation in degrees to the straight-line distance
+    between unit vectors.
+    """
+    return 2*np.sin(np.radians(angle)/2)
+
+
+def _match_pairs(stack, threshold):
+    """
+    Pair up non-rejected sources in a table that lie within a threshold
+    separation of each other.
+
+    Sources are taken in table order, and each is paired with its nearest
+    unpaired neighbor within the threshold. Every source belongs to at most
+    one pair.
+
+    Parameters
+    ----------
+    stack : `~astropy.table.Table`
+        Table of sources, with 'x_cen', 'y_cen', and 'rejected' columns.
+    threshold : float
+        Maximum separation between matched sources, in degrees.
 
-    with open(outfile, 'w') as fh:
-        fh.write("icrs\n")
-        for row in catalog:
-            fh.write("ellipse({}, {}, {}, {}, {}) # text={{}}\n"
-                     .format(row['x_cen'], row['y_cen'], row['major_fwhm']/2.,
-                             row['minor_fwhm']/2., row['position_angle'],
-                             row['_name']))
+    Returns
+    -------
+    list of tuple
+        The row indices (kept, merged) of each pair.
+    """
+    from scipy.spatial import cKDTree
+
+    candidates = np.where(np.asarray(stack['rejected']) != 1)[0]
+    if len(candidates) < 2:
+        return []
+
+    xyz = _unit_vectors(stack['x_cen'][candidates],
+                        stack['y_cen'][candidates])
+    tree = cKDTree(xyz)
+    close = tree.sparse_distance_matrix(tree, _chord(threshold),
+                                        output_type='coo_matrix')
+
+    # Nearest neighbor first for each source, skipping self-matches
+    first, second, dist = close.row, close.col, close.data
+    keep = first != second
+    first, second, dist = first[keep], second[keep], dist[keep]
+    order = np.lexsort((dist, first))
+    first, second = first[order], second[order]
+
+    paired = np.zeros(len(candidates), dtype=bool)
+    pairs = []
+    starts = np.searchsorted(first, np.arange(len(candidates)))
+    stops = np.searchsorted(first, np.arange(len(candidates)), side='right')
+    for i in range(len(candidates)):
+        if paired[i]:
+            continue
+        for j in second[starts[i]:stops[i]]:
+            if not paired[j]:
+                paired[i] = paired[j] = True
+                pairs.append((candidates[i], candidates[j]))
+                break
+    return pairs
 
 
 def match(*args, verbose=True, threshold=0.036*u.arcsec):
@@ -253,77 +543,48 @@ def match(*args, verbose=True, threshold=0.036*u.arcsec):
             stack['_index'] = range(len(stack))
         stack = stack[sorted(list(all_colnames))]
 
-        rejected = np.where(stack['rejected'] == 1)[0]
+        pairs = _match_pairs(stack, threshold)
 
         if verbose:
-            print('Combining matches')
-            pb = ProgressBar(len(stack) - len(rejected))
-
-        i = 0
-        while True:
-
-            if i >= len(stack) - 1:
-                break
-
-            if i in rejected:
-                i += 1
-                continue
-
-            teststar = stack[i]
-            delta_p = deepcopy(stack[stack['rejected']==0]['_idx', '_index', 'x_cen', 'y_cen'])
-            delta_p.remove_rows(np.where(delta_p['_index']==teststar['_index'])[0])
-            delta_p['x_cen'] = np.abs(delta_p['x_cen'] - teststar['x_cen'])
-            delta_p['y_cen'] = np.abs(delta_p['y_cen'] - teststar['y_cen'])
-            delta_p.sort('x_cen')
-
-            found_match = False
-
-            dist_col = MaskedColumn(length=len(delta_p), name='dist',
-                                    mask=True)
-
-            for j in range(min(10, len(delta_p))):
-                dist_col[j] = np.sqrt(delta_p[j]['x_cen']**2. +
-                                      delta_p[j]['y_cen']**2)
-                if dist_col[j] <= threshold:
-                    found_match = True
-
-            delta_p.add_column(dist_col)
-            delta_p.sort('dist')
-
-            if found_match:
-                match_index = np.where(stack['_index'] == delta_p[0]['_index'])
-                match = deepcopy(stack[match_index])
-                stack.remove_row(match_index[0][0])
-
-                # Find the common bounding ellipse
-                new_x_cen = np.average([match['x_cen'], teststar['x_cen']])
-                new_y_cen = np.average([match['y_cen'], teststar['y_cen']])
-
-                # Find new ellipse properties
-                new_maj, new_min, new_pa = commonbeam(
-                                             float(match['major_fwhm']),
-                                             float(match['minor_fwhm']),
-                                             float(match['position_angle']),
-                                             float(teststar['major_fwhm']),
-                                             float(teststar['minor_fwhm']),
-                                             float(teststar['position_angle'])
-                                             )
-
-                # Replace properties of test star
-                stack[i]['x_cen'] = new_x_cen
-                stack[i]['y_cen'] = new_y_cen
-                stack[i]['major_fwhm'] = new_maj.value
-                stack[i]['minor_fwhm'] = new_min.value
-                stack[i]['position_angle'] = new_pa.value
-
-                # Replace masked data with available values from the match
-                for k, masked in enumerate(stack.mask[i]):
-                    colname = stack.colnames[k]
-                    if masked:
-                        stack[i][colname] = match[colname]
-            i += 1
-            if verbose:
-                pb.update()
+            print('Combining {} matches'.format(len(pairs)))
+
+        kept = np.array([i for i, j in pairs], dtype=int)
+        merged = np.array([j for i, j in pairs], dtype=int)
+
+        if len(pairs) > 0:
+            # Find the common bounding ellipses of all pairs at once
+            new_majs, new_mins, new_pas = commonbeam_array(
+                np.asarray(stack['major_fwhm'][merged], dtype=float),
+                np.asarray(stack['minor_fwhm'][merged], dtype=float),
+                np.asarray(stack['position_angle'][merged], dtype=float),
+                np.asarray(stack['major_fwhm'][kept], dtype=float),
+                np.asarray(stack['minor_fwhm'][kept], dtype=float),
+                np.asarray(stack['position_angle'][kept], dtype=float))
+
+            # Replace masked data in each kept row with available values
+            # from its match, one column at a time for all pairs
+            for colname in stack.colnames:
+                mask = np.ma.getmaskarray(stack[colname])
+                fill = mask[kept] & ~mask[merged]
+                if not fill.any():
+                    continue
+                data = np.ma.getdata(stack[colname])
+                stack[colname][kept] = np.where(fill, data[merged],
+                                                data[kept])
+                stack[colname].mask[kept] = mask[kept] & ~fill
+
+            # Replace properties of the kept rows
+            for colname in ['x_cen', 'y_cen']:
+                values = np.asarray(stack[colname], dtype=float)
+                stack[colname][kept] = (values[kept] + values[merged])/2
+            stack['major_fwhm'][kept] = new_majs
+            stack['minor_fwhm'][kept] = new_mins
+            stack['position_angle'][kept] = new_pas
+
+        # Matched sources have been merged into their partners
+        unmatched = np.ones(len(stack), dtype=bool)
+        unmatched[merged] = False
+        stack = stack[unmatched]
 
         # Fill masked detection column fields with 'False'
         for colname in stack.colnames:
@@ -333,3 +594,346 @@ def match(*args, verbose=True, threshold=0.036*u.arcsec):
         stack['_index'] = range(len(stack))
         current_arg = MasterCatalog(arg1, arg2, catalog=stack)
     return current_arg
+
+
+def _merge_groups(stack, labels):
+    """
+    Merge the rows of a table that share a group label into one row each.
+
+    Each merged row takes the mean position of its group and the common beam
+    of all of its members. Every other column takes the first unmasked value
+    among the members, in table order.
+
+    Parameters
+    ----------
+    stack : `~astropy.table.Table`
+        The table to merge.
+    labels : array-like of int
+        Group label of each row.
+
+    Returns
+    -------
+    `~astropy.table.Table`
+        One row per group, ordered by each group's first row in the table.
+    """
+    labels = np.asarray(labels)
+    n = len(labels)
+    if n == 0:
+        return stack.copy()
+
+    # Relabel each group by its first row, so groups sort in table order
+    first_row = np.full(labels.max() + 1, n)
+    np.minimum.at(first_row, labels, np.arange(n))
+    labels = first_row[labels]
+
+    order = np.argsort(labels, kind='stable')
+    starts = np.flatnonzero(np.r_[True, labels[order][1:] != labels[order][:-1]])
+    sizes = np.diff(np.r_[starts, n])
+    group = np.repeat(np.arange(len(starts)), sizes)
+    rank = np.arange(n) - np.repeat(starts, sizes)
+    reps = order[starts]
+
+    merged = stack[reps]
+
+    # Fill masked entries from the first member with a value, column by
+    # column for all groups at once
+    position = np.arange(n)
+    for colname in stack.colnames:
+        mask = np.ma.getmaskarray(stack[colname])[order]
+        if not mask.any():
+            continue
+        first = np.minimum.reduceat(np.where(mask, n, position), starts)
+        fill = (first < n) & np.ma.getmaskarray(merged[colname])
+        if fill.any():
+            data = np.ma.getdata(stack[colname])[order]
+            merged[colname][fill] = data[first[fill]]
+            merged[colname].mask[fill] = False
+
+    # Mean position of each group
+    for colname in ['x_cen', 'y_cen']:
+        values = np.asarray(stack[colname], dtype=float)[order]
+        merged[colname] = np.add.reduceat(values, starts)/sizes
+
+    # Grow each group's beam to contain one more member at a time
+    major = np.asarray(merged['major_fwhm'], dtype=float)
+    minor = np.asarray(merged['minor_fwhm'], dtype=float)
+    pa = np.asarray(merged['position_angle'], dtype=float)
+    for r in range(1, sizes.max()):
+        members = order[rank == r]
+        groups = group[rank == r]
+        major[groups], minor[groups], pa[groups] = commonbeam_array(
+            major[groups], minor[groups], pa[groups],
+            np.asarray(stack['major_fwhm'][members], dtype=float),
+            np.asarray(stack['minor_fwhm'][members], dtype=float),
+            np.asarray(stack['position_angle'][members], dtype=float))
+    merged['major_fwhm'] = major
+    merged['minor_fwhm'] = minor
+    merged['position_angle'] = pa
+
+    return merged
+
+
+def _stack_catalogs(args):
+    """
+    Vertically stack the catalogs of several dendrocat objects, with a fresh
+    '_index' column and the columns in sorted order.
+    """
+    all_colnames = set(['_index'])
+    for arg in args:
+        all_colnames.update(arg.catalog.colnames)
+    stack = vstack([arg.catalog for arg in args])
+    stack['_index'] = range(len(stack))
+    return stack[sorted(list(all_colnames))]
+
+
+def match_nway(*args, verbose=True, threshold=0.036*u.arcsec):
+    """
+    Match sources between any number of dendrocat objects simultaneously.
+
+    Unlike `~dendrocat.utils.match`, all catalogs are indexed at once and the
+    result does not depend on the order of the arguments. Sources closer
+    than ``threshold`` are linked, and every chain of linked sources
+    (friends-of-friends) becomes one source in the master catalog. Rejected
+    sources are kept but never matched.
+
+    Parameters
+    ----------
+    *args : `~dendrocat.RadioSource` or `~dendrocat.MasterCatalog` objects
+        The objects whose catalogs will be matched.
+    verbose : bool, optional
+        If enabled, output is fed to the console.
+    threshold : `~astropy.units.Quantity`, optional
+        Linking length between matched sources.
+
+    Returns
+    ----------
+    `~dendrocat.MasterCatalog` object
+    """
+    from scipy.spatial import cKDTree
+    from scipy.sparse import coo_matrix
+    from scipy.sparse.csgraph import connected_components
+    from .mastercatalog import MasterCatalog
+
+    threshold = threshold.to(u.deg).value
+
+    stack = _stack_catalogs(args)
+
+    candidates = np.where(np.asarray(stack['rejected']) != 1)[0]
+    xyz = _unit_vectors(stack['x_cen'][candidates],
+                        stack['y_cen'][candidates])
+    links = cKDTree(xyz).query_pairs(_chord(threshold), output_type='ndarray')
+
+    # Rows are linked through their position among the candidates; rejected
+    # rows get no links and stay on their own
+    n = len(stack)
+    graph = coo_matrix((np.ones(len(links)),
+                        (candidates[links[:, 0]], candidates[links[:, 1]])),
+                       shape=(n, n))
+    ngroups, labels = connected_components(graph, directed=False)
+
+    if verbose:
+        print('Matched {} sources into {} groups'.format(n, ngroups))
+
+    merged = _merge_groups(stack, labels)
+
+    # Fill masked detection column fields with 'False'
+    for colname in merged.colnames:
+        if 'detected' in colname:
+            merged[colname].fill_value = 0
+
+    merged['_index'] = range(len(merged))
+    return MasterCatalog(*args, catalog=merged)
+
+
+def positional_error(catalog, sys_error=0.01*u.arcsec):
+    """
+    Estimate the positional uncertainty of each source in a catalog.
+
+    The statistical error of a fitted position scales as the source size
+    over twice its signal-to-noise ratio. The size is the geometric mean of
+    'major_fwhm' and 'minor_fwhm', and the signal-to-noise ratio is the
+    largest unmasked value among the '<freq_id>_snr' columns (taken as 1
+    where none is available). A systematic error is added in quadrature.
+
+    Parameters
+    ----------
+    catalog : `~astropy.table.Table`
+        The source catalog.
+    sys_error : `~astropy.units.Quantity`, optional
+        Systematic positional error, such as from the astrometric
+        calibration. Default is 0.01 arcsec.
+
+    Returns
+    -------
+    `~numpy.ndarray`
+        The one-dimensional positional error of each source, in degrees.
+    """
+    size = np.sqrt(np.asarray(catalog['major_fwhm'], dtype=float)
+                   * np.asarray(catalog['minor_fwhm'], dtype=float))
+
+    snr = np.ones(len(catalog))
+    for colname in catalog.colnames:
+        if colname.endswith('_snr'):
+            values = np.ma.filled(np.ma.asarray(catalog[colname],
+                                                dtype=float), 1.)
+            snr = np.fmax(snr, values)
+
+    sys_error = ucheck(sys_error, unit=u.arcsec).to(u.deg).value
+    return np.sqrt((size/(2*snr))**2 + sys_error**2)
+
+
+def match_probabilistic(*args, verbose=True, sys_error=0.01*u.arcsec,
+                        max_sigma=5., min_prob=0.5, ambiguity=0.1,
+                        density=None):
+    """
+    Match sources between any number of dendrocat objects using the
+    positional uncertainty of each source.
+
+    Rather than a fixed separation threshold, each pair of sources from
+    different catalogs is scored with the Gaussian likelihood of its
+    separation given both sources' positional errors (see
+    `~dendrocat.utils.positional_error`), so compact, bright sources match
+    tightly and large or faint ones match loosely. Each likelihood is
+    normalized against the source's other candidates in the same catalog
+    and against the density of unrelated sources, from both sides of the
+    pair; the smaller of the two is the match probability. Pairs that are
+    each other's best candidate with a probability of at least
+    ``min_prob`` are linked, and linked sources are merged as in
+    `~dendrocat.utils.match_nway`. Rejected sources are kept but never
+    matched.
+
+    The master catalog gains a 'match_prob' column, the lowest probability
+    among the links that formed each source (masked for unmatched sources),
+    and a 'match_ambiguous' column, set to 1 where any member had two or
+    more candidates in one catalog with a probability of at least
+    ``ambiguity``.
+
+    Parameters
+    ----------
+    *args : `~dendrocat.RadioSource` or `~dendrocat.MasterCatalog` objects
+        The objects whose catalogs will be matched.
+    verbose : bool, optional
+        If enabled, output is fed to the console.
+    sys_error : `~astropy.units.Quantity`, optional
+        Systematic positional error added to every source. Default is 0.01
+        arcsec.
+    max_sigma : float, optional
+        Pairs separated by more than this many combined standard deviations
+        are not considered. Default is 5.
+    min_prob : float, optional
+        Lowest match probability for which sources are linked. Default is
+        0.5.
+    ambiguity : float, optional
+        Lowest probability for a candidate to count toward an ambiguous
+        match. Default is 0.1.
+    density : `~astropy.units.Quantity`, optional
+        Surface density of unrelated sources, e.g. in units of
+        ``1/u.arcsec**2``. By default, each catalog's density is estimated
+        from its number of sources over the extent of all sources.
+
+    Returns
+    ----------
+    `~dendrocat.MasterCatalog` object
+    """
+    from scipy.spatial import cKDTree
+    from scipy.sparse import coo_matrix
+    from scipy.sparse.csgraph import connected_components
+    from .mastercatalog import MasterCatalog
+
+    stack = _stack_catalogs(args)
+    origin = np.repeat(np.arange(len(args)),
+                       [len(arg.catalog) for arg in args])
+    sigma = positional_error(stack, sys_error=sys_error)
+    n = len(stack)
+
+    # Candidate pairs from different catalogs, within max_sigma of each
+    # other for even the least certain partner
+    candidates = np.where(np.asarray(stack['rejected']) != 1)[0]
+    if len(candidates) > 0:
+        xyz = _unit_vectors(stack['x_cen'][candidates],
+                            stack['y_cen'][candidates])
+        radius = max_sigma*np.sqrt(sigma[candidates]**2
+                                   + sigma[candidates].max()**2)
+        neighbors = cKDTree(xyz).query_ball_point(xyz, _chord(radius))
+        counts = np.array([len(nbrs) for nbrs in neighbors], dtype=int)
+        first = candidates[np.repeat(np.arange(len(candidates)), counts)]
+        second = candidates[np.hstack([[]] + list(neighbors)).astype(int)]
+        keep = origin[first] != origin[second]
+        first, second = first[keep], second[keep]
+    else:
+        first = second = np.zeros(0, dtype=int)
+
+    # Gaussian likelihood of each separation, in 1/deg**2
+    sep = np.degrees(2*np.arcsin(np.linalg.norm(
+        _unit_vectors(stack['x_cen'][first], stack['y_cen'][first])
+        - _unit_vectors(stack['x_cen'][second], stack['y_cen'][second]),
+        axis=1)/2))
+    var = sigma[first]**2 + sigma[second]**2
+    keep = sep**2 <= max_sigma**2*var
+    first, second, sep, var = first[keep], second[keep], sep[keep], var[keep]
+    like = np.exp(-sep**2/(2*var))/(2*np.pi*var)
+
+    if density is None and n == 0:
+        density = np.zeros(len(args))
+    elif density is None:
+        lon = np.asarray(stack['x_cen'], dtype=float)
+        lat = np.asarray(stack['y_cen'], dtype=float)
+        area = ((lon.max() - lon.min())*np.cos(np.radians(np.median(lat)))
+                * (lat.max() - lat.min()))
+        nsources = np.bincount(origin, minlength=len(args))
+        density = nsources/max(area, np.finfo(float).tiny)
+    else:
+        density = np.full(len(args),
+                          ucheck(density, unit=u.deg**-2).to(u.deg**-2).value)
+
+    # Normalize over each source's candidates in the partner's catalog.
+    # Every pair appears once in each direction, so the reverse
+    # normalization is found by looking up the swapped pair.
+    key = first*n + second
+    group = first*len(args) + origin[second]
+    total = np.bincount(group, weights=like, minlength=n*len(args))
+    prob = like/(total[group] + density[origin[second]])
+    order = np.argsort(key)
+    reverse = order[np.searchsorted(key[order], second*n + first)]
+    prob = np.minimum(prob, prob[reverse])
+
+    # Ambiguous sources have several plausible candidates in one catalog
+    plausible = np.bincount(group[prob >= ambiguity], minlength=n*len(args))
+    ambiguous = np.zeros(n, dtype=int)
+    ambiguous[first[plausible[group] > 1]] = 1
+
+    # Link mutual best candidates
+    best = np.lexsort((-prob, group))
+    is_best = np.zeros(len(prob), dtype=bool)
+    if len(prob) > 0:
+        is_best[best[np.r_[True, group[best][1:] != group[best][:-1]]]] = True
+    link = is_best & is_best[reverse] & (prob >= min_prob) & (first < second)
+    first, second, prob = first[link], second[link], prob[link]
+
+    graph = coo_matrix((np.ones(len(first)), (first, second)), shape=(n, n))
+    ngroups, labels = connected_components(graph, directed=False)
+
+    if verbose:
+        print('Matched {} sources into {} groups'.format(n, ngroups))
+
+    # Carry the link probabilities and flags through the merge
+    link_prob = np.full(n, np.inf)
+    np.minimum.at(link_prob, first, prob)
+    np.minimum.at(link_prob, second, prob)
+    group_prob = np.full(n, np.inf)
+    np.minimum.at(group_prob, labels, link_prob)
+    group_ambiguous = np.zeros(n, dtype=int)
+    np.maximum.at(group_ambiguous, labels, ambiguous)
+    stack['match_prob'] = MaskedColumn(group_prob[labels],
+                                       mask=np.isinf(group_prob[labels]))
+    stack['match_ambiguous'] = group_ambiguous[labels]
+
+    merged = _merge_groups(stack, labels)
+
+    # Fill masked detection column fields with 'False'
+    for colname in merged.colnames:
+        if 'detected' in colname:
+            merged[colname].fill_value = 0
+
+    merged['_index'] = range(len(merged))
+    return MasterCatalog(*args, catalog=merged)